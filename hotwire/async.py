@@ -19,7 +19,7 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import threading, Queue, logging
+import threading, Queue, logging, time, heapq
 
 from hotwire.gutil import call_timeout,remove_idle
 from hotwire.externals.singletonmixin import Singleton
@@ -27,17 +27,45 @@ from hotwire.externals.singletonmixin import Singleton
 _logger = logging.getLogger("hotwire.Async")
 
 class MiniThreadPool(Singleton):
-    """A Thread pool.  Seems like a missing battery from the Python standard library..."""
+    """A Thread pool.  Seems like a missing battery from the Python standard library...
+
+Work is queued in priority lanes; idle threads always take the oldest job from the
+highest priority nonempty lane.  Bulk work is never allowed to occupy every thread,
+so that interactive work can start without waiting for it to drain."""
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_DEFAULT = 1
+    PRIORITY_BULK = 2
+    lane_names = ('interactive', 'default', 'bulk')
+
+    DEFAULT_MAX_THREADS = 7
+
     def __init__(self):
         _logger.debug("Creating MiniThreadPool")
         self.__queue_cond = threading.Condition()
-        self.__queue = []
+        self.__lanes = [[] for name in self.lane_names]
         self.__avail_threads = 0
         self.__thread_count = 0
-        self.__max_threads = 7
+        self.__max_threads = self.DEFAULT_MAX_THREADS
+        self.__running_bulk = 0
         self.__async_serial = 0
 
-    def run(self, callable, args=()):
+    def set_max_threads(self, count):
+        """Set the maximum number of worker threads; must be at least 2 so
+        that one thread is always available for non-bulk work."""
+        if count < 2:
+            raise ValueError("Thread pool requires at least 2 threads, %d given" % (count,))
+        self.__queue_cond.acquire()
+        self.__max_threads = count
+        self.__queue_cond.notifyAll()
+        self.__queue_cond.release()
+
+    def get_max_threads(self):
+        return self.__max_threads
+
+    def run(self, callable, args=(), priority=PRIORITY_DEFAULT):
+        """Queue callable(*args) for execution, returning a serial which may
+        be passed to cancel()."""
         self.__queue_cond.acquire()
         if not self.__avail_threads and self.__thread_count < self.__max_threads:
             thr = threading.Thread(target=self.__worker, name="MiniThreadPool Thread")
@@ -47,23 +75,56 @@ class MiniThreadPool(Singleton):
             self.__thread_count += 1
         serial = self.__async_serial
         self.__async_serial += 1
-        self.__queue.append((serial, callable, args))
-        self.__queue_cond.notify()
+        self.__lanes[priority].append((serial, callable, args))
+        self.__queue_cond.notifyAll()
         self.__queue_cond.release()
         return serial
     
     def cancel(self, serial):
-        # FIXME implement
-        pass
+        """Remove a queued job.  Returns True if it was removed, False if it
+        already started or completed."""
+        self.__queue_cond.acquire()
+        try:
+            for lane in self.__lanes:
+                for i,(job_serial, cb, args) in enumerate(lane):
+                    if job_serial == serial:
+                        del lane[i]
+                        return True
+            return False
+        finally:
+            self.__queue_cond.release()
+
+    def get_queue_depths(self):
+        """Return a dictionary mapping lane name to the number of queued jobs."""
+        self.__queue_cond.acquire()
+        try:
+            return dict(zip(self.lane_names, map(len, self.__lanes)))
+        finally:
+            self.__queue_cond.release()
+
+    def __pop_job(self):
+        # Called with __queue_cond held
+        for priority,lane in enumerate(self.__lanes):
+            if not lane:
+                continue
+            if priority == self.PRIORITY_BULK and self.__running_bulk >= self.__max_threads - 1:
+                continue
+            (serial, cb, args) = lane.pop(0)
+            return (priority, cb, args)
+        return None
             
     def __worker(self):
         while True:
             _logger.debug("thread %s waiting", threading.currentThread())
             self.__queue_cond.acquire()
             self.__avail_threads += 1
-            while not self.__queue:
+            job = self.__pop_job()
+            while job is None:
                 self.__queue_cond.wait()
-            (serial, cb, args) = self.__queue.pop(0)
+                job = self.__pop_job()
+            (priority, cb, args) = job
+            if priority == self.PRIORITY_BULK:
+                self.__running_bulk += 1
             self.__avail_threads -= 1
             self.__queue_cond.release()
             try:
@@ -71,21 +132,280 @@ class MiniThreadPool(Singleton):
                 cb(*args)
             except:
                 logging.exception("Exception in thread pool worker")
+            if priority == self.PRIORITY_BULK:
+                self.__queue_cond.acquire()
+                self.__running_bulk -= 1
+                self.__queue_cond.notifyAll()
+                self.__queue_cond.release()
+
+class GroupThreadPool(Singleton):
+    """A pool of reusable threads for groups of callables which must all run
+concurrently, such as the stages of a pipeline.  A group is only started
+when a thread is available for each member, so members never wait on each
+other for a thread.  Waiting groups are started in FIFO order, and a group
+which has waited ADMIT_TIMEOUT seconds is started on extra threads, since
+the running groups may be blocked for good."""
+
+    DEFAULT_MAX_THREADS = 32
+    ADMIT_TIMEOUT = 0.5
+
+    def __init__(self):
+        _logger.debug("Creating GroupThreadPool")
+        self.__cond = threading.Condition()
+        self.__ready = []
+        self.__pending = []
+        self.__thread_count = 0
+        self.__busy = 0
+        self.__max_threads = self.DEFAULT_MAX_THREADS
+
+    def set_max_threads(self, count):
+        self.__cond.acquire()
+        self.__max_threads = count
+        self.__admit()
+        self.__cond.release()
+
+    def get_max_threads(self):
+        return self.__max_threads
+
+    def run_group(self, callables, wait=True):
+        """Run all of the given callables concurrently.  If there are not enough free
+threads and wait is True, the group is queued until there are, or for at most
+ADMIT_TIMEOUT seconds; otherwise the pool temporarily grows beyond its maximum size."""
+        if not callables:
+            return
+        self.__cond.acquire()
+        try:
+            if wait:
+                self.__pending.append(callables)
+                self.__admit()
+                if self.__pending and self.__pending[-1] is callables:
+                    DeadlineTimer.getInstance().call_at(time.time() + self.ADMIT_TIMEOUT,
+                                                        lambda: self.__admit_late(callables))
+            else:
+                self.__start(callables)
+        finally:
+            self.__cond.release()
+
+    def get_queue_depth(self):
+        """Return the number of groups waiting for threads."""
+        return len(self.__pending)
+
+    def __start(self, callables):
+        # Called with __cond held
+        self.__busy += len(callables)
+        self.__ready.extend(callables)
+        while self.__thread_count < self.__busy:
+            thr = threading.Thread(target=self.__worker, name="GroupThreadPool Thread")
+            _logger.debug("Created thread %s", thr)
+            thr.setDaemon(True)
+            thr.start()
+            self.__thread_count += 1
+        self.__cond.notifyAll()
+
+    def __admit(self):
+        # Called with __cond held
+        while self.__pending:
+            group = self.__pending[0]
+            # Groups larger than the whole pool are started once it is idle
+            if not (self.__busy + len(group) <= self.__max_threads or self.__busy == 0):
+                break
+            self.__pending.pop(0)
+            self.__start(group)
+
+    def __admit_late(self, group):
+        self.__cond.acquire()
+        try:
+            for (i, pending) in enumerate(self.__pending):
+                if pending is group:
+                    _logger.debug("Group waited %.1fs for threads; starting it anyway", self.ADMIT_TIMEOUT)
+                    del self.__pending[i]
+                    self.__start(group)
+                    break
+        finally:
+            self.__cond.release()
+
+    def __worker(self):
+        self.__cond.acquire()
+        while True:
+            while not self.__ready:
+                if self.__thread_count > max(self.__max_threads, self.__busy):
+                    # Surplus thread from an oversized group
+                    self.__thread_count -= 1
+                    self.__cond.release()
+                    return
+                self.__cond.wait()
+            cb = self.__ready.pop(0)
+            self.__cond.release()
+            try:
+                cb()
+            except:
+                logging.exception("Exception in thread pool worker")
+            self.__cond.acquire()
+            self.__busy -= 1
+            self.__admit()
+
+class DeadlineTimer(Singleton):
+    """Calls functions from a single background thread once their deadlines
+pass.  Meant for short, cheap callbacks which must run even while the main
+loop is busy or not running."""
 
-class IterableQueue(Queue.Queue):
     def __init__(self):
+        _logger.debug("Creating DeadlineTimer")
+        self.__cond = threading.Condition()
+        # Heap of (deadline, serial, callable)
+        self.__timers = []
+        self.__serial = 0
+        self.__thread = None
+
+    def call_at(self, deadline, callable):
+        """Call callable() once time.time() reaches deadline."""
+        self.__cond.acquire()
+        try:
+            self.__serial += 1
+            heapq.heappush(self.__timers, (deadline, self.__serial, callable))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__worker, name="DeadlineTimer Thread")
+                self.__thread.setDaemon(True)
+                self.__thread.start()
+            elif self.__timers[0][1] == self.__serial:
+                # Sooner than what the thread is waiting for
+                self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+    def __worker(self):
+        self.__cond.acquire()
+        while True:
+            if not self.__timers:
+                # Started again by the next call_at()
+                self.__thread = None
+                self.__cond.release()
+                return
+            delay = self.__timers[0][0] - time.time()
+            if delay > 0:
+                self.__cond.wait(delay)
+                continue
+            (deadline, serial, cb) = heapq.heappop(self.__timers)
+            self.__cond.release()
+            try:
+                cb()
+            except:
+                logging.exception("Exception in deadline timer")
+            self.__cond.acquire()
+
+class ObjectBatch(list):
+    """A list of objects transferred through an IterableQueue as one item.
+The objects are stored in reverse order so they can be popped cheaply."""
+    __slots__ = []
+
+class IterableQueue(Queue.Queue):
+    """A queue of objects which can be consumed from the main loop or by iteration.
+
+If high_water is nonzero, producers block once that many objects are queued.
+A None item marks the end of the stream, and is always accepted."""
+
+    # Default number of milliseconds to coalesce objects for a connected handler
+    DEFAULT_LATENCY = 100
+    
+    def __init__(self, high_water=0):
         Queue.Queue.__init__(self)
         self.__lock = threading.Lock()
         self.__handler_idle_id = 0
         self.__handler = None
         self.__handler_args = None
         self.__timeout_kwargs = None
+        self.__latency = self.DEFAULT_LATENCY
+        self.__last_dispatch = 0
+        self.__block_hook = None
+        self.__objcount = 0
+        self.__discarding = False
+        self.high_water = high_water
+        # Total seconds producers have spent blocked on a full queue
+        self.put_wait_time = 0
+        # Total seconds get_batch() callers have spent blocked on an empty queue
+        self.get_wait_time = 0
+        # Objects added and removed over the queue's lifetime, not counting None
+        self.put_total = 0
+        self.get_total = 0
+        # Largest number of objects queued at once
+        self.peak_count = 0
+        # Set once the None terminator has been removed
+        self.drained = False
+
+    def _put(self, item):
+        if type(item) is ObjectBatch:
+            self.__objcount += len(item)
+            self.put_total += len(item)
+        else:
+            self.__objcount += 1
+            if item is not None:
+                self.put_total += 1
+        # The None terminator doesn't count towards the peak
+        if item is not None and self.__objcount > self.peak_count:
+            self.peak_count = self.__objcount
+        self.queue.append(item)
+
+    def _get(self):
+        # Called with the queue mutex held; unpack batches transparently so that
+        # plain get() callers see individual objects.
+        self.__objcount -= 1
+        item = self.queue[0]
+        if type(item) is ObjectBatch:
+            self.get_total += 1
+            obj = item.pop()
+            if not item:
+                self.queue.popleft()
+            return obj
+        if item is not None:
+            self.get_total += 1
+        else:
+            self.drained = True
+        return self.queue.popleft()
+
+    def __put(self, item):
+        self.not_full.acquire()
+        try:
+            if self.high_water > 0 and (item is not None) \
+                   and self.__objcount >= self.high_water and not self.__discarding:
+                start = time.time()
+                while self.__objcount >= self.high_water and not self.__discarding:
+                    self.not_full.wait()
+                self.put_wait_time += time.time() - start
+            if self.__discarding and (item is not None):
+                return False
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+        finally:
+            self.not_full.release()
+
+    def discard(self):
+        """Stop accepting objects other than the None terminator, waking
+any blocked producers."""
+        self.not_full.acquire()
+        self.__discarding = True
+        self.not_full.notifyAll()
+        self.not_full.release()
+
+    def get_count(self):
+        """Return the number of objects currently queued."""
+        return self.__objcount
 
     def connect(self, handler, *args, **kwargs):
+        """Arrange for handler(queue, *args) to be called from the main loop when
+objects are available.  The handler is invoked as soon as possible for the
+first object after a quiet period; while objects keep arriving, calls are
+coalesced so they happen at most once every latency milliseconds (keyword
+argument, default DEFAULT_LATENCY).  If the handler returns True, it is
+invoked again at the next idle time.  Other keyword arguments are passed
+to call_timeout."""
+        latency = kwargs.pop('latency', self.DEFAULT_LATENCY)
         self.__lock.acquire()
         assert(self.__handler is None)
         self.__handler_args = args
         self.__timeout_kwargs = kwargs
+        self.__latency = latency
         self.__handler = handler
         self.__lock.release()
         if not self.empty():
@@ -103,26 +423,82 @@ class IterableQueue(Queue.Queue):
     def __do_idle(self):
         self.__lock.acquire()
         self.__handler_idle_id = 0
+        self.__last_dispatch = time.time()
         handler = self.__handler
         self.__lock.release()
-        if handler:
-            return handler(self, *self.__handler_args)
+        if handler and handler(self, *self.__handler_args):
+            # The handler has more work queued; continue at the next idle.
+            self.__add_idle(immediate=True)
+        return False
 
-    def __add_idle(self):
+    def __add_idle(self, immediate=False):
         self.__lock.acquire()
-        if self.__handler_idle_id == 0 and self.__handler:           
-            self.__handler_idle_id = call_timeout(200, self.__do_idle, **self.__timeout_kwargs)
+        if self.__handler_idle_id == 0 and self.__handler:
+            if immediate:
+                timeout = 0
+            else:
+                # Wake right away after a quiet period, otherwise wait out the rest
+                # of the latency budget so a stream of objects is coalesced.
+                elapsed = int((time.time() - self.__last_dispatch) * 1000)
+                timeout = max(self.__latency - elapsed, 0)
+            self.__handler_idle_id = call_timeout(timeout, self.__do_idle, **self.__timeout_kwargs)
         self.__lock.release()
 
-    def put(self, *args):
-        Queue.Queue.put(self, *args)
-        self.__add_idle()
+    def put(self, item):
+        if self.__put(item):
+            self.__add_idle()
+
+    def put_batch(self, objs):
+        """Add a list of objects to the queue, taking the queue locks only once."""
+        if not objs:
+            return
+        batch = ObjectBatch(objs)
+        batch.reverse()
+        if self.__put(batch):
+            self.__add_idle()
+
+    def set_block_hook(self, hook):
+        """Set a function to be invoked before get_batch() blocks on an empty queue."""
+        self.__block_hook = hook
+
+    def get_batch(self, block=True):
+        """Remove and return the list of objects in the next queue item.  If
+block is False and no item is available, raises Queue.Empty."""
+        if block and self.__block_hook is not None and self.empty():
+            self.__block_hook()
+        self.not_empty.acquire()
+        try:
+            if not block:
+                if not self._qsize():
+                    raise Queue.Empty
+            elif not self._qsize():
+                start = time.time()
+                while not self._qsize():
+                    self.not_empty.wait()
+                self.get_wait_time += time.time() - start
+            item = self.queue.popleft()
+            if type(item) is ObjectBatch:
+                self.__objcount -= len(item)
+                self.get_total += len(item)
+            else:
+                self.__objcount -= 1
+                if item is not None:
+                    self.get_total += 1
+                else:
+                    self.drained = True
+            self.not_full.notify()
+        finally:
+            self.not_empty.release()
+        if type(item) is ObjectBatch:
+            item.reverse()
+            return item
+        return [item]
         
     def iter_avail(self):
         try:
             while True:
-                val = self.get(False)
-                yield val
+                for val in self.get_batch(False):
+                    yield val
         except Queue.Empty, e:
             pass
 
@@ -135,10 +511,8 @@ class QueueIterator(object):
         self._source = source
 
     def __iter__(self):
-        item = True
-        while not (item is None):
-            item = self._source.get()
-            if not (item is None):
+        while True:
+            for item in self._source.get_batch():
+                if item is None:
+                    return
                 yield item
-            else:
-                break
@@ -0,0 +1,244 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os, sys, time, tempfile, subprocess, shutil, resource, random
+
+from hotwire.command import HotwireContext, Pipeline
+from hotwire.sysdep.fs import Filesystem
+
+def _make_text_file(megabytes):
+    (fd, path) = tempfile.mkstemp(prefix='hotwirebench')
+    f = os.fdopen(fd, 'w')
+    line = 'x' * 79 + '\n'
+    block = line * (1024 * 1024 // len(line))
+    for i in xrange(megabytes):
+        f.write(block)
+    f.close()
+    return path
+
+def _report(name, nbytes, secs):
+    sys.stdout.write("  %s: %.2fs, %.1f MB/s\n" % (name, secs, nbytes / (1024.0 * 1024) / secs))
+
+def _measure_sys_cat(megabytes):
+    path = _make_text_file(megabytes)
+    try:
+        nbytes = os.stat(path).st_size
+        start = time.time()
+        subprocess.call(['cat', path], stdout=open(os.devnull, 'w'))
+        _report('shell cat > /dev/null', nbytes, time.time() - start)
+
+        context = HotwireContext(initcwd=os.path.dirname(path))
+        for (name, opt_formats) in (('sys cat, lines', []),
+                                    ('sys cat, chunks', ['bytearray/chunked'])):
+            pipeline = Pipeline.parse('sys cat ' + path, context)
+            start = time.time()
+            pipeline.execute(opt_formats=opt_formats)
+            count = 0
+            for obj in pipeline.get_output():
+                count += len(obj)
+            assert count == nbytes
+            _report(name, nbytes, time.time() - start)
+    finally:
+        os.unlink(path)
+
+def bench_sys_cat_throughput():
+    """Bytes per second read from a system command's output."""
+    _measure_sys_cat(100)
+
+def _make_tree(dirs, files_per_dir):
+    root = tempfile.mkdtemp(prefix='hotwirebench')
+    for i in xrange(dirs):
+        dpath = os.path.join(root, 'directory%04d' % (i,))
+        os.mkdir(dpath)
+        for j in xrange(files_per_dir):
+            open(os.path.join(dpath, 'some-file-name-%06d.txt' % (j,)), 'w').close()
+    return root
+
+def _maxrss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measure_file_memory(dirs, files_per_dir):
+    root = _make_tree(dirs, files_per_dir)
+    try:
+        fs = Filesystem.getInstance()
+        start_rss = _maxrss()
+        start = time.time()
+        files = []
+        for dpath in sorted(os.listdir(root)):
+            for fobj in fs.ls_dir(os.path.join(root, dpath), True):
+                fobj.size
+                files.append(fobj)
+        secs = time.time() - start
+        kbytes = _maxrss() - start_rss
+        sys.stdout.write("  %d File objects: %.2fs, %.1f MB, %d bytes/file\n" \
+                         % (len(files), secs, kbytes / 1024.0, kbytes * 1024 // len(files)))
+    finally:
+        shutil.rmtree(root)
+
+def bench_file_memory():
+    """Memory held by stat'ed File objects from a synthetic tree."""
+    _measure_file_memory(100, 2000)
+
+def _measure_ls(files):
+    root = _make_tree(1, files)
+    try:
+        dpath = os.path.join(root, os.listdir(root)[0])
+        fs = Filesystem.getInstance()
+        for (name, fn) in (('ls_dir', lambda fobj: None),
+                           ('ls_dir, is_directory', lambda fobj: fobj.is_directory),
+                           ('ls_dir, size', lambda fobj: fobj.size)):
+            start = time.time()
+            for fobj in fs.ls_dir(dpath, False):
+                fn(fobj)
+            sys.stdout.write("  %s, %d files: %.2fs\n" % (name, files, time.time() - start))
+    finally:
+        shutil.rmtree(root)
+
+def bench_ls():
+    """Listing a large directory, with and without reading stats."""
+    _measure_ls(100000)
+
+def _measure_file_properties(files, passes):
+    root = _make_tree(1, files)
+    try:
+        dpath = os.path.join(root, os.listdir(root)[0])
+        fobjs = list(Filesystem.getInstance().ls_dir(dpath, False, resolve=True))
+        start = time.time()
+        for i in xrange(passes):
+            for fobj in fobjs:
+                fobj.size
+                fobj.mtime
+                fobj.is_directory
+        sys.stdout.write("  size, mtime, is_directory, %d passes over %d files: %.2fs\n" \
+                         % (passes, files, time.time() - start))
+    finally:
+        shutil.rmtree(root)
+
+def bench_file_properties():
+    """Reading the stat-derived properties of already stat'ed Files."""
+    _measure_file_properties(100000, 5)
+
+def _make_text_tree(dirs, files_per_dir, words_per_file):
+    rand = random.Random(42)
+    vocabulary = ['%s%d' % (rand.choice(('get', 'set', 'make', 'file', 'path', 'index')), i) for i in xrange(20000)]
+    root = tempfile.mkdtemp(prefix='hotwirebench')
+    nbytes = 0
+    for i in xrange(dirs):
+        dpath = os.path.join(root, 'directory%04d' % (i,))
+        os.mkdir(dpath)
+        for j in xrange(files_per_dir):
+            words = [rand.choice(vocabulary) for k in xrange(words_per_file)]
+            if j == 0 and i % 10 == 0:
+                words.append('needle')
+            text = '\n'.join(' '.join(words[k:k+10]) for k in xrange(0, len(words), 10))
+            f = open(os.path.join(dpath, 'source%04d.txt' % (j,)), 'w')
+            f.write(text)
+            f.close()
+            nbytes += len(text)
+    return (root, nbytes)
+
+def _time_fsearch(context, regexp):
+    pipeline = Pipeline.parse('fsearch ' + regexp, context)
+    start = time.time()
+    pipeline.execute_sync()
+    count = len(list(pipeline.get_output()))
+    return (count, time.time() - start)
+
+def _measure_trigram_index(dirs, files_per_dir, words_per_file):
+    (root, nbytes) = _make_text_tree(dirs, files_per_dir, words_per_file)
+    try:
+        context = HotwireContext(initcwd=root)
+        for regexp in ('needle', '-l index1234'):
+            (count, secs) = _time_fsearch(context, regexp)
+            _report('fsearch %s, no index (%d matches)' % (regexp, count), nbytes, secs)
+        pipeline = Pipeline.parse('index-build', context)
+        start = time.time()
+        pipeline.execute_sync()
+        _report('index-build', nbytes, time.time() - start)
+        for regexp in ('needle', '-l index1234'):
+            (count, secs) = _time_fsearch(context, regexp)
+            _report('fsearch %s, indexed (%d matches)' % (regexp, count), nbytes, secs)
+        # Touch a few files, as an edit would
+        for i in xrange(10):
+            f = open(os.path.join(root, 'directory%04d' % (i,), 'source0000.txt'), 'a')
+            f.write('\nneedle\n')
+            f.close()
+        (count, secs) = _time_fsearch(context, 'needle')
+        _report('fsearch needle, 10 files changed (%d matches)' % (count,), nbytes, secs)
+    finally:
+        shutil.rmtree(root)
+
+def bench_trigram_index():
+    """Building the fsearch content index, and searching with and without it."""
+    _measure_trigram_index(100, 100, 1000)
+
+def _time_pipeline(context, text):
+    pipeline = Pipeline.parse(text, context)
+    start = time.time()
+    pipeline.execute_sync()
+    count = len(list(pipeline.get_output()))
+    return (count, time.time() - start)
+
+def _measure_file_index(dirs, files_per_dir):
+    root = _make_tree(dirs, files_per_dir)
+    try:
+        context = HotwireContext(initcwd=root)
+        (count, secs) = _time_pipeline(context, "walk | filter 001234 path")
+        sys.stdout.write("  walk | filter 001234 path (%d matches): %.3fs\n" % (count, secs))
+        # The first run indexes the tree
+        for text in ("find 001234", "find 001234", "find -u 001234", "find 'some-file-name-0012*'",
+                     "find -r '01234.txt$'", "find type=d"):
+            (count, secs) = _time_pipeline(context, text)
+            sys.stdout.write("  %s (%d matches): %.3fs\n" % (text, count, secs))
+    finally:
+        shutil.rmtree(root)
+
+def bench_file_index():
+    """Finding files by name with the file index, against a full traversal."""
+    _measure_file_index(100, 2000)
+
+def _measure_sechash(files, megabytes):
+    root = tempfile.mkdtemp(prefix='hotwirebench')
+    try:
+        block = os.urandom(1024 * 1024)
+        for i in xrange(files):
+            f = open(os.path.join(root, 'image%02d.iso' % (i,)), 'wb')
+            for j in xrange(megabytes):
+                f.write(block)
+            f.close()
+            # Old enough to be cached
+            os.utime(f.name, (time.time() - 10, time.time() - 10))
+        nbytes = files * megabytes * 1024 * 1024
+        context = HotwireContext(initcwd=root)
+        for name in ('sechash, first run', 'sechash, cached'):
+            pipeline = Pipeline.parse('sechash *.iso', context)
+            start = time.time()
+            pipeline.execute_sync()
+            assert len(list(pipeline.get_output())) == files
+            _report(name, nbytes, time.time() - start)
+    finally:
+        shutil.rmtree(root)
+
+def bench_sechash():
+    """Hashing a directory of large files, and hashing it again unchanged."""
+    _measure_sechash(8, 64)
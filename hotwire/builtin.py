@@ -38,10 +38,18 @@ class InputStreamSchema(ObjectStreamSchema):
         self.optional = optional
 
 class OutputStreamSchema(ObjectStreamSchema):
-    def __init__(self, otype, merge_default=False, typefunc=None, **kwargs):
+    def __init__(self, otype, merge_default=False, typefunc=None, batched=True, display_opt_formats=None, **kwargs):
         super(OutputStreamSchema, self).__init__(otype, **kwargs)
         self.merge_default = merge_default
         self.typefunc = typefunc
+        # The subset of opt_formats to offer when the output goes to the display;
+        # by default, all of them.
+        if display_opt_formats is None:
+            display_opt_formats = self.opt_formats
+        self.display_opt_formats = display_opt_formats
+        # Whether objects may be held back and transferred to the next stage in batches;
+        # builtins which can block for a long time between objects should disable this.
+        self.batched = batched
 
 class ArgSpec(object):
     __slots__ = ['name', 'opt']
@@ -66,6 +74,8 @@ class Builtin(object):
     output_type = property(lambda self: self._output and self._output.otype or None)
     output_typefunc = property(lambda self: self._output and self._output.typefunc or None)
     output_opt_formats = property(lambda self: self._output and self._output.opt_formats or [])
+    output_display_opt_formats = property(lambda self: self._output and self._output.display_opt_formats or [])
+    output_batched = property(lambda self: self._output and self._output.batched)
     options = property(lambda self: self._options)
     options_passthrough = property(lambda self: self._options_passthrough, doc="""Treat all options as arguments.""")
     argspec = property(lambda self: self._argspec)
@@ -76,6 +86,10 @@ class Builtin(object):
     hasmeta = property(lambda self: self._hasmeta)
     nodisplay = property(lambda self: self._nodisplay)
     threaded = property(lambda self: self._threaded)
+    fusible = property(lambda self: self._fusible, doc="""Cheap per-object work which may run in the producer's thread.""")
+    cacheable = property(lambda self: self._cacheable, doc="""Output depends only on the arguments, the input, and the files named by the arguments or in the working directory.""")
+    stream_args = property(lambda self: self._stream_args, doc="""Arguments are passed as one iterable, expanded lazily.""")
+    parallel = property(lambda self: self._parallel, doc="""Accepts -j to spread the work over worker processes.""")
     locality = property(lambda self: self._locality)
     api_version = property(lambda self: self._api_version)
     singlevalue = property(lambda self: self._singlevalue)
@@ -95,12 +109,18 @@ class Builtin(object):
                  hasmeta=False,
                  nodisplay=False,
                  threaded=True,
+                 fusible=False,
+                 cacheable=False,
+                 stream_args=False,
+                 parallel=False,
                  locality='local',
                  doc=None,
                  api_version=0,
                  singlevalue=False):
         self._input=input
         self._output = isinstance(output, OutputStreamSchema) and output or OutputStreamSchema(output)
+        if parallel:
+            options = options + [['-j', '--parallel']]
         self._options = options
         self._options_passthrough = options_passthrough
         if isinstance(argspec, tuple):
@@ -115,6 +135,10 @@ class Builtin(object):
         self._hasmeta = hasstatus or hasmeta
         self._nodisplay = nodisplay
         self._threaded = threaded
+        self._fusible = fusible
+        self._cacheable = cacheable
+        self._stream_args = stream_args
+        self._parallel = parallel
         self._locality = locality
         self._api_version = api_version
         self._singlevalue = singlevalue
@@ -216,10 +240,18 @@ class PyFuncBuiltin(Builtin):
         self.__func_is_generator = func.func_code.co_flags & 0x20
         if not self.__func_is_generator:
             kwargs['singlevalue'] = True
-        kwargs['output'] = 'any'
+        output = kwargs.get('output')
+        if isinstance(output, OutputStreamSchema):
+            # Keep any optimized formats, but objects are dynamically typed
+            kwargs['output'] = OutputStreamSchema('any', opt_formats=output.opt_formats, batched=output.batched,
+                                                  display_opt_formats=output.display_opt_formats)
+        else:
+            kwargs['output'] = 'any'
         kwargs['doc'] = inspect.getdoc(func)
         if self.__func_args[1] is not None:
             kwargs['argspec'] = MultiArgSpec(self.__func_args[1])
+        elif kwargs.get('stream_args'):
+            kwargs['argspec'] = MultiArgSpec(self.__func_args[0][1])
         else:
             kwargs['argspec'] = tuple(self.__func_args[0][1:])
         super(PyFuncBuiltin, self).__init__(name, **kwargs)
@@ -246,6 +278,7 @@ def load():
     import hotwire.builtins.current
     import hotwire.builtins.exit
     import hotwire.builtins.filter
+    import hotwire.builtins.find
     import hotwire.builtins.fsearch
     import hotwire.builtins.head    
     import hotwire.builtins.help
@@ -258,6 +291,7 @@ def load():
     if have_simplejson:
         import hotwire.builtins.json
     import hotwire.builtins.httpget
+    import hotwire.builtins.index_build
     import hotwire.builtins.kill
     import hotwire.builtins.iter
     import hotwire.builtins.ls
@@ -265,6 +299,7 @@ def load():
     import hotwire.builtins.mv
     import hotwire.builtins.open
     import hotwire.builtins.path
+    import hotwire.builtins.pipeline_stats
     import hotwire.builtins.pprint_builtin
     import hotwire.builtins.prop
     import hotwire.builtins.proc
@@ -20,13 +20,32 @@
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from hotwire.fs import FilePath, open_text_file
-from hotwire.builtin import builtin_hotwire
+from hotwire.builtin import builtin_hotwire, OutputStreamSchema
 
-@builtin_hotwire(output=str,
-                 idempotent=True)
-def cat(context, *files):
+CHUNK_SIZE = 64 * 1024
+
+@builtin_hotwire(output=OutputStreamSchema(str, opt_formats=['bytearray/chunked'], display_opt_formats=[]),
+                 idempotent=True,
+                 cacheable=True,
+                 stream_args=True)
+def cat(context, files, out_opt_format=None):
     _("""Yield content lines from file path arguments.""")    
     for f in files:
+        if context.cancelled:
+            return
         fpath = FilePath(f, context.cwd)
+        if out_opt_format == 'bytearray/chunked':
+            # Our consumer takes bytes, so don't decode
+            stream = open(fpath, 'rb')
+            try:
+                buf = stream.read(CHUNK_SIZE)
+                while buf:
+                    yield buf
+                    if context.cancelled:
+                        return
+                    buf = stream.read(CHUNK_SIZE)
+            finally:
+                stream.close()
+            continue
         for line in open_text_file(fpath):
             yield line
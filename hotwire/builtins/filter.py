@@ -38,7 +38,9 @@ class FilterBuiltin(Builtin):
                                             input=InputStreamSchema('any'),
                                             output='identity',
                                             options=[['-s', '--stringify'], ['-i', '--ignore-case'],['-v', '--invert-match']],
-                                            argspec=('regexp', ArgSpec('property', opt=True)))
+                                            argspec=('regexp', ArgSpec('property', opt=True)),
+                                            fusible=True,
+                                            cacheable=True)
 
     def execute(self, context, args, options=[]):     
         if len(args) == 2:
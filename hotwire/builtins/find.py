@@ -0,0 +1,136 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import re, time, logging
+
+from hotwire.builtin import BuiltinRegistry, MultiArgSpec
+from hotwire.builtins.fileop import FileOpBuiltin
+from hotwire.fileindex import FileIndex, glob_escape
+from hotwire.sysdep.fs import Filesystem, File, FileStatError
+
+_logger = logging.getLogger("hotwire.builtins.Find")
+
+_size_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+_time_units = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+_bound_re = re.compile(r'^(size|mtime)([-+])(\d+)([a-zA-Z]?)$')
+_type_re = re.compile(r'^type=([fdl]+)$')
+
+class FindBuiltin(FileOpBuiltin):
+    __doc__ = _("""Find files below the current directory by name, using the file index.
+Each predicate is one of: a name substring or quoted glob pattern (or with -r,
+a regular expression); size+N or size-N, for files larger or smaller than N,
+with an optional k, M or G suffix; mtime-N or mtime+N, for files modified less
+or more than N ago, with an optional s, m, h, d or w suffix; or type=f, type=d
+or type=l.  Hidden files are only found with -a.  The directory is indexed the
+first time; later the index is updated in the background, or beforehand with
+-u.  Size and mtime predicates are checked against each file's current stat.""")
+    def __init__(self):
+        super(FindBuiltin, self).__init__('find',
+                                          output=File,
+                                          argspec=MultiArgSpec('predicates'),
+                                          options=[['-a', '--all'], ['-i', '--ignore-case'],
+                                                   ['-r', '--regexp'], ['-u', '--update']])
+
+    def __parse_predicates(self, args, use_regexp):
+        query = {'names': [], 'regexps': []}
+        now = int(time.time())
+        for arg in args:
+            match = _bound_re.match(arg)
+            if match:
+                (field, op, value, unit) = match.groups()
+                if field == 'size':
+                    units = _size_units
+                else:
+                    units = _time_units
+                try:
+                    value = int(value) * units[unit.lower()]
+                except KeyError, e:
+                    raise ValueError(_("Invalid unit: %s") % (arg,))
+                if field == 'size':
+                    key = (op == '-') and 'max_size' or 'min_size'
+                    value += (op == '-') and -1 or 1
+                else:
+                    key = (op == '-') and 'newer' or 'older'
+                    value = now - value
+                query[key] = value
+                continue
+            match = _type_re.match(arg)
+            if match:
+                query['types'] = list(match.group(1))
+                continue
+            if use_regexp:
+                query['regexps'].append(arg)
+            elif re.search(r'[*?[]', arg):
+                query['names'].append(arg)
+            else:
+                query['names'].append(u'*' + glob_escape(arg) + u'*')
+        return query
+
+    def execute(self, context, args, options=[]):
+        query = self.__parse_predicates(args, '-r' in options)
+        fs = Filesystem.getInstance()
+        index = FileIndex.getInstance()
+        path = context.cwd
+        refresh = index.get_root(path) is not None and '-u' not in options
+        if not refresh:
+            index.update(fs, path, cancelled=lambda: context.cancelled)
+        # The index only has the size and mtime of a file as of when its
+        # directory last changed; check those bounds against the current stat
+        bounds = {}
+        for key in ('min_size', 'max_size', 'newer', 'older'):
+            if key in query:
+                bounds[key] = query.pop(key)
+        # (path, size, mtime) of entries which changed since they were indexed
+        stale = []
+        results = index.search(path, ignore_case=('-i' in options), hidden=('-a' in options), **query)
+        try:
+            for entry in results:
+                if context.cancelled:
+                    return
+                try:
+                    fobj = fs.get_file_sync(entry.path)
+                except FileStatError, e:
+                    # Gone since it was indexed
+                    stale.append((entry.path, None, None))
+                    continue
+                st = fobj.stat
+                if st.st_size != entry.size or st.st_mtime != entry.mtime:
+                    stale.append((entry.path, st.st_size, st.st_mtime))
+                if bounds and not self.__within_bounds(st, bounds):
+                    continue
+                yield fobj
+        finally:
+            results.close()
+            index.refresh_entries(stale)
+        if refresh:
+            index.update_async(fs, path)
+
+    def __within_bounds(self, st, bounds):
+        for (key, value) in (('min_size', st.st_size), ('newer', st.st_mtime)):
+            if key in bounds and value < bounds[key]:
+                return False
+        for (key, value) in (('max_size', st.st_size), ('older', st.st_mtime)):
+            if key in bounds and value > bounds[key]:
+                return False
+        return True
+
+BuiltinRegistry.getInstance().register_hotwire(FindBuiltin())
@@ -19,16 +19,19 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, logging, re
+import os, sys, logging, re, mmap, locale
+from functools import partial
 
 import hotwire
 import hotwire.fs
-from hotwire.fs import FilePath, file_is_valid_utf8, open_text_file
+from hotwire.fs import FilePath, path_join, path_normalize
 
-from hotwire.command import HotwireContext
 from hotwire.builtin import Builtin, BuiltinRegistry, ArgSpec
 from hotwire.builtins.fileop import FileOpBuiltin
 from hotwire.sysdep.fs import Filesystem, FileStatError
+from hotwire.fswalk import TreeWalker
+from hotwire.procpool import ProcessPool
+from hotwire.textindex import TrigramIndexService, SNIFF_SIZE
 
 _logger = logging.getLogger("hotwire.builtins.FSearch")
 
@@ -48,35 +51,120 @@ class FileStringMatch(object):
         self._match_start = match_start
         self._match_end = match_end
 
+# Files at least this large are mapped rather than read
+MMAP_THRESHOLD = 1024 * 1024
+
+def _count_newlines(buf, start, end):
+    # mmap has no count(); go through it in slices
+    count = 0
+    while start < end:
+        stop = min(end, start + MMAP_THRESHOLD)
+        count += buf[start:stop].count('\n')
+        start = stop
+    return count
+
+def _search_buffer(regexp, buf, encoding, max_count):
+    results = []
+    pos = 0
+    line_num = 0
+    counted = 0
+    size = len(buf)
+    while pos < size:
+        match = regexp.search(buf, pos)
+        if not match:
+            break
+        line_start = buf.rfind('\n', 0, match.start()) + 1
+        line_end = buf.find('\n', match.start())
+        if line_end < 0:
+            line_end = size
+        # The match may run past the end of the line; only one within it counts
+        match = regexp.search(buf, line_start, line_end)
+        if not match:
+            pos = line_end + 1
+            continue
+        line_num += _count_newlines(buf, counted, line_start)
+        counted = line_start
+        line = buf[line_start:line_end]
+        # Offsets into the decoded line
+        start = len(line[:match.start()-line_start].decode(encoding, 'replace'))
+        end = start + len(line[match.start()-line_start:match.end()-line_start].decode(encoding, 'replace'))
+        results.append((line_num, line.decode(encoding, 'replace'), start, end))
+        if max_count is not None and len(results) >= max_count:
+            break
+        pos = line_end + 1
+    return results
+
+def _search_file(regexp, encoding, max_count, size_limit, path):
+    """Return FileStringMatch objects for the lines of the file at path that match
+the bytes pattern regexp, skipping binary files and those over size_limit."""
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        return []
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0 or (size_limit is not None and size > size_limit):
+            return []
+        if size >= MMAP_THRESHOLD:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = f.read()
+        try:
+            if buf[:SNIFF_SIZE].find('\0') >= 0:
+                return []
+            matches = _search_buffer(regexp, buf, encoding, max_count)
+        finally:
+            if size >= MMAP_THRESHOLD:
+                buf.close()
+    except EnvironmentError, e:
+        _logger.debug("Failed to search %r: %s", path, e)
+        return []
+    finally:
+        f.close()
+    return [FileStringMatch(path, line, line_num, start, end) for (line_num, line, start, end) in matches]
+
 class FSearchBuiltin(FileOpBuiltin):
     __doc__ = _("""Search directory tree for files matching a regular expression.""")
+
+    # Maximum size of files searched with --skip-large
+    SIZE_LIMIT = 8 * 1024 * 1024
+
     def __init__(self):
         super(FSearchBuiltin, self).__init__('fsearch',
                                              output=FileStringMatch,
                                              argspec=('regexp', ArgSpec('directory', opt=True)),                                             
-                                             options=[['-i', '--ignore-case']])
+                                             options=[['-i', '--ignore-case'], ['-l', '--files-with-matches'],
+                                                      ['-s', '--skip-large']])
 
     def execute(self, context, args, options=[]):       
-        regexp = args[0]
         if len(args) == 2:
-            path = args[1]
+            path = path_normalize(path_join(context.cwd, args[1]))
         else:
             path = context.cwd
+        encoding = locale.getdefaultlocale()[1] or 'utf-8'
         regexp = args[0]
-        comp_regexp = re.compile(regexp, (('-i' in options) and re.IGNORECASE or 0) | re.UNICODE)
-        walk_builtin = BuiltinRegistry.getInstance()['walk']
-        newctx = HotwireContext(context.cwd)
-        for fobj in walk_builtin.execute(newctx, [path]):
-            fp = None
-            try:
-                fp = open_text_file(fobj.path) 
-                for i,line in enumerate(fp):
-                    match = comp_regexp.search(line)
-                    if match:
-                        yield FileStringMatch(fobj.path, line[:-1], i, match.start(), match.end())
-                fp.close()
-            except OSError, e:
-                pass
-            except UnicodeDecodeError, e:
-                pass
+        if isinstance(regexp, unicode):
+            regexp = regexp.encode(encoding)
+        comp_regexp = re.compile(regexp, (('-i' in options) and re.IGNORECASE or 0) | re.MULTILINE)
+        max_count = ('-l' in options) and 1 or None
+        size_limit = ('-s' in options) and self.SIZE_LIMIT or None
+        searchfn = partial(_search_file, comp_regexp, encoding, max_count, size_limit)
+        fs = Filesystem.getInstance()
+        cancelled = lambda: context.cancelled
+        # With an index, only the files it can't rule out are read
+        paths = TrigramIndexService.getInstance().candidates(fs, comp_regexp, path, cancelled=cancelled)
+        if paths is None:
+            batches = TreeWalker(fs).walk(path)
+            paths = (fobj.path for batch in batches for fobj in batch)
+        else:
+            batches = None
+        try:
+            for result in ProcessPool.getInstance().imap(searchfn, paths, cancelled=cancelled):
+                if context.cancelled:
+                    return
+                yield result
+        finally:
+            if batches is not None:
+                batches.close()
+
 BuiltinRegistry.getInstance().register_hotwire(FSearchBuiltin())
@@ -26,7 +26,9 @@ from hotwire.builtin import builtin_hotwire, InputStreamSchema
 
 @builtin_hotwire(input=InputStreamSchema('any',optional=True),
                  options_passthrough=True,
-                 idempotent=True)
+                 idempotent=True,
+                 fusible=True,
+                 cacheable=True)
 def head(context, *files):
     _("""Return a subset of items from start of input stream.""")
     count = 10
@@ -0,0 +1,53 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os, logging
+
+from hotwire.fs import path_join, path_normalize
+
+from hotwire.builtin import BuiltinRegistry, ArgSpec
+from hotwire.builtins.fileop import FileOpBuiltin
+from hotwire.sysdep.fs import Filesystem
+from hotwire.textindex import TrigramIndexService
+
+_logger = logging.getLogger("hotwire.builtins.IndexBuild")
+
+class IndexBuildBuiltin(FileOpBuiltin):
+    __doc__ = _("""Create or update the content index fsearch uses for a directory tree.""")
+    def __init__(self):
+        super(IndexBuildBuiltin, self).__init__('index-build',
+                                                argspec=(ArgSpec('directory', opt=True),),
+                                                options=[['-r', '--rebuild']])
+
+    def execute(self, context, args, options=[]):
+        if len(args) == 1:
+            path = path_normalize(path_join(context.cwd, args[0]))
+        else:
+            path = context.cwd
+        if not os.path.isdir(path):
+            raise ValueError(_("Not a directory: %s") % (path,))
+        TrigramIndexService.getInstance().build(Filesystem.getInstance(), path,
+                                                rebuild=('-r' in options),
+                                                cancelled=lambda: context.cancelled)
+        return []
+
+BuiltinRegistry.getInstance().register_hotwire(IndexBuildBuiltin())
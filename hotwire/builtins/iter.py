@@ -31,7 +31,9 @@ class IterBuiltin(Builtin):
                                           output='any',
                                           argspec=None,
                                           idempotent=True,
-                                          threaded=False)
+                                          threaded=False,
+                                          fusible=True,
+                                          cacheable=True)
 
     def execute(self, context, args, options=[]):
         for item in context.input:
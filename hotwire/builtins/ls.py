@@ -33,6 +33,7 @@ _logger = logging.getLogger("hotwire.builtins.ls")
                  input=InputStreamSchema(str, optional=True),
                  output=File,
                  idempotent=True,
+                 cacheable=True,
                  argspec=MultiArgSpec('paths'),
                  options=[['-l', '--long'],['-a', '--all'],['-i', '--input']])
 def ls(context, *args):
@@ -46,14 +47,18 @@ def ls(context, *args):
         args = list(args)
         args.extend(context.input)        
         
+    # If our consumer sorts, stream in directory order so the first
+    # entries show up without waiting for the whole listing
+    sort = context.output_ordered
+        
     if len(args) == 0:
-        for x in fs.ls_dir(context.cwd, show_all):
+        for x in fs.ls_dir(context.cwd, show_all, sort=sort):
             yield x
     elif len(args) == 1:
         path = FilePath(args[0], context.cwd)
         fobj = fs.get_file_sync(path)
         if fobj.is_directory:
-            for x in fs.ls_dir(path, show_all):
+            for x in fs.ls_dir(path, show_all, sort=sort):
                 yield x
         else:
             yield fobj
@@ -29,7 +29,9 @@ class NewlineBuiltin(Builtin):
         super(NewlineBuiltin, self).__init__('newline',
                                              input=InputStreamSchema('any'),
                                              output=str,
-                                             argspec=None)
+                                             argspec=None,
+                                             fusible=True,
+                                             cacheable=True)
 
     def execute(self, context, args, options=[]):
         for arg in context.input:
@@ -33,7 +33,9 @@ class PropBuiltin(Builtin):
                                           idempotent=True,
                                           argspec=(ArgSpec('name'),),
                                           options=[['-t', '--tuple']],
-                                          threaded=True)
+                                          threaded=True,
+                                          fusible=True,
+                                          cacheable=True)
 
     def execute(self, context, args, options=[]):
         prop = args[0]            
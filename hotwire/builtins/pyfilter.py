@@ -20,11 +20,19 @@
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import os,sys,re,subprocess,sha,tempfile
+from functools import partial
 
 from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, ArgSpec
 
 from hotwire.fs import path_join
 from hotwire.sysdep.fs import Filesystem
+from hotwire.procpool import ProcessPool
+from hotwire.builtins.pymap import eval_expression
+
+def _filter_object(expression, it):
+    if eval_expression(expression, it):
+        return [it]
+    return []
 
 class PyFilterBuiltin(Builtin):
     __doc__ = _("""Filter object list using Python code.""")
@@ -39,9 +47,16 @@ def execute(context, input):
         super(PyFilterBuiltin, self).__init__('py-filter',
                                               argspec=(ArgSpec('expression'),),
                                               input=InputStreamSchema('any'),
-                                              output='identity')
+                                              output='identity',
+                                              parallel=True)
 
     def execute(self, context, args, options=[]):
+        if '-j' in options:
+            # The expression runs in worker processes, without access to context
+            for o in ProcessPool.getInstance().imap(partial(_filter_object, args[0]), context.input,
+                                                    cancelled=lambda: context.cancelled):
+                yield o
+            return
         buf = self.PYFILTER_CONTENT % (args[0],)
         code = compile(buf, '<input>', 'exec')
         locals = {}
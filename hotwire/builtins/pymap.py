@@ -20,11 +20,25 @@
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import os,sys,re,subprocess,sha,tempfile
+from functools import partial
 
 from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, OutputStreamSchema, ArgSpec
 
 from hotwire.fs import path_join
 from hotwire.sysdep.fs import Filesystem
+from hotwire.procpool import ProcessPool
+
+_compiled = {}
+def eval_expression(expression, it):
+    """Evaluate expression with the object bound to 'it', as py-map -j does."""
+    code = _compiled.get(expression)
+    if code is None:
+        code = compile(expression, '<input>', 'eval')
+        _compiled[expression] = code
+    return eval(code, {'os': os, 'sys': sys, 're': re, 'it': it})
+
+def _map_object(expression, it):
+    return [eval_expression(expression, it)]
 
 class PyMapBuiltin(Builtin):
     __doc__ = _("""Process objects using Python code.""")
@@ -38,9 +52,16 @@ def execute(context, input):
         super(PyMapBuiltin, self).__init__('py-map',
                                            argspec=(ArgSpec('expression'),),
                                            input=InputStreamSchema('any', optional=True),
-                                           output=OutputStreamSchema('any'))
+                                           output=OutputStreamSchema('any'),
+                                           parallel=True)
 
     def execute(self, context, args, options=[]):
+        if '-j' in options:
+            # The expression runs in worker processes, without access to context
+            for o in ProcessPool.getInstance().imap(partial(_map_object, args[0]), context.input,
+                                                    cancelled=lambda: context.cancelled):
+                yield o
+            return
         buf = self.PYMAP_CONTENT % (args[0],)
         code = compile(buf, '<input>', 'exec')
         locals = {}
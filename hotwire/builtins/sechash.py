@@ -19,34 +19,192 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,md5,sha
+import os, sys, stat, mmap, time, hashlib, logging
+from collections import deque
+from functools import partial
+try:
+    import sqlite3
+except:
+    from pysqlite2 import dbapi2 as sqlite3
+try:
+    from pyblake2 import blake2b
+except ImportError, e:
+    blake2b = getattr(hashlib, 'blake2b', None)
 
 import hotwire
 from hotwire.builtin import builtin_hotwire, InputStreamSchema
-from hotwire.fs import FilePath
-from hotwire.sysdep.fs import Filesystem
+from hotwire.fs import FilePath, iter_chunk_lines, mtime_is_racy
+from hotwire.sysdep.fs import Filesystem, File
+from hotwire.procpool import ProcessPool
+from hotwire.state import _get_state_path
+
+_logger = logging.getLogger("hotwire.builtins.SecHash")
+
+# Size of reads; files at least this large are mapped instead
+READ_SIZE = 1024 * 1024
+
+def _new_hash(algorithm):
+    if algorithm == 'blake2b':
+        return blake2b()
+    return hashlib.new(algorithm)
+
+def _hash_string(algorithm, valstr):
+    hashval = _new_hash(algorithm)
+    hashval.update(valstr)
+    return [hashval.hexdigest()]
+
+def _hash_file(algorithm, fpath):
+    hashval = _new_hash(algorithm)
+    stream = open(fpath, 'rb')
+    try:
+        buf = None
+        if os.fstat(stream.fileno()).st_size >= READ_SIZE:
+            try:
+                buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, mmap.error, OverflowError, ValueError), e:
+                # Too large for the address space, or not a regular file
+                pass
+        if buf is not None:
+            try:
+                hashval.update(buf)
+            finally:
+                buf.close()
+        else:
+            for buf in iter(lambda: stream.read(READ_SIZE), ''):
+                hashval.update(buf)
+    finally:
+        stream.close()
+    return [hashval.hexdigest()]
+
+def _hash_item(algorithm, (path, value)):
+    # value is the string to hash without a path, else any cached digest
+    if path is None:
+        return _hash_string(algorithm, value)
+    if value is not None:
+        return [value]
+    try:
+        return _hash_file(algorithm, path)
+    except EnvironmentError, e:
+        # Reported by the caller, which knows which file this was
+        return [None]
+
+class HashCache(object):
+    """Digests of files computed earlier, keyed by the device, inode, size and
+modification time of the file."""
+    def __init__(self, algorithm):
+        super(HashCache, self).__init__()
+        self.__algorithm = algorithm
+        self.__start_time = time.time()
+        self.__added = []
+        self.__conn = sqlite3.connect(_get_state_path('hashes.sqlite'), isolation_level=None)
+        cursor = self.__conn.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Hashes (device INTEGER, inode INTEGER, algorithm TEXT, size INTEGER, mtime REAL, digest TEXT, PRIMARY KEY (device, inode, algorithm))''')
+
+    def lookup(self, st):
+        """Return the digest of the file with stat result st, or None."""
+        cursor = self.__conn.cursor()
+        row = cursor.execute('''SELECT size, mtime, digest FROM Hashes WHERE device = ? AND inode = ? AND algorithm = ?''',
+                             (st.st_dev, st.st_ino, self.__algorithm)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return str(row[2])
+
+    def add(self, st, digest):
+        if mtime_is_racy(st.st_mtime, self.__start_time):
+            return
+        self.__added.append((st.st_dev, st.st_ino, self.__algorithm, st.st_size, st.st_mtime, digest))
+
+    def close(self):
+        """Save the added digests."""
+        try:
+            if self.__added:
+                cursor = self.__conn.cursor()
+                cursor.execute('''BEGIN TRANSACTION''')
+                cursor.executemany('''INSERT OR REPLACE INTO Hashes VALUES (?, ?, ?, ?, ?, ?)''', self.__added)
+                cursor.execute('''COMMIT''')
+                self.__added = []
+        finally:
+            self.__conn.close()
 
 @builtin_hotwire(idempotent=True,
-                 input=InputStreamSchema('any', optional=True),
+                 cacheable=True,
+                 hasmeta=True,
+                 stream_args=True,
+                 parallel=True,
+                 input=InputStreamSchema('any', optional=True, opt_formats=['bytearray/chunked']),
                  output=str,                   
-                 options=[['-5', '--md5'],])
-def sechash(context, *files):
-    _("""Create a secure hash (default SHA1) from objects or file arguments.""")
-    alg = ('-5' in context.options) and md5 or sha  
-    fs = Filesystem.getInstance()
+                 options=[['-5', '--md5'], ['-2', '--sha256'], ['-b', '--blake2']])
+def sechash(context, files, in_opt_format=None):
+    _("""Create a secure hash (default SHA1) from objects, or from files given as arguments or File input.
+File digests are cached.  Files other than regular files, and files which can't be read, are skipped
+and reported in the status.  Files are hashed in worker
+processes; with -j, so are objects.""")
+    if '-5' in context.options:
+        algorithm = 'md5'
+    elif '-2' in context.options:
+        algorithm = 'sha256'
+    elif '-b' in context.options:
+        if blake2b is None:
+            raise ValueError(_("BLAKE2 is not available"))
+        algorithm = 'blake2b'
+    else:
+        algorithm = 'sha1'
     if (not files) and context.input:
-        for val in context.input:
-            valstr = str(val)
-            hashval = alg.new()
-            hashval.update(valstr)
-            yield hashval.hexdigest()
-    for arg in files:
-        fpath = FilePath(arg, context.cwd)
-        stream = open(fpath)
-        hashval = alg.new()
-        buf = stream.read(4096)
-        while buf:
-            hashval.update(buf)
-            buf = stream.read(4096)
-        stream.close()
-        yield hashval.hexdigest()
+        if in_opt_format == 'bytearray/chunked':
+            values = iter_chunk_lines(context.input)
+        else:
+            values = context.input
+        parallel = '-j' in context.options
+        paths = False
+    else:
+        values = (FilePath(arg, context.cwd) for arg in files)
+        parallel = paths = True
+    cache = HashCache(algorithm)
+    # Items awaiting their digest, with the stat result of files
+    pending = deque()
+    skipped = []
+    def iter_items():
+        for value in values:
+            if isinstance(value, File):
+                path = value.path
+            elif paths:
+                path = value
+            else:
+                item = (None, str(value))
+                pending.append((item, None))
+                yield item
+                continue
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                _logger.debug("Failed to stat %r: %s", path, e)
+                skipped.append(path)
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                skipped.append(path)
+                continue
+            item = (path, cache.lookup(st))
+            pending.append((item, st))
+            yield item
+    hashfn = partial(_hash_item, algorithm)
+    try:
+        if parallel:
+            results = ProcessPool.getInstance().imap(hashfn, iter_items(), cancelled=lambda: context.cancelled)
+        else:
+            results = (result for item in iter_items() for result in hashfn(item))
+        for result in results:
+            ((path, value), st) = pending.popleft()
+            if result is None:
+                _logger.debug("Failed to hash %r", path)
+                skipped.append(path)
+                continue
+            if path is not None and value is None:
+                cache.add(st, result)
+            yield result
+        if skipped:
+            names = [os.path.basename(path) for path in skipped[:5]]
+            if len(skipped) > len(names):
+                names.append('...')
+            context.status_notify(_('Skipped %d: %s') % (len(skipped), ', '.join(names)))
+    finally:
+        cache.close()
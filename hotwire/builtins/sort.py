@@ -41,7 +41,8 @@ class SortBuiltin(Builtin):
                                             input=InputStreamSchema('any'),
                                             output='identity',
                                             options=[['-r', '--reverse']],
-                                            argspec=MultiArgSpec('property', min=0))
+                                            argspec=MultiArgSpec('property', min=0),
+                                            cacheable=True)
 
     def execute(self, context, args, options=[]):     
         reversesearch = '-r' in options
@@ -19,7 +19,7 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, subprocess, string, threading, logging, codecs
+import os, sys, subprocess, string, threading, logging, codecs, errno
 try:
     import pty, termios, fcntl
     pty_available = True
@@ -73,7 +73,9 @@ class SysBuiltin(Builtin):
                                          input=InputStreamSchema(str, optional=True, opt_formats=['x-unix-pipe-file-object/special']),
                                          output=OutputStreamSchema(str, opt_formats=['x-unix-pipe-file-object/special',
                                                                                      'x-filedescriptor/special', 
-                                                                                     'bytearray/chunked']),
+                                                                                     'bytearray/chunked',
+                                                                                     'x-unix-file-target/special'],
+                                                                   batched=False),
                                          hasstatus=True,
                                          argspec=MultiArgSpec('args'),
                                          options_passthrough=True)
@@ -99,6 +101,9 @@ class SysBuiltin(Builtin):
         except IOError, e:
             pass
 
+    # Bytes requested per read of the subprocess output
+    READ_SIZE = 64 * 1024
+
     @staticmethod
     def __unbuffered_readlines(stream):
         try:
@@ -109,20 +114,54 @@ class SysBuiltin(Builtin):
         except IOError, e:
             pass
 
+    @staticmethod
+    def __buffered_readlines(fd):
+        """Yield lines from fd, reading in large blocks.  Only whole lines are
+returned, apart from a trailing partial line at the end of the output; the
+display reads chunks instead, so prompts aren't held back."""
+        partial = ''
+        while True:
+            try:
+                buf = os.read(fd, SysBuiltin.READ_SIZE)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # EIO from a pty whose other side is closed
+                break
+            if not buf:
+                break
+            lines = (partial + buf).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
     @staticmethod
     def __unbuffered_read_pipe(fd=None, stream=None):
         if fd is not None:
             fdno = fd
         else:
             fdno = stream.fileno()
-        buf = os.read(fdno, 512)
+        buf = os.read(fdno, SysBuiltin.READ_SIZE)
         while buf:
             yield buf
-            buf = os.read(fdno, 512)
+            buf = os.read(fdno, SysBuiltin.READ_SIZE)
+
+    @staticmethod
+    def __close_pipe(stream):
+        # The pty master, if any, is closed in cleanup()
+        if stream is not None:
+            stream.close()
 
     def cancel(self, context):
         if context.attribs.has_key('pid'):
             pid = context.attribs['pid']
+            if context.stopped:
+                # The read end of its output is closed as execute() returns; the
+                # process sees that on its next write, as under a normal shell
+                _logger.debug("output of pid %s no longer read", pid)
+                return
             _logger.debug("cancelling pid %s", pid)
             ProcessManager.getInstance().terminate_pidgroup(pid)
             
@@ -153,7 +192,7 @@ class SysBuiltin(Builtin):
                     _logger.debug("matched completer %s", matcher)
                     return completer(context, args, i)
 
-    def execute(self, context, args, in_opt_format=None, out_opt_format=None):
+    def execute(self, context, args, in_opt_format=None, out_opt_format=None, out_target=None):
         # This function is complex.  There are two major variables.  First,
         # are we on Unix or Windows?  This is effectively determined by
         # pty_available, though I suppose some Unixes might not have ptys.
@@ -162,8 +201,11 @@ class SysBuiltin(Builtin):
         # (determined by bytearray/chunked).  There is also a special hack
         # x-filedescriptor/special where we pass along a file descriptor from
         # the subprocess; this is used in unicode.py to directly read the output.
+        # For output redirection, x-unix-file-target/special gives us the open
+        # file in out_target, which becomes the subprocess's stdout.
         
-        using_pty_out = pty_available and (out_opt_format not in (None, 'x-unix-pipe-file-object/special'))
+        using_pty_out = pty_available and (out_opt_format not in (None, 'x-unix-pipe-file-object/special',
+                                                                  'x-unix-file-target/special'))
         using_pty_in = pty_available and (in_opt_format is None) and \
                        context.input_is_first and hasattr(context.input, 'connect')
         _logger.debug("using pty in: %s out: %s", using_pty_in, using_pty_out)
@@ -186,6 +228,8 @@ class SysBuiltin(Builtin):
             _logger.debug("allocated pty fds %d %d", master_fd, slave_fd)
             if using_pty_out:
                 stdout_target = slave_fd
+            elif out_opt_format == 'x-unix-file-target/special':
+                stdout_target = out_target
             else:
                 stdout_target = subprocess.PIPE
             if context.input is None:
@@ -201,7 +245,10 @@ class SysBuiltin(Builtin):
         else:
             _logger.debug("no pty available or non-chunked output, not allocating fds")
             (master_fd, slave_fd) = (None, None)
-            stdout_target = subprocess.PIPE
+            if out_opt_format == 'x-unix-file-target/special':
+                stdout_target = out_target
+            else:
+                stdout_target = subprocess.PIPE
             if context.input is None:
                 stdin_target = None
             elif in_opt_format == 'x-unix-pipe-file-object/special':
@@ -249,6 +296,9 @@ class SysBuiltin(Builtin):
                 # of subcommands is tied to an open window, instead of until when the toplevel
                 # process exits.
                 signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                # Python ignores SIGPIPE; restore the default so a child writing to a
+                # closed pipe exits like it would under a normal shell.
+                signal.signal(signal.SIGPIPE, signal.SIG_DFL)
             subproc_args['preexec_fn'] = preexec
         else:
             assert(False)    
@@ -278,26 +328,45 @@ class SysBuiltin(Builtin):
                 context.input.connect(self.__on_input, stdin_stream)
             else:
                 MiniThreadPool.getInstance().run(self.__inputwriter, args=(context.input, stdin_stream))
-        if using_pty_out:
+        if out_opt_format == 'x-unix-file-target/special':
+            # The child has its own copy now
+            out_target.close()
+            (stdout_read, stdout_fd) = (None, None)
+        elif using_pty_out:
             stdout_read = None
             stdout_fd = master_fd
         else:
             stdout_read = subproc.stdout
             stdout_fd = subproc.stdout.fileno()
         if out_opt_format is None:
-            for line in SysBuiltin.__unbuffered_readlines(stdout_read):
-                yield line
+            if is_unix():
+                lines = SysBuiltin.__buffered_readlines(stdout_fd)
+            else:
+                lines = SysBuiltin.__unbuffered_readlines(stdout_read)
+            try:
+                for line in lines:
+                    if context.stopped:
+                        break
+                    yield line
+            finally:
+                SysBuiltin.__close_pipe(stdout_read)
         elif out_opt_format == 'bytearray/chunked':     
             try:
                 for buf in SysBuiltin.__unbuffered_read_pipe(stream=stdout_read, fd=stdout_fd):
+                    if context.stopped:
+                        break
                     yield buf
             except OSError, e:
                 pass
+            finally:
+                SysBuiltin.__close_pipe(stdout_read)
         elif out_opt_format == 'x-unix-pipe-file-object/special':
             yield subproc.stdout
         elif out_opt_format == 'x-filedescriptor/special':
             context.attribs['master_fd_passed'] = True            
             yield stdout_fd
+        elif out_opt_format == 'x-unix-file-target/special':
+            pass
         else:
             assert(False)
         retcode = subproc.wait()
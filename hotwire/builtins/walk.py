@@ -19,53 +19,48 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, logging, re
+import logging
 
-import hotwire
-import hotwire.fs
-from hotwire.fs import FilePath, file_is_valid_utf8, path_join
+from hotwire.fs import path_join, path_normalize
+from hotwire.fswalk import TreeWalker
 
-from hotwire.builtin import Builtin, BuiltinRegistry, ArgSpec
+from hotwire.builtin import BuiltinRegistry, ArgSpec
 from hotwire.builtins.fileop import FileOpBuiltin
-from hotwire.sysdep.fs import Filesystem, File, FileStatError
+from hotwire.sysdep.fs import Filesystem, File
 
 _logger = logging.getLogger("hotwire.builtins.Walk")
 
 class WalkBuiltin(FileOpBuiltin):
-    __doc__ = _("""Recursively traverse directory tree.""")
+    __doc__ = _("""Recursively traverse directory tree, optionally to at most depth levels.""")
     def __init__(self):
         super(WalkBuiltin, self).__init__('walk',
                                           output=File,
-                                          argspec=(ArgSpec('directory', opt=True),),
-                                          options=[['-a', '--all']])
+                                          argspec=(ArgSpec('directory', opt=True), ArgSpec('depth', opt=True)),
+                                          options=[['-a', '--all'], ['-g', '--gitignore']])
 
     def execute(self, context, args, options=[]):
         fs = Filesystem.getInstance()
-        if len(args) == 1:
-            path = path_join(context.cwd, args[0])
+        if len(args) >= 1:
+            path = path_normalize(path_join(context.cwd, args[0]))
         else:
             path = context.cwd
-        if '-a' not in options:
-            ignorecheck = True
+        if len(args) == 2:
+            try:
+                max_depth = int(args[1])
+            except ValueError, e:
+                raise ValueError(_("Invalid depth: %s") % (args[1],))
         else:
-            ignorecheck = False 
-        for (dirpath, subdirs, fnames) in os.walk(path):
-            filtered_dirs = []
-            if ignorecheck:
-                for i,dpath in enumerate(subdirs):
-                    try:
-                        dstat = fs.get_file_sync(dpath)
-                        if dstat.hidden:
-                            filtered_dirs.append(i)
-                    except FileStatError, e:
-                        continue
-                for c,i in enumerate(filtered_dirs):
-                    del subdirs[i-c]
-            for fname in fnames:
-                fpath = path_join(dirpath, fname)                
-                fobj = fs.get_file_sync(fpath)
-                if ignorecheck and fobj.hidden:
-                    continue
-                yield fobj
+            max_depth = None
+        walker = TreeWalker(fs, show_all=('-a' in options), max_depth=max_depth,
+                            gitignore=('-g' in options))
+        batches = walker.walk(path)
+        try:
+            for batch in batches:
+                if context.cancelled:
+                    return
+                for fobj in batch:
+                    yield fobj
+        finally:
+            batches.close()
 
 BuiltinRegistry.getInstance().register_hotwire(WalkBuiltin())
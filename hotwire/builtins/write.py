@@ -23,19 +23,41 @@ import os,sys,pickle
 
 import hotwire
 from hotwire.builtin import Builtin, BuiltinRegistry, InputStreamSchema, MultiArgSpec
-from hotwire.fs import FilePath, open_text_file
+from hotwire.fs import FilePath, open_text_file, iter_chunk_lines
 from hotwire.sysdep.fs import Filesystem
 
+def _iter_pipe_lines(pipe):
+    """Yield the lines read from pipe, and close it at the end."""
+    try:
+        for line in iter(pipe.readline, ''):
+            yield line
+    finally:
+        pipe.close()
+
 class WriteBuiltin(Builtin):
     __doc__ = _("""Save stream to files.""")
     def __init__(self):
         super(WriteBuiltin, self).__init__('write',
-                                           input=InputStreamSchema('any', optional=False),
+                                           input=InputStreamSchema('any', optional=False,
+                                                                   opt_formats=['x-unix-pipe-file-object/special',
+                                                                                'bytearray/chunked']),
                                            argspec=MultiArgSpec('paths', min=1),
                                            options=[['-a', '--append'],['-p', '--pickle'],
                                                     ['-n', '--newline']])
 
-    def execute(self, context, args, options=[]):
+    COPY_BUFSIZE = 64 * 1024
+
+    def __write_chunks(self, context, args, options, chunks):
+        open_mode = ('-a' in options) and 'ab' or 'wb'
+        streams = map(lambda x: open(FilePath(x, context.cwd), open_mode), args)
+        try:
+            for buf in chunks:
+                for stream in streams:
+                    stream.write(buf)
+        finally:
+            map(lambda x: x.close(), streams)
+
+    def execute(self, context, args, options=[], in_opt_format=None):
         open_mode = ('-a' in options) and 'a+' or 'w'
         do_pickle = '-p' in options
         with_newline = '-n' in options
@@ -43,6 +65,28 @@ class WriteBuiltin(Builtin):
             open_mode = 'wb'
         if not context.input:
             return
+        if in_opt_format == 'x-unix-pipe-file-object/special':
+            pipe = iter(context.input).next()
+            if do_pickle or with_newline:
+                context.input = _iter_pipe_lines(pipe)
+            else:
+                # Bytes from a system command; copy them in blocks, undecoded
+                fd = pipe.fileno()
+                try:
+                    self.__write_chunks(context, args, options,
+                                        iter(lambda: os.read(fd, self.COPY_BUFSIZE), ''))
+                finally:
+                    pipe.close()
+                # Wait for the command to exit, rather than stopping it
+                for obj in context.input:
+                    pass
+                return []
+        elif in_opt_format == 'bytearray/chunked':
+            if do_pickle or with_newline:
+                context.input = iter_chunk_lines(context.input)
+            else:
+                self.__write_chunks(context, args, options, context.input)
+                return []
         streams = map(lambda x: open_text_file(FilePath(x, context.cwd), open_mode), args)
         if not do_pickle:
             for arg in context.input:
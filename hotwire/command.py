@@ -26,9 +26,11 @@ from StringIO import StringIO
 import gobject
 
 import hotwire.fs
-from hotwire.fs import path_normalize, unix_basename, FilePath, open_text_file
+from hotwire.fs import path_normalize, unix_basename, FilePath, open_text_file, Globber
+from hotwire.externals.glob2 import has_magic, expand_braces
 from hotwire.sysdep.fs import Filesystem, File
-from hotwire.async import IterableQueue, MiniThreadPool
+from hotwire.async import IterableQueue, MiniThreadPool, GroupThreadPool, DeadlineTimer
+from hotwire.resultcache import ResultCache, get_validators
 from hotwire.builtin import BuiltinRegistry, Builtin, ArgSpec, MultiArgSpec
 import hotwire.util
 from hotwire.util import quote_arg, assert_strings_equal, class_is_assignable
@@ -39,6 +41,18 @@ from hotwire.externals.dispatch import dispatcher
 
 _logger = logging.getLogger("hotwire.Command")
 
+def _glob_base(pattern):
+    """Return the leading directories of a glob pattern which have no magic."""
+    parts = pattern.split('/')
+    base = []
+    for part in parts[:-1]:
+        if has_magic(part) or expand_braces(part) != [part]:
+            break
+        base.append(part)
+    if base == ['']:
+        return '/'
+    return '/'.join(base)
+
 class PipelineTypeData(object):
     """Represents a snapshot of metadata from a pipeline execution."""
     type = property(lambda self: self._type)
@@ -49,6 +63,40 @@ class PipelineTypeData(object):
         self._type = pipeline.get_output_type()
         self._single = pipeline.is_singlevalue
 
+class CommandProfile(object):
+    """A snapshot of execution statistics for one Command in a pipeline.
+    Times are in seconds; busy_time is the wall time not spent blocked
+    on the input or output queue, and first_output_time is the time until
+    the first object was produced, or None if there was none yet."""
+    __slots__ = ['stage', 'name', 'executor', 'complete', 'wall_time', 'busy_time',
+                 'input_wait_time', 'output_wait_time', 'objects_in', 'objects_out',
+                 'peak_queue_depth', 'first_output_time']
+    def __init__(self, stage, name, executor, complete, wall_time, input_wait_time,
+                 output_wait_time, objects_in, objects_out, peak_queue_depth,
+                 first_output_time=None):
+        super(CommandProfile, self).__init__()
+        self.stage = stage
+        self.name = name
+        self.executor = executor
+        self.complete = complete
+        self.wall_time = wall_time
+        self.busy_time = max(wall_time - input_wait_time - output_wait_time, 0)
+        self.input_wait_time = input_wait_time
+        self.output_wait_time = output_wait_time
+        self.objects_in = objects_in
+        self.objects_out = objects_out
+        self.peak_queue_depth = peak_queue_depth
+        self.first_output_time = first_output_time
+
+    def __str__(self):
+        if self.first_output_time is None:
+            first = '-'
+        else:
+            first = '%.2fs' % (self.first_output_time,)
+        return '%s: %.2fs (busy %.2fs, in-wait %.2fs, out-wait %.2fs, first %s), %d in, %d out, peak %d' \
+            % (self.name, self.wall_time, self.busy_time, self.input_wait_time,
+               self.output_wait_time, first, self.objects_in, self.objects_out, self.peak_queue_depth)
+
 class HotwireContext(gobject.GObject):
     __gsignals__ = {
         "cwd" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_STRING,)),
@@ -90,6 +138,9 @@ class HotwireContext(gobject.GObject):
     
     def get_current_output_ref(self):
         raise NotImplementedError()
+
+    def get_output_pipeline(self, ref):
+        raise NotImplementedError()
     
     def snapshot_output(self, ref):
         raise NotImplementedError()
@@ -105,6 +156,8 @@ class CommandContext(object):
         self.input = None
         self.input_type = None
         self.input_is_first = False
+        # Unset when whatever reads our output puts it in its own order
+        self.output_ordered = True
         self.pipeline = None
         self.cwd = hotwire.get_cwd()
         self.gtk_event_time = hotwire.get_gtk_event_time()
@@ -124,6 +177,8 @@ class CommandContext(object):
         self.attribs = {}
         self.options = []
         self.cancelled = False
+        # Set with cancelled when the cancellation is because no more output is needed
+        self.stopped = False
         
     def snapshot_current_output(self, selected=False):
         if self.current_output_ref is None:
@@ -163,41 +218,125 @@ class CommandContext(object):
             self.__metadata_handler(metatype, flags, value)
 
 class CommandQueue(IterableQueue):
+    # Default maximum number of objects held back by a producer before a transfer
+    DEFAULT_BATCH_SIZE = 256
+    # Maximum number of seconds an object is held back by a producer
+    BATCH_TIMEOUT = 0.05
+    # Default number of queued objects at which a threaded producer blocks
+    DEFAULT_HIGH_WATER = 8192
+    
     def __init__(self):
         IterableQueue.__init__(self)
         self.opt_type = None
+        self.batch_size = 0
+        self.__cancel_hook = None
 
-    def negotiate(self, out_fmts, in_fmts):
+    def negotiate(self, out_fmts, in_fmts, batch_size=0):
         _logger.debug("negotiating stream; out_fmts: %s in_fmts: %s", out_fmts, in_fmts)
         for fmt in out_fmts:
             if fmt in in_fmts:
                 self.opt_type = fmt
                 _logger.debug("negotiated optimized type %s", fmt)
                 break
+        # Optimized formats do their own framing; only plain object streams are batched.
+        if self.opt_type is None and batch_size > 1:
+            self.batch_size = batch_size
+            _logger.debug("negotiated batch size %d", batch_size)
             
-    def cancel(self):
+    def set_cancel_hook(self, hook):
+        """Set a function to be invoked as hook(stopped) when the queue is cancelled;
+        the producing Command uses this to stop when its consumer goes away."""
+        self.__cancel_hook = hook
+
+    def cancel(self, stopped=False):
+        self.discard()
         self.put(None)
+        if self.__cancel_hook is not None:
+            self.__cancel_hook(stopped)
+
+    def close(self):
+        """Called by the consumer when it is done reading.  If the stream was not
+        read to its end, the producer is stopped.  A consumer which took over a
+        pipe instead never reads the end of the stream; the producer finds out
+        it is gone by the pipe closing, as in a normal shell."""
+        if not self.drained and self.opt_type != 'x-unix-pipe-file-object/special':
+            self.cancel(stopped=True)
         
 class CommandFileQueue(object):
-    """Implements command queue protocol, yielding lines from a file."""
-    def __init__(self, f):
+    """Implements command queue protocol, yielding lines from a file.  For
+    fmt 'bytearray/chunked' the file is read as blocks of bytes instead; for
+    'x-unix-pipe-file-object/special' the file object itself is the only item,
+    and the reader takes ownership of it."""
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, f, fmt=None):
         self.__f = f
+        self.__fmt = fmt
         
-    def negotiate(self, out_fmts, in_fmts):
+    def negotiate(self, out_fmts, in_fmts, batch_size=0):
         pass
         
     def __iter__(self):
-        for line in self.__f:
-            yield line
+        if self.__fmt == 'x-unix-pipe-file-object/special':
+            yield self.__f
+            return
+        elif self.__fmt == 'bytearray/chunked':
+            buf = self.__f.read(self.CHUNK_SIZE)
+            while buf:
+                yield buf
+                buf = self.__f.read(self.CHUNK_SIZE)
+        else:
+            for line in self.__f:
+                yield line
         self.__f.close()
         self.__f = None
         
-    def cancel(self):
+    def cancel(self, stopped=False):
         if self.__f is None:
             return
         self.__f.close()
         self.__f = None
 
+class FusedCommandInput(object):
+    """Implements command queue protocol, running the builtin of an upstream
+    Command in the consumer's thread and yielding its objects directly."""
+    opt_type = None
+
+    def __init__(self, command):
+        self.__command = command
+        self.__results = None
+        # For compatibility with IterableQueue statistics
+        self.get_total = 0
+        self.get_wait_time = 0
+
+    def negotiate(self, out_fmts, in_fmts, batch_size=0):
+        pass
+
+    def set_block_hook(self, hook):
+        # We only block when the fused command does
+        if self.__command.input is not None:
+            self.__command.input.set_block_hook(hook)
+
+    def __iter__(self):
+        self.__results = self.__command.run_fused()
+        for obj in self.__results:
+            self.get_total += 1
+            yield obj
+
+    def close(self):
+        """Finish the upstream command; called when the consumer is done."""
+        # Does nothing if the command already ran to completion
+        self.__command.cancel(stopped=True)
+        if self.__results is None:
+            # The consumer never read its input; don't leave the command pending.
+            self.__results = self.__command.run_fused()
+            for obj in self.__results:
+                pass
+        self.__results.close()
+
+    def cancel(self, stopped=False):
+        self.__command.cancel(stopped=stopped)
+
 class CommandAuxStream(object):
     def __init__(self, command, schema):
         self.command = command
@@ -208,6 +347,28 @@ class CommandAuxStream(object):
 class CommandException(Exception):
     pass
 
+class ExpandedArguments(object):
+    """Lazily expanded command arguments, passed to builtins with stream_args.
+It is true if there is at least one argument."""
+    def __init__(self, args):
+        super(ExpandedArguments, self).__init__()
+        self.__args = iter(args)
+        self.__peeked = []
+
+    def __nonzero__(self):
+        if not self.__peeked:
+            try:
+                self.__peeked.append(self.__args.next())
+            except StopIteration, e:
+                return False
+        return True
+
+    def __iter__(self):
+        while self.__peeked:
+            yield self.__peeked.pop(0)
+        for arg in self.__args:
+            yield arg
+
 class CommandArgument(unicode):
     """An argument for a command, with the additional metadata of quotation status."""
     def __new__(cls, value, quoted=False):
@@ -222,6 +383,7 @@ class Command(gobject.GObject):
         "complete" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, []),                    
         "metadata" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, gobject.TYPE_STRING, gobject.TYPE_PYOBJECT)),
         "exception" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        "first-output" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
     }
 
     def __init__(self, builtin, args, options, hotwire, tokens=None, in_redir=None, out_redir=None, 
@@ -236,6 +398,7 @@ class Command(gobject.GObject):
             self.context.set_metadata_handler(lambda *args: self.emit("metadata", *args))
         self.input = None
         self.output = CommandQueue()
+        self.output.set_cancel_hook(self.__on_output_cancelled)
         self.map_fn = lambda x: x
         self.args = args
         self.context.options = options
@@ -243,10 +406,28 @@ class Command(gobject.GObject):
         self.out_redir = out_redir and FilePath(os.path.expanduser(out_redir), self.context.cwd)
         self.out_append = out_append
         
+        self.threaded = builtin.threaded
         self.__thread = None
         self.__executing_sync = None
+        self.__executor = None
+        self.__fused_upstream = None
+        self.__fused = False
         self._cancelled = False
         self.__tokens = tokens
+        # Output held back for batching; guarded by __output_lock, since it is
+        # also flushed from the DeadlineTimer thread
+        self.__output_lock = threading.Lock()
+        self.__pending_output = []
+        self.__pending_output_time = 0
+        self.__flush_timer_set = False
+        self.__start_time = None
+        self.__end_time = None
+        self.__first_output_time = None
+        # Objects output other than through our queue; redirected or fused
+        self.__unqueued_count = 0
+        self.__expanded_args = None
+        self.__recorded = None
+        self.__dependencies = None
 
     def set_pipeline(self, pipeline):
         self.context.set_pipeline(pipeline)
@@ -255,6 +436,26 @@ class Command(gobject.GObject):
         self.input = input       
         self.context.input = self.input
         self.context.input_is_first = is_first
+
+    def fuse_input(self, upstream):
+        """Run the builtin of upstream, the previous command, in our thread,
+        iterating over its results directly rather than through a queue."""
+        self.__fused_upstream = upstream
+        upstream.__fused = True
+        self.input = FusedCommandInput(upstream)
+        self.context.input = self.input
+        # The fused chain needs a thread if its first command does
+        self.threaded = upstream.threaded
+
+    def get_fused(self):
+        """Return True if this command runs fused into its consumer."""
+        return self.__fused
+
+    def __set_fused(self, executing_sync):
+        self.__executing_sync = executing_sync
+        self.__executor = 'fused'
+        if self.__fused_upstream is not None:
+            self.__fused_upstream.__set_fused(executing_sync)
         
     def set_input_type(self, in_type):
         """Note the pipeline object type used for input."""
@@ -263,13 +464,19 @@ class Command(gobject.GObject):
     def disconnect(self):
         self.context = None
         
-    def cancel(self):
-        if self._cancelled:
+    def cancel(self, stopped=False):
+        """Stop execution.  If stopped is True, this is because no more output
+        is wanted, rather than a cancellation by the user.  Commands providing
+        our input are stopped as well."""
+        if self._cancelled or self.__end_time is not None:
             return
         self._cancelled = True
         self.context.cancelled = True
+        self.context.stopped = stopped
         if self.context.input:
-            self.context.input.cancel()
+            self.context.input.cancel(stopped=stopped)
+        # Wake up our thread if it is blocked on a full output queue
+        self.output.discard()
         self.builtin.cancel(self.context)
 
     def get_input_opt_formats(self):
@@ -278,22 +485,88 @@ class Command(gobject.GObject):
     def get_output_opt_formats(self):
         return self.builtin.output_opt_formats
 
-    def execute(self, force_sync, **kwargs):
-        if force_sync or not self.builtin.threaded:
+    def get_output_display_opt_formats(self):
+        return self.builtin.output_display_opt_formats
+
+    def set_output_high_water(self, high_water, force_sync):
+        """Bound the output queue; only done when we run in our own thread,
+        since otherwise nothing could drain it while we block."""
+        if force_sync or not self.threaded:
+            return
+        self.output.high_water = high_water
+
+    def get_output_wait_time(self):
+        """Return the number of seconds spent blocked on a full output queue."""
+        return self.output.put_wait_time
+
+    def get_output_batch_size(self, batch_size):
+        """Return the batch size this command may use for its output, given
+        the size requested for the pipeline."""
+        if self.out_redir or not self.builtin.output_batched:
+            return 0
+        return batch_size
+
+    def execute(self, force_sync, group=None, **kwargs):
+        """Run the command.  If force_sync is set or the command is not threaded,
+        it runs in the calling thread.  Otherwise, if group is a list, the function
+        to run is appended to it for submission to a GroupThreadPool; if not, it
+        runs in a new thread.  Commands fused into this one run in the same way."""
+        if self.__fused_upstream is not None:
+            self.__fused_upstream.__set_fused(force_sync or not self.threaded)
+        if force_sync or not self.threaded:
             _logger.debug("executing sync: %s", self)
             self.__executing_sync = True
+            self.__executor = 'sync'
             self.__run(**kwargs)
+        elif group is not None:
+            _logger.debug("executing pooled: %s", self)
+            self.__executing_sync = False
+            self.__executor = 'pool'
+            group.append(self.__run)
         else:         
             _logger.debug("executing async: %s", self)              
             self.__executing_sync = False             
+            self.__executor = 'thread'
             self.__thread = threading.Thread(target=self.__run)
             self.__thread.setDaemon(True)            
             self.__thread.start()
 
+    def get_executor(self):
+        """Return how the command was run: 'sync', 'thread', 'pool', or 'fused'
+        if it ran in the thread of its consumer."""
+        return self.__executor
+
+    def get_profile(self, stage=0):
+        """Return a CommandProfile with statistics for this command so far;
+        stage is its index in the pipeline."""
+        if self.__start_time is None:
+            wall_time = 0
+        else:
+            wall_time = (self.__end_time or time.time()) - self.__start_time
+        input_wait_time = getattr(self.input, 'get_wait_time', 0)
+        objects_in = getattr(self.input, 'get_total', 0)
+        if self.__first_output_time is None:
+            first_output_time = None
+        else:
+            first_output_time = self.__first_output_time - self.__start_time
+        return CommandProfile(stage, self.builtin.name, self.__executor,
+                              self.__end_time is not None, wall_time,
+                              input_wait_time, self.output.put_wait_time,
+                              objects_in, self.output.put_total + self.__unqueued_count,
+                              self.output.peak_count, first_output_time)
+
+    def __note_first_output(self):
+        self.__first_output_time = time.time()
+        self.emit("first-output", self.__first_output_time - self.__start_time)
+
     def set_output_queue(self, queue, map_fn):
         self.output = queue
+        self.output.set_cancel_hook(self.__on_output_cancelled)
         self.map_fn = map_fn
 
+    def __on_output_cancelled(self, stopped):
+        self.cancel(stopped=stopped)
+
     def get_auxstreams(self):
         for obj in self.context.get_auxstreams():
             yield obj
@@ -301,70 +574,276 @@ class Command(gobject.GObject):
     def get_tokens(self):
         return self.__tokens
 
+    def record_output(self):
+        """Keep a copy of the objects we output, up to ResultCache.MAX_OBJECTS."""
+        self.__recorded = []
+
+    def get_recorded_output(self):
+        """Return the list of objects output since record_output(), or None if
+        there were too many."""
+        return self.__recorded
+
+    def __record(self, obj):
+        if len(self.__recorded) >= ResultCache.MAX_OBJECTS:
+            self.__recorded = None
+        else:
+            self.__recorded.append(obj)
+
+    def record_dependencies(self):
+        """Note the files found while running which our output may depend on:
+        those matched by glob arguments and those we output as File objects."""
+        self.__dependencies = []
+
+    def get_recorded_dependencies(self):
+        """Return the paths noted since record_dependencies(), or None if there
+        were too many."""
+        return self.__dependencies
+
+    def __add_dependency(self, path):
+        if len(self.__dependencies) >= ResultCache.MAX_OBJECTS:
+            self.__dependencies = None
+        else:
+            self.__dependencies.append(path)
+
+    def get_cache_dependencies(self):
+        """Return the paths whose state our output may depend on, if the builtin
+        is cacheable: the working directory and the arguments.  For a glob
+        pattern, this is the directory it is matched from; expanding it is left
+        to the command's own thread, which records what it matched."""
+        paths = [self.context.cwd]
+        for arg in self.args:
+            if not (isinstance(arg, CommandArgument) and arg.isquoted):
+                arg = os.path.expanduser(arg)
+                if has_magic(arg) or expand_braces(arg) != [arg]:
+                    base = _glob_base(arg)
+                    if base:
+                        paths.append(FilePath(base, self.context.cwd))
+                    continue
+            paths.append(FilePath(arg, self.context.cwd))
+        return paths
+
+    def __put_output(self, obj):
+        if self.__recorded is not None:
+            self.__record(obj)
+        if self.__dependencies is not None and isinstance(obj, File):
+            self.__add_dependency(obj.path)
+        batch_size = self.output.batch_size
+        if not batch_size:
+            self.output.put(obj)
+            return
+        self.__output_lock.acquire()
+        try:
+            pending = self.__pending_output
+            if not pending:
+                self.__pending_output_time = time.time()
+                if not self.__flush_timer_set:
+                    # Deliver the batch on time even if we stall before the next object
+                    self.__flush_timer_set = True
+                    DeadlineTimer.getInstance().call_at(self.__pending_output_time + CommandQueue.BATCH_TIMEOUT,
+                                                        self.__on_flush_timer)
+            pending.append(obj)
+            if len(pending) >= batch_size \
+                   or (time.time() - self.__pending_output_time) >= CommandQueue.BATCH_TIMEOUT:
+                self.__do_flush_output()
+        finally:
+            self.__output_lock.release()
+
+    def __flush_output(self):
+        self.__output_lock.acquire()
+        try:
+            self.__do_flush_output()
+        finally:
+            self.__output_lock.release()
+
+    def __do_flush_output(self):
+        if not self.__pending_output:
+            return
+        pending = self.__pending_output
+        self.__pending_output = []
+        self.output.put_batch(pending)
+
+    def __on_flush_timer(self):
+        # Don't wait on a producer which is putting, possibly blocked on a full queue
+        if not self.__output_lock.acquire(False):
+            DeadlineTimer.getInstance().call_at(time.time() + CommandQueue.BATCH_TIMEOUT, self.__on_flush_timer)
+            return
+        try:
+            if not self.__pending_output:
+                self.__flush_timer_set = False
+                return
+            now = time.time()
+            deadline = self.__pending_output_time + CommandQueue.BATCH_TIMEOUT
+            queue = self.output
+            if now < deadline:
+                # An earlier batch was flushed; this is a newer one
+                DeadlineTimer.getInstance().call_at(deadline, self.__on_flush_timer)
+            elif queue.high_water > 0 and queue.get_count() >= queue.high_water:
+                # The consumer has plenty to read, and putting would block
+                DeadlineTimer.getInstance().call_at(now + CommandQueue.BATCH_TIMEOUT, self.__on_flush_timer)
+            else:
+                self.__flush_timer_set = False
+                self.__do_flush_output()
+        finally:
+            self.__output_lock.release()
+
+    def __iter_args(self):
+        """Yield our arguments, expanding globs as they are reached."""
+        if self.__expanded_args is not None:
+            for arg in self.__expanded_args:
+                yield arg
+            return
+        # Share directory listings between all the arguments
+        globber = Globber()
+        for globarg_in in self.args:
+            if isinstance(globarg_in, CommandArgument) and globarg_in.isquoted:
+                yield globarg_in
+                continue
+            globarg = os.path.expanduser(globarg_in)
+            matched = False
+            for result in hotwire.fs.dirglob(self.context.cwd, globarg, globber=globber):
+                matched = True
+                if self.__dependencies is not None:
+                    self.__add_dependency(FilePath(result, self.context.cwd))
+                yield result
+            if not matched:
+                yield globarg
+
+    def __expand_args(self):
+        if self.__expanded_args is None:
+            self.__expanded_args = list(self.__iter_args())
+            _logger.debug("expanded args: %s", self.__expanded_args)
+        return self.__expanded_args
+
+    def __prepare_execute(self):
+        """Expand arguments and open any input redirection; returns the
+        arguments and keyword arguments for the builtin."""
+        if self.builtin.stream_args:
+            target_args = [ExpandedArguments(self.__iter_args())]
+        else:
+            target_args = [self.__expand_args()]
+        _logger.info("Execute '%s' args: %s options: %s", self.builtin, target_args, self.context.options)
+        kwargs = {}
+        if self.context.options and not self.builtin.flattened_args:
+            kwargs['options'] = self.context.options
+        if self.input is not None and self.input.opt_type and not self.in_redir:
+            kwargs['in_opt_format'] = self.input.opt_type                
+        if self.output.opt_type and not self.out_redir:
+            kwargs['out_opt_format'] = self.output.opt_type
+        if self.in_redir:
+            _logger.debug("input redirected, opening %s", self.in_redir)
+            in_fmts = self.get_input_opt_formats() or []
+            for fmt in ('x-unix-pipe-file-object/special', 'bytearray/chunked'):
+                if fmt in in_fmts:
+                    # Give the builtin the bytes, without decoding them
+                    self.context.input = CommandFileQueue(open(self.in_redir, 'rb'), fmt=fmt)
+                    kwargs['in_opt_format'] = fmt
+                    break
+            else:
+                self.context.input = CommandFileQueue(open_text_file(self.in_redir, 'r'))
+        if self.out_redir and 'x-unix-file-target/special' in self.get_output_opt_formats():
+            _logger.debug("output redirected, passing %s to builtin", self.out_redir)
+            kwargs['out_opt_format'] = 'x-unix-file-target/special'
+            kwargs['out_target'] = open(self.out_redir, self.out_append and 'ab' or 'wb')
+        if self.builtin.flattened_args and not self.builtin.stream_args:
+            target_args = target_args[0]
+        return (target_args, kwargs)
+
+    def run_fused(self):
+        """Run the builtin in the calling thread, yielding its results; used by
+        FusedCommandInput.  Exceptions are reported as ours, then propagated."""
+        self.__start_time = time.time()
+        try:
+            if self._cancelled:
+                _logger.debug("%s cancelled, returning", self)
+                return
+            (target_args, kwargs) = self.__prepare_execute()
+            try:
+                execresult = self.builtin.execfunc(self.context, *target_args, **kwargs)
+                if self.builtin.singlevalue:
+                    execresult = [execresult]
+                for result in execresult:
+                    if self._cancelled and not self.builtin.hasstatus:
+                        _logger.debug("%s cancelled, returning", self)
+                        return
+                    if self.__first_output_time is None:
+                        self.__note_first_output()
+                    self.__unqueued_count += 1
+                    if self.__dependencies is not None and isinstance(result, File):
+                        self.__add_dependency(result.path)
+                    yield result
+            finally:
+                if self.__fused_upstream is not None:
+                    self.input.close()
+                self.builtin.cleanup(self.context)
+        except Exception, e:
+            _logger.debug("Caught exception from fused command: %s", e, exc_info=True)
+            if not self.__executing_sync:
+                self.emit("exception", e)
+            raise
+        finally:
+            self.__end_time = time.time()
+            self.emit("complete")
+
     def __run(self, *args, **kwargs):
+        self.__start_time = time.time()
         if self._cancelled:
             _logger.debug("%s cancelled, returning", self)
+            if self.input is not None:
+                self.input.close()
+            self.__end_time = time.time()
             self.output.put(self.map_fn(None))
             return
+        if self.input is not None and self.output.batch_size:
+            # Don't hold back our output while waiting for more input
+            self.input.set_block_hook(self.__flush_output)
         try:
-            matched_files = []
-            oldlen = 0
-            for globarg_in in self.args:
-                if isinstance(globarg_in, CommandArgument) and globarg_in.isquoted:
-                    globarg = globarg_in
-                    newlen = oldlen                    
-                else:
-                    globarg = os.path.expanduser(globarg_in)
-                    matched_files.extend(hotwire.fs.dirglob(self.context.cwd, globarg))
-                    _logger.debug("glob on %s matched is: %s", globarg_in, matched_files) 
-                    newlen = len(matched_files)
-                if oldlen == newlen:
-                    matched_files.append(globarg)
-                    newlen += 1
-                oldlen = newlen
-            target_args = [matched_files]
-            _logger.info("Execute '%s' args: %s options: %s", self.builtin, target_args, self.context.options)
-            kwargs = {}
-            if self.context.options and not self.builtin.flattened_args:
-                kwargs['options'] = self.context.options
-            if self.input is not None and self.input.opt_type and not self.in_redir:
-                kwargs['in_opt_format'] = self.input.opt_type                
-            if self.output.opt_type and not self.out_redir:
-                kwargs['out_opt_format'] = self.output.opt_type
-            if self.in_redir:
-                _logger.debug("input redirected, opening %s", self.in_redir)
-                self.context.input = CommandFileQueue(open_text_file(self.in_redir, 'r'))
-            if self.out_redir:
+            (target_args, kwargs) = self.__prepare_execute()
+            if self.out_redir and 'out_target' not in kwargs:
                 _logger.debug("output redirected, opening %s", self.out_redir)
                 outfile = open_text_file(self.out_redir, self.out_append and 'a+' or 'w')
             else:
                 outfile = None
             try:
                 exectarget = self.builtin.execfunc
-                if self.builtin.flattened_args:
-                    target_args = target_args[0]
                 execresult = exectarget(self.context, *target_args, **kwargs)                
                 if self.builtin.singlevalue:
+                    self.__note_first_output()
                     if outfile:
                         outfile.write(unicode(execresult))
                     else:
+                        if self.__recorded is not None:
+                            self.__record(execresult)
                         self.output.put(execresult)
                 else:
+                    map_fn = self.map_fn
                     for result in execresult:
                         # if it has status, let it do its own cleanup
                         if self._cancelled and not self.builtin.hasstatus:
                             _logger.debug("%s cancelled, returning", self)
+                            self.__output_lock.acquire()
+                            self.__pending_output = []
+                            self.__output_lock.release()
+                            self.__end_time = time.time()
                             self.output.put(self.map_fn(None))
                             self.emit("complete")                        
                             return
+                        if self.__first_output_time is None:
+                            self.__note_first_output()
                         if outfile and (result is not None):
                             result = unicode(result)
                             outfile.write(result)
+                            self.__unqueued_count += 1
                         else:                        
-                            self.output.put(self.map_fn(result))
+                            self.__put_output(map_fn(result))
             finally:
+                self.__flush_output()
                 if outfile:
                     outfile.close()
+                if 'out_target' in kwargs:
+                    kwargs['out_target'].close()
+                if self.input is not None:
+                    # Stop whatever is feeding us if we finished early
+                    self.input.close()
                 self.builtin.cleanup(self.context)
         except Exception, e:
             _logger.debug("Caught exception from command: %s", e, exc_info=True)
@@ -372,6 +851,9 @@ class Command(gobject.GObject):
                 raise
             else:
                 self.emit("exception", e)
+        if self.output.put_wait_time:
+            _logger.debug("%s blocked %.3fs on output", self, self.output.put_wait_time)
+        self.__end_time = time.time()
         self.output.put(self.map_fn(None))
         self.emit("complete")  
         
@@ -491,7 +973,8 @@ class Pipeline(gobject.GObject):
                  output_type='unknown', locality=None,
                  idempotent=False,
                  undoable=False,
-                 singlevalue=False):
+                 singlevalue=False,
+                 cacheable=False):
         super(Pipeline, self).__init__()
         self.__executing_sync = False
         self.__components = components
@@ -501,6 +984,13 @@ class Pipeline(gobject.GObject):
         self.__input_type = input_type
         self.__input_optional = input_optional
         self.__idempotent = idempotent
+        self.__cacheable = cacheable
+        self.__cache_status = None
+        # Set when the output of the last command was replaced by cached objects
+        self.__output = None
+        self.__cache_key = None
+        self.__cache_validators = None
+        self.__cache_start_time = None
         self.__undoable = undoable
         self._is_singlevalue = singlevalue
         self.__output_type = output_type
@@ -511,6 +1001,7 @@ class Pipeline(gobject.GObject):
         self.__cmd_complete_count = 0
         self.__state = 'waiting'
         self.__completion_time = None
+        self.__profile = False
         
     def get_state(self):
         return self.__state     
@@ -519,13 +1010,64 @@ class Pipeline(gobject.GObject):
         for cmd in self.__components:
             cmd.disconnect()
     
-    def __execute_internal(self, force_sync, opt_formats=[], assert_all_threaded=False):
+    def __execute_internal(self, force_sync, opt_formats=[], assert_all_threaded=False,
+                           batch_size=CommandQueue.DEFAULT_BATCH_SIZE,
+                           high_water=CommandQueue.DEFAULT_HIGH_WATER,
+                           executor='pool', profile=False, fuse=True, cache=True,
+                           ordered=True):
+        """Start the pipeline.  high_water may be a single object count applied to
+        every stage's output, or a sequence with one count per stage; 0 is unbounded.
+        executor selects how threaded stages are run: 'pool' for the shared
+        GroupThreadPool, or 'thread' for a new thread per stage.  If profile is
+        set, each command's CommandProfile is emitted as 'hotwire.profile'
+        metadata when it completes.  If fuse is set, fusible builtins run in the
+        thread of the command before them, without a queue in between.  If cache
+        is set and the pipeline is cacheable, output from ResultCache is used
+        while the pipeline runs again to refresh it.  Unset ordered if the
+        consumer sorts the output itself; the last command may then produce it
+        in whatever order is quickest.  The time until the last command
+        produces its first object is emitted as 'hotwire.first_output' metadata."""
         _logger.debug("Executing %s", self)
+        self.__profile = profile
         self.__set_state('executing')
         meta_idx = 0          
+        if not isinstance(high_water, (list, tuple)):
+            high_water = [high_water] * len(self.__components)
+        prev_opt_formats = []
+        prev_batch_size = 0
+        for cmd in self.__components:
+            if cmd.input:
+                cmd.input.negotiate(prev_opt_formats, cmd.get_input_opt_formats(), 
+                                    batch_size=prev_batch_size)
+            prev_opt_formats = cmd.get_output_opt_formats()
+            prev_batch_size = cmd.get_output_batch_size(batch_size)
+            if cmd.out_redir:
+                prev_opt_formats = []
+        last = self.__components[-1]
+        if not last.out_redir:
+            last_opt_fmts = last.get_output_display_opt_formats()
+        else:
+            last_opt_fmts = []
+        last.output.negotiate(last_opt_fmts, opt_formats, batch_size=last.get_output_batch_size(batch_size))
+        if not (ordered or last.out_redir):
+            last.context.output_ordered = False
+        last.connect("first-output", self.__on_last_first_output)
+        if self.__cacheable and not force_sync and last.output.opt_type is None \
+               and self.__components[0].input is None:
+            if cache:
+                self.__execute_cached()
+            else:
+                self.__cache_status = 'bypass'
+        if fuse and not force_sync:
+            for prev,cmd in zip(self.__components[:-1], self.__components[1:]):
+                if cmd.builtin.fusible and not (cmd.in_redir or prev.out_redir) \
+                       and prev.output.opt_type is None:
+                    _logger.debug("fusing %s into %s", prev, cmd)
+                    cmd.fuse_input(prev)
         for i,cmd in enumerate(self.__components):
             if assert_all_threaded and not cmd.builtin.threaded:
                 raise ValueError("assert_all_threaded is enabled but trying to execute non-threaded builtin %s" % (cmd.builtin,))
+            cmd.set_output_high_water(high_water[i], force_sync)
             cmd.connect("complete", self.__on_cmd_complete)
             cmd.connect("exception", self.__on_cmd_exception)            
             # Here we record which commands include metadata, and
@@ -534,22 +1076,71 @@ class Pipeline(gobject.GObject):
                 _logger.debug("connecting to metadata on cmd %s, idx=%s", cmd, meta_idx)
                 cmd.connect("metadata", self.__on_cmd_metadata, meta_idx)
                 meta_idx += 1                
-        prev_opt_formats = []
+        # Fused commands are run by their consumer
+        runnable = [cmd for cmd in self.__components if not cmd.get_fused()]
+        if force_sync or executor != 'pool':
+            for cmd in runnable:
+                cmd.execute(force_sync)
+        else:
+            # Submit all threaded stages as one group before running any synchronous
+            # ones, so a pooled stage never waits for a thread behind its consumer.
+            group = []
+            for cmd in runnable:
+                if cmd.threaded:
+                    cmd.execute(False, group=group)
+            # A synchronous stage downstream of a pooled one would block this
+            # thread until the group is started, so don't queue in that case.
+            wait = True
+            for i,cmd in enumerate(runnable):
+                if cmd.threaded:
+                    break
+            for cmd in runnable[i+1:]:
+                if not cmd.threaded:
+                    wait = False
+            GroupThreadPool.getInstance().run_group(group, wait=wait)
+            for cmd in runnable:
+                if not cmd.threaded:
+                    cmd.execute(False)
+        for i,cmd in enumerate(self.__components):
+            _logger.debug("stage %d (%s) executor: %s", i, cmd.builtin.name, cmd.get_executor())
+
+    def __execute_cached(self):
+        paths = []
         for cmd in self.__components:
-            if cmd.input:
-                cmd.input.negotiate(prev_opt_formats, cmd.get_input_opt_formats())
-            prev_opt_formats = cmd.get_output_opt_formats()
-            if cmd.out_redir:
-                prev_opt_formats = []
+            paths.extend(cmd.get_cache_dependencies())
+            cmd.record_dependencies()
+        self.__cache_key = (self.__str__(), self.__components[0].context.cwd)
+        self.__cache_start_time = time.time()
+        self.__cache_validators = get_validators(paths)
         last = self.__components[-1]
-        if not last.out_redir:
-            last_opt_fmts = last.get_output_opt_formats()
-        else:
-            last_opt_fmts = []
-        last.output.negotiate(last_opt_fmts, opt_formats)
-        for i,cmd in enumerate(self.__components[:-1]):
-            cmd.execute(force_sync)
-        last.execute(force_sync)
+        last.record_output()
+        objects = ResultCache.getInstance().lookup(self.__cache_key, self.__cache_validators)
+        if objects is None:
+            self.__cache_status = 'miss'
+            return
+        _logger.debug("using %d cached objects for %s", len(objects), self)
+        self.__cache_status = 'hit'
+        # Output the cached objects now, and send the real output to a queue
+        # which only records it to refresh the cache.
+        output = last.output
+        self.__output = output
+        revalidate_output = CommandQueue()
+        revalidate_output.discard()
+        last.set_output_queue(revalidate_output, last.map_fn)
+        output.put_batch(list(objects))
+        output.put(None)
+
+    def get_cacheable(self):
+        return self.__cacheable
+
+    def get_cache_status(self):
+        """Return None if the result cache was not used, otherwise 'hit', 'miss',
+        or 'bypass' if it was disabled for this execution."""
+        return self.__cache_status
+
+    def get_stage_executors(self):
+        """Return a list of the executor which ran each command; see Command.get_executor()."""
+        return [cmd.get_executor() for cmd in self.__components]
         
     def validate_state_transition(self, state):
         if self.__state == 'waiting':
@@ -602,6 +1193,17 @@ class Pipeline(gobject.GObject):
     def get_idempotent(self):
         return self.__idempotent
 
+    def get_output_wait_times(self):
+        """Return a list with the seconds each command spent blocked on output."""
+        return [cmd.get_output_wait_time() for cmd in self.__components]
+
+    def get_profiling(self):
+        return self.__profile
+
+    def get_profile(self):
+        """Return a list of CommandProfile, one per command."""
+        return [cmd.get_profile(i) for i,cmd in enumerate(self.__components)]
+
     def get_status_commands(self):
         for cmd in self.__components:
             if cmd.builtin.hasstatus:
@@ -614,6 +1216,9 @@ class Pipeline(gobject.GObject):
         self.__cmd_metadata[(cmd, cmdidx, key)] = (flags, meta)
         self.__cmd_metadata_lock.release()
 
+    def __on_last_first_output(self, cmd, elapsed):
+        self.__on_cmd_metadata(cmd, 'hotwire.first_output', 0, elapsed, len(self.__components)-1)
+
     def __idle_emit_cmd_metadata(self):
         _logger.debug("signalling command metadata")      
         self.__cmd_metadata_lock.acquire()
@@ -626,6 +1231,31 @@ class Pipeline(gobject.GObject):
 
     def __on_cmd_complete(self, cmd):
         _logger.debug("command complete: %s", cmd)
+        if self.__profile:
+            idx = self.__components.index(cmd)
+            self.__on_cmd_metadata(cmd, 'hotwire.profile', 0, cmd.get_profile(idx), idx)
+        if cmd is self.__components[-1] and self.__cache_key is not None \
+               and self.__state == 'executing' and not cmd._cancelled:
+            objects = cmd.get_recorded_output()
+            dependencies = set()
+            for component in self.__components:
+                paths = component.get_recorded_dependencies()
+                if paths is None:
+                    objects = None
+                    break
+                dependencies.update(paths)
+            if objects is not None:
+                dependencies = get_validators(sorted(dependencies))
+                # The dependencies are statted now, after the run; one changed
+                # since it started may have been read before the change
+                for (path, mtime, size) in dependencies:
+                    if mtime is not None and mtime >= self.__cache_start_time:
+                        _logger.debug("not caching %s, %r changed while it ran", self, path)
+                        objects = None
+                        break
+            if objects is not None:
+                ResultCache.getInstance().store(self.__cache_key, self.__cache_validators, objects,
+                                                dependencies)
         if cmd.get_executing_sync():
             self.__idle_handle_cmd_complete(cmd)
         else:  
@@ -652,6 +1282,8 @@ class Pipeline(gobject.GObject):
         return self.__exception_info
 
     def get_output(self):
+        if self.__output is not None:
+            return self.__output
         return self.__components[-1].output
 
     def get_input_type(self):
@@ -740,11 +1372,15 @@ Otherwise, return arg."""
         return (countstream, parser)
 
     @staticmethod
-    def tokenize(text, context=None, assertfn=None, accept_partial=False, internal=False):
+    def tokenize(text, context=None, assertfn=None, accept_partial=False, internal=False,
+                 offset=0, curpos=None, checkpoints=None):
+        """Generate the tokens of text, starting from character offset.  If
+checkpoints is given, a (token count, offset, curpos) tuple is appended to it
+for each point at which the lexer could be restarted with the same result."""
         result = []
         _logger.debug("parsing '%s'", text)
         
-        (countstream, parser) = Pipeline.mkparser(text)
+        (countstream, parser) = Pipeline.mkparser(text[offset:])
         
         def mktoken(text, *args, **kwargs):
             if internal:
@@ -753,7 +1389,9 @@ Otherwise, return arg."""
         
         is_initial = True
         first_token = None
-        curpos = 0
+        if curpos is None:
+            curpos = offset
+        count = 0
         while True:
             try:
                 (token, quoted) = parser.get_token_info()
@@ -778,7 +1416,7 @@ Otherwise, return arg."""
             if token is None:
                 break 
             is_initial = False
-            end = countstream.get_count()
+            end = offset + countstream.get_count()
             if not quoted and token in ('|', '<', '>', '>>'):
                 if token == '|':
                     yield hotwire.script.PIPE
@@ -793,6 +1431,11 @@ Otherwise, return arg."""
                     end = curpos+len(token)
                 yield mktoken(token, curpos, end=end, quoted=quoted)
             curpos = end
+            count += 1
+            # Between tokens with nothing pushed back, the lexer has read
+            # exactly the text up to here and holds no other state.
+            if checkpoints is not None and parser.state == ' ' and not parser.pushback:
+                checkpoints.append((count, offset + countstream.get_count(), curpos))
         
     @staticmethod
     def create(context, resolver, *tokens, **kwargs):
@@ -802,6 +1445,7 @@ Otherwise, return arg."""
         components = []
         undoable = None
         idempotent = True
+        cacheable = True
         prev = None
         pipeline_input_type = 'unknown'
         pipeline_input_optional = 'unknown'
@@ -988,6 +1632,8 @@ Otherwise, return arg."""
 
             if not cmd.builtin.idempotent:
                 idempotent = False
+            if not cmd.builtin.cacheable or in_redir or out_redir:
+                cacheable = False
                 
         if len(components) == 0:
             raise PipelineParseException(_("Empty pipeline"))
@@ -1001,7 +1647,8 @@ Otherwise, return arg."""
                             locality=prev_locality,
                             undoable=undoable,
                             idempotent=idempotent,
-                            singlevalue=pipeline_singlevalue)
+                            singlevalue=pipeline_singlevalue,
+                            cacheable=cacheable)
         _logger.debug("Parsed pipeline %s (%d components, input %s, output %s)",
                       pipeline, len(components),
                       pipeline.get_input_type(),
@@ -1009,8 +1656,11 @@ Otherwise, return arg."""
         return pipeline 
 
     @staticmethod
-    def parse(text, context=None, resolver=None, accept_partial=False):
-        tokens = list(Pipeline.tokenize(text, context, accept_partial=accept_partial))
+    def parse(text, context=None, resolver=None, accept_partial=False, tokenizer=None):
+        if tokenizer is not None:
+            tokens = tokenizer.tokenize(text, accept_partial=accept_partial)
+        else:
+            tokens = list(Pipeline.tokenize(text, context, accept_partial=accept_partial))
         return Pipeline.create(context, resolver, accept_partial=accept_partial, *tokens)
     
     def __iter__(self):
@@ -1137,11 +1787,52 @@ class PerlLanguage(PipelineLanguage):
                                            "pl", "pl", "Perl", 'perl.ico', interpreter_exec='perl', exec_args=['-e'])
 PipelineLanguageRegistry.getInstance().register(PerlLanguage())                
 
+class IncrementalTokenizer(object):
+    """Tokenizes successive edits of the same command text.  Tokens before
+the first changed character are reused, and lexing resumes from there."""
+    def __init__(self):
+        super(IncrementalTokenizer, self).__init__()
+        self.__text = u''
+        self.__tokens = []
+        self.__checkpoints = []
+        # Number of characters lexed by the last call, for testing
+        self.lexed = 0
+
+    def tokenize(self, text, accept_partial=False):
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        prefixlen = 0
+        maxlen = min(len(text), len(self.__text))
+        while prefixlen < maxlen and text[prefixlen] == self.__text[prefixlen]:
+            prefixlen += 1
+        checkpoints = self.__checkpoints
+        while checkpoints and checkpoints[-1][1] > prefixlen:
+            checkpoints.pop()
+        if checkpoints:
+            (count, offset, curpos) = checkpoints[-1]
+        else:
+            (count, offset, curpos) = (0, 0, 0)
+        tokens = self.__tokens[:count]
+        # Drop our state first, so an exception leaves it consistent
+        self.__text = text[:offset]
+        self.__tokens = list(tokens)
+        newcheckpoints = []
+        for token in Pipeline.tokenize(text, accept_partial=accept_partial, offset=offset,
+                                       curpos=curpos, checkpoints=newcheckpoints):
+            tokens.append(token)
+        self.lexed = len(text) - offset
+        for (subcount, suboffset, subcurpos) in newcheckpoints:
+            checkpoints.append((count + subcount, suboffset, subcurpos))
+        self.__text = text
+        self.__tokens = tokens
+        return list(tokens)
+
 class PipelineFactory(object):
     def __init__(self, context, resolver=None):
         super(PipelineFactory, self).__init__()
         self.__context = context
         self.__resolver = resolver
+        self.__tokenizer = IncrementalTokenizer()
         
     def __make_lang_pipeline(self, lang, ispiped, resolve, cmdtext):
         if ispiped:
@@ -1188,4 +1879,5 @@ class PipelineFactory(object):
         # Try parsing as HotwirePipe
         if ispiped:
             text = 'current | ' + text
-        return Pipeline.parse(text, context=self.__context, resolver=(resolve and self.__resolver or None), **kwargs)
+        return Pipeline.parse(text, context=self.__context, resolver=(resolve and self.__resolver or None),
+                              tokenizer=self.__tokenizer, **kwargs)
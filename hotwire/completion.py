@@ -29,7 +29,8 @@ from hotwire.builtin import BuiltinRegistry
 from hotwire.cmdalias import Alias, AliasRegistry
 from hotwire.async import MiniThreadPool
 from hotwire.fs import FilePath,iterd,iterd_sorted,path_normalize,path_expanduser,unix_basename
-from hotwire.sysdep.fs import Filesystem
+from hotwire.sysdep.fs import Filesystem, FileStatError
+from hotwire.fileindex import FileIndex, TYPE_DIRECTORY, glob_escape
 from hotwire.externals.singletonmixin import Singleton
 from hotwire.util import quote_arg, tracefn
 from hotwire.logutil import log_except
@@ -85,12 +86,38 @@ def _mkfile_completion(text, fpath, fileobj=None):
     return Completion(suffix, fobj, fname)     
 
 class PathCompleter(Completer):
+    # Most matches looked up for a ** path
+    DEEP_LIMIT = 200
+
     def __init__(self):
         super(PathCompleter, self).__init__()
 
+    def __deep_completions(self, base, prefix):
+        # Complete the name after a ** component from the file index, if it
+        # covers the directory; the glob then expands to the files found
+        index = FileIndex.getInstance()
+        if index.get_root(base) is None:
+            return
+        fs = Filesystem.getInstance()
+        for entry in index.search(base, names=[glob_escape(prefix) + u'*'], hidden=prefix.startswith('.'),
+                                  limit=self.DEEP_LIMIT):
+            try:
+                fobj = fs.get_file_sync(entry.path)
+            except FileStatError, e:
+                continue
+            suffix = quote_arg(unix_basename(entry.path)[len(prefix):])
+            if entry.type == TYPE_DIRECTORY:
+                suffix += '/'
+            yield Completion(suffix, fobj, entry.path[len(base.rstrip('/'))+1:])
+
     def completions(self, text, cwd):
         expanded = path_expanduser(text)        
         fullpath = FilePath(expanded, cwd)
+        (src_dpath, src_prefix) = os.path.split(fullpath)
+        if unix_basename(src_dpath) == '**':
+            for completion in self.__deep_completions(os.path.dirname(src_dpath), src_prefix):
+                yield completion
+            return
         try:
             isdir = stat.S_ISDIR(os.stat(fullpath).st_mode)
         except OSError, e:
@@ -100,7 +127,6 @@ class PathCompleter(Completer):
             for fpath in iterd_sorted(fullpath, fpath=True):
                 yield _mkfile_completion(text, fpath)
             return
-        (src_dpath, src_prefix) = os.path.split(fullpath)
         try:
             for fpath in iterd_sorted(src_dpath, fpath=True):
                 fname = unix_basename(fpath)
@@ -199,7 +225,12 @@ class CompletionSystem(object):
         return self.__get_completions(*args)
 
     def async_complete(self, *args):
-        return MiniThreadPool.getInstance().run(self.__do_async_complete, args=args)
+        return MiniThreadPool.getInstance().run(self.__do_async_complete, args=args,
+                                                priority=MiniThreadPool.PRIORITY_INTERACTIVE)
+
+    def cancel(self, serial):
+        """Cancel an asynchronous completion if it has not yet started."""
+        return MiniThreadPool.getInstance().cancel(serial)
     
     def __get_completions(self, completer, text, cwd):
         return CompletionResults(list(completer.completions(text, cwd)))
@@ -8,9 +8,10 @@
 import sys
 import os
 import re
+import stat
 import fnmatch
 
-__all__ = ["glob", "iglob"]
+__all__ = ["glob", "iglob", "Globber", "expand_braces"]
 
 def glob(pathname, cwd=None):
     """Return a list of paths matching a pathname pattern.
@@ -26,28 +27,157 @@ def iglob(pathname, cwd=None):
     The pattern may contain simple shell-style wildcards a la fnmatch.
 
     """
-    wd = cwd or os.curdir
-    if not has_magic(pathname):
-        if os.path.lexists(pathname):
-            yield pathname
-        return
-    dirname, basename = os.path.split(pathname)
-    if not dirname:
-        for name in glob1(wd, basename):
-            yield name
-        return
-    if has_magic(dirname):
-        dirs = iglob(dirname)
-    else:
-        dirs = [dirname]
-    if has_magic(basename):
-        glob_in_dir = glob1
-    else:
-        glob_in_dir = glob0
-    for dirname in dirs:
-        dirname = os.path.join(wd, dirname)
-        for name in glob_in_dir(dirname, basename):
-            yield os.path.join(dirname, name)
+    return Globber().iglob(pathname, cwd)
+
+class Globber(object):
+    """Expands pathname patterns, streaming the matches.
+
+    Besides fnmatch wildcards, a pattern may use brace alternatives such as
+    '*.{c,h}', and a '**' path component, which matches any number of
+    nested directories.  Compiled patterns, directory listings and file
+    types are cached for the lifetime of the object, so it should be used
+    only for a short batch of expansions.
+
+    """
+    def __init__(self):
+        super(Globber, self).__init__()
+        self.__patterns = {}
+        self.__listings = {}
+        self.__isdir = {}
+
+    def iglob(self, pathname, cwd=None):
+        wd = cwd or os.curdir
+        for pattern in expand_braces(pathname):
+            for result in self.__iglob(pattern, wd, False):
+                yield result
+
+    def __iglob(self, pathname, wd, dirs_only):
+        if not has_magic(pathname):
+            if os.path.lexists(os.path.join(wd, pathname)):
+                yield pathname
+            return
+        dirname, basename = os.path.split(pathname)
+        if not dirname:
+            if basename == '**':
+                if dirs_only:
+                    yield ''
+                for name in self.__glob_recursive(wd, dirs_only):
+                    yield name
+                return
+            for name in self.__glob1(wd, basename):
+                yield name
+            return
+        if has_magic(dirname):
+            dirs = self.__iglob(dirname, wd, True)
+        else:
+            dirs = [dirname]
+        for dirname in dirs:
+            dirname = os.path.join(wd, dirname)
+            if basename == '**':
+                if dirs_only:
+                    yield dirname
+                names = self.__glob_recursive(dirname, dirs_only)
+            elif has_magic(basename):
+                names = self.__glob1(dirname, basename)
+            else:
+                names = glob0(dirname, basename)
+            for name in names:
+                yield os.path.join(dirname, name)
+
+    def __listdir(self, dirname):
+        try:
+            return self.__listings[dirname]
+        except KeyError, e:
+            pass
+        try:
+            names = os.listdir(dirname)
+        except os.error:
+            names = []
+        self.__listings[dirname] = names
+        return names
+
+    def __is_dir(self, path):
+        # Symbolic links are not followed, so recursion can't loop
+        try:
+            return self.__isdir[path]
+        except KeyError, e:
+            pass
+        try:
+            isdir = stat.S_ISDIR(os.lstat(path).st_mode)
+        except os.error:
+            isdir = False
+        self.__isdir[path] = isdir
+        return isdir
+
+    def __match(self, pattern):
+        try:
+            return self.__patterns[pattern]
+        except KeyError, e:
+            pass
+        match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+        self.__patterns[pattern] = match
+        return match
+
+    def __glob1(self, dirname, pattern):
+        if not dirname:
+            dirname = os.curdir
+        if isinstance(pattern, unicode) and not isinstance(dirname, unicode):
+            dirname = unicode(dirname, sys.getfilesystemencoding() or
+                                       sys.getdefaultencoding())
+        names = self.__listdir(dirname)
+        match = self.__match(pattern)
+        show_hidden = pattern[0] == '.'
+        for name in names:
+            if name[0] == '.' and not show_hidden:
+                continue
+            if match(os.path.normcase(name)):
+                yield name
+
+    def __glob_recursive(self, dirname, dirs_only):
+        """Yield the paths below dirname, relative to it."""
+        if not dirname:
+            dirname = os.curdir
+        for name in self.__listdir(dirname):
+            if name[0] == '.':
+                continue
+            path = os.path.join(dirname, name)
+            isdir = self.__is_dir(path)
+            if isdir or not dirs_only:
+                yield name
+            if isdir:
+                for subname in self.__glob_recursive(path, dirs_only):
+                    yield os.path.join(name, subname)
+
+def expand_braces(pattern):
+    """Return the list of patterns given by expanding brace alternatives;
+    'a{b,c{d,e}}' gives ['ab', 'acd', 'ace'].  Braces without a comma are
+    left alone."""
+    depth = 0
+    start = None
+    commas = []
+    for i, c in enumerate(pattern):
+        if c == '{':
+            if depth == 0:
+                start = i
+                commas = []
+            depth += 1
+        elif c == '}' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                if not commas:
+                    # Not an alternative; expand the rest of the pattern
+                    return [pattern[:i+1] + rest for rest in expand_braces(pattern[i+1:])]
+                prefix = pattern[:start]
+                bounds = [start] + commas + [i]
+                results = []
+                for rest in expand_braces(pattern[i+1:]):
+                    for j in xrange(len(bounds) - 1):
+                        for alt in expand_braces(pattern[bounds[j]+1:bounds[j+1]]):
+                            results.append(prefix + alt + rest)
+                return results
+        elif c == ',' and depth == 1:
+            commas.append(i)
+    return [pattern]
 
 # These 2 helper functions non-recursively glob inside a literal directory.
 # They return a list of basenames. `glob1` accepts a pattern while `glob0`
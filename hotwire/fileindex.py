@@ -0,0 +1,278 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os, sys, stat, re, datetime, threading, logging
+try:
+    import sqlite3
+except:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from hotwire.fs import path_normalize, mtime_is_racy
+from hotwire.externals.singletonmixin import Singleton
+from hotwire.state import _get_state_path
+from hotwire.logutil import log_except
+
+_logger = logging.getLogger("hotwire.FileIndex")
+
+TYPE_FILE = u'f'
+TYPE_DIRECTORY = u'd'
+TYPE_LINK = u'l'
+
+# Bumped when existing indexes need relisting; version 1 added hidden entries
+_SCHEMA_VERSION = 1
+
+def _subtree_range(path):
+    # Bounds selecting the paths below path with the primary key index; '0'
+    # is the character after '/'
+    path = path.rstrip('/')
+    return (path + '/', path + '0')
+
+def glob_escape(text):
+    """Return text quoted for use in a GLOB pattern."""
+    return re.sub(r'([[*?])', r'[\1]', text)
+
+_regexps = {}
+def _sql_regexp(pattern, value):
+    regexp = _regexps.get(pattern)
+    if regexp is None:
+        regexp = _regexps[pattern] = re.compile(pattern)
+    return value is not None and regexp.search(value) is not None
+
+class FileIndexEntry(object):
+    __slots__ = ['path', 'type', 'size', 'mtime']
+    def __init__(self, path, type, size, mtime):
+        self.path = path
+        self.type = type
+        self.size = size
+        self.mtime = mtime
+
+class FileIndex(Singleton):
+    """Names, types, sizes and modification times of the files under indexed
+directory trees, for finding files without walking them.  Updating relists
+just the directories whose modification time changed, as it does when
+entries are added, removed or renamed; so the size and time recorded for a
+file are those when its directory last changed, and callers searching by them
+must check the file's current stat.  Hidden files are indexed, but only
+searched for when asked."""
+
+    def __init__(self):
+        super(FileIndex, self).__init__()
+        self.__path = None
+        self.__update_lock = threading.Lock()
+
+    def __connect(self):
+        # The configuration directory may be overridden after we're created
+        path = _get_state_path('files.sqlite')
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.create_function('regexp', 2, _sql_regexp)
+        if path != self.__path:
+            _logger.debug("opening file index db: %s", path)
+            cursor = conn.cursor()
+            # Directory trees that are indexed
+            cursor.execute('''CREATE TABLE IF NOT EXISTS Roots (path TEXT UNIQUE, modtime DATETIME)''')
+            # Directories, with their modification time when last listed
+            cursor.execute('''CREATE TABLE IF NOT EXISTS Dirs (path TEXT PRIMARY KEY, mtime INTEGER)''')
+            # Searches scan a range of paths; keep the rows in path order where
+            # SQLite allows it
+            files_schema = '''CREATE TABLE IF NOT EXISTS Files (path TEXT PRIMARY KEY, dirpath TEXT, name TEXT, type TEXT, size INTEGER, mtime INTEGER)'''
+            try:
+                cursor.execute(files_schema + ' WITHOUT ROWID')
+            except sqlite3.OperationalError, e:
+                cursor.execute(files_schema)
+            cursor.execute('''CREATE INDEX IF NOT EXISTS FilesDirIndex on Files (dirpath, type)''')
+            if cursor.execute('''PRAGMA user_version''').fetchone()[0] < _SCHEMA_VERSION:
+                # Forget the directory mtimes, so every directory is relisted
+                cursor.execute('''DELETE FROM Dirs''')
+                cursor.execute('''PRAGMA user_version = %d''' % (_SCHEMA_VERSION,))
+            self.__path = path
+        return conn
+
+    def __get_root(self, cursor, path):
+        while True:
+            if cursor.execute('''SELECT path FROM Roots WHERE path = ?''', (path,)).fetchone():
+                return path
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def get_root(self, path):
+        """Return the indexed directory tree containing path, or None."""
+        conn = self.__connect()
+        try:
+            return self.__get_root(conn.cursor(), path_normalize(path).rstrip('/') or '/')
+        finally:
+            conn.close()
+
+    def update(self, fs, path, cancelled=None):
+        """Index the tree at path, relisting the directories which changed since
+they were last listed.  Returns the number of directories listed."""
+        path = path_normalize(path).rstrip('/') or '/'
+        self.__update_lock.acquire()
+        conn = self.__connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''BEGIN TRANSACTION''')
+            try:
+                count = self.__update(cursor, fs, path, cancelled)
+                if self.__get_root(cursor, path) is None:
+                    cursor.execute('''INSERT OR REPLACE INTO Roots VALUES (?, ?)''', (path, datetime.datetime.now()))
+                cursor.execute('''COMMIT''')
+            except:
+                cursor.execute('''ROLLBACK''')
+                raise
+        finally:
+            conn.close()
+            self.__update_lock.release()
+        _logger.debug("updated index of %r, listed %d directories", path, count)
+        return count
+
+    def update_async(self, fs, path):
+        """Update the index of path in the background, unless an update is running."""
+        from hotwire.async import MiniThreadPool
+        MiniThreadPool.getInstance().run(self.__do_update_async, args=(fs, path),
+                                         priority=MiniThreadPool.PRIORITY_BULK)
+
+    @log_except(_logger)
+    def __do_update_async(self, fs, path):
+        if self.__update_lock.locked():
+            return
+        self.update(fs, path)
+
+    def __forget_subtree(self, cursor, path):
+        (start, end) = _subtree_range(path)
+        cursor.execute('''DELETE FROM Files WHERE path >= ? AND path < ?''', (start, end))
+        cursor.execute('''DELETE FROM Dirs WHERE path = ? OR (path >= ? AND path < ?)''', (path, start, end))
+
+    def __update(self, cursor, fs, root, cancelled):
+        count = 0
+        pending = [root]
+        while pending:
+            if cancelled is not None and cancelled():
+                break
+            dirpath = pending.pop()
+            try:
+                mtime = int(os.stat(dirpath).st_mtime)
+            except OSError, e:
+                self.__forget_subtree(cursor, dirpath)
+                continue
+            row = cursor.execute('''SELECT mtime FROM Dirs WHERE path = ?''', (dirpath,)).fetchone()
+            if row is not None and row[0] == mtime:
+                pending.extend(row[0] for row in cursor.execute('''SELECT path FROM Files WHERE dirpath = ? AND type = ?''',
+                                                                (dirpath, TYPE_DIRECTORY)))
+                continue
+            count += 1
+            olddirs = set(row[0] for row in cursor.execute('''SELECT path FROM Files WHERE dirpath = ? AND type = ?''',
+                                                           (dirpath, TYPE_DIRECTORY)))
+            entries = []
+            try:
+                for fobj in fs.ls_dir(dirpath, True, sort=False, resolve=True):
+                    st = fobj.stat
+                    if st is None:
+                        continue
+                    if stat.S_ISLNK(st.st_mode):
+                        ftype = TYPE_LINK
+                    elif stat.S_ISDIR(st.st_mode):
+                        ftype = TYPE_DIRECTORY
+                        pending.append(fobj.path)
+                    else:
+                        ftype = TYPE_FILE
+                    entries.append((fobj.path, dirpath, fobj.basename, ftype, st.st_size, st.st_mtime))
+            except OSError, e:
+                _logger.debug("Failed to list %r: %s", dirpath, e)
+                self.__forget_subtree(cursor, dirpath)
+                continue
+            for olddir in olddirs.difference(entry[0] for entry in entries if entry[3] == TYPE_DIRECTORY):
+                self.__forget_subtree(cursor, olddir)
+            cursor.execute('''DELETE FROM Files WHERE dirpath = ?''', (dirpath,))
+            cursor.executemany('''INSERT OR REPLACE INTO Files VALUES (?, ?, ?, ?, ?, ?)''', entries)
+            # Have a directory which may change again without its mtime
+            # moving listed next time
+            if mtime_is_racy(mtime):
+                mtime = None
+            cursor.execute('''INSERT OR REPLACE INTO Dirs VALUES (?, ?)''', (dirpath, mtime))
+        return count
+
+    def refresh_entries(self, entries):
+        """Store the current size and modification time of indexed files, given
+as (path, size, mtime) tuples; a size of None drops the file.  Skipped while
+an update is running."""
+        if not entries or not self.__update_lock.acquire(False):
+            return
+        conn = self.__connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''BEGIN TRANSACTION''')
+            try:
+                for (path, size, mtime) in entries:
+                    if size is None:
+                        cursor.execute('''DELETE FROM Files WHERE path = ?''', (path,))
+                    else:
+                        cursor.execute('''UPDATE Files SET size = ?, mtime = ? WHERE path = ?''', (size, mtime, path))
+                cursor.execute('''COMMIT''')
+            except:
+                cursor.execute('''ROLLBACK''')
+                raise
+        finally:
+            conn.close()
+            self.__update_lock.release()
+
+    def search(self, path, names=(), regexps=(), ignore_case=False, types=None,
+               min_size=None, max_size=None, newer=None, older=None, hidden=False, limit=None):
+        """Yield FileIndexEntry objects for the files below path whose name
+matches all of the GLOB patterns names and regular expressions regexps, of
+one of types if given, and within the size and modification time bounds
+given, sorted by path.  Unless hidden is set, files whose name, or that of a
+directory between them and path, starts with '.' are left out."""
+        (start, end) = _subtree_range(path_normalize(path))
+        clauses = ['path >= ? AND path < ?']
+        args = [start, end]
+        if not hidden:
+            clauses.append('NOT (path GLOB ? OR path GLOB ?)')
+            args.extend((glob_escape(start) + u'.*', glob_escape(start) + u'*/.*'))
+        for name in names:
+            if ignore_case:
+                clauses.append('lower(name) GLOB ?')
+                args.append(name.lower())
+            else:
+                clauses.append('name GLOB ?')
+                args.append(name)
+        for regexp in regexps:
+            clauses.append('name REGEXP ?')
+            args.append(ignore_case and (u'(?i)' + regexp) or regexp)
+        if types:
+            clauses.append('type IN (%s)' % (', '.join('?' * len(types)),))
+            args.extend(types)
+        for (clause, value) in (('size >= ?', min_size), ('size <= ?', max_size),
+                                ('mtime >= ?', newer), ('mtime <= ?', older)):
+            if value is not None:
+                clauses.append(clause)
+                args.append(value)
+        query = '''SELECT path, type, size, mtime FROM Files WHERE %s ORDER BY path''' % (' AND '.join(clauses),)
+        if limit is not None:
+            query += ' LIMIT %d' % (limit,)
+        conn = self.__connect()
+        try:
+            for row in conn.cursor().execute(query, args):
+                yield FileIndexEntry(*row)
+        finally:
+            conn.close()
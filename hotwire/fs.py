@@ -19,16 +19,18 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, fnmatch, stat, shutil
+import os, sys, fnmatch, stat, shutil, time
 import posixpath, locale, urllib, codecs
 
 import hotwire
 from hotwire.async import MiniThreadPool
-from hotwire.externals.glob2 import iglob
+from hotwire.externals.glob2 import iglob, Globber
 from hotwire.sysdep import is_windows, is_unix
 
-def dirglob(dir, pat):
-    for result in iglob(pat, dir):
+def dirglob(dir, pat, globber=None):
+    if globber is None:
+        globber = Globber()
+    for result in globber.iglob(pat, dir):
         yield result
 
 _sep_len = len(os.sep)
@@ -112,6 +114,17 @@ def open_text_file(path, mode='r', buffering=None):
         kwargs['buffering'] = buffering
     return codecs.open(path, mode, locale_encoding, 'strict', **kwargs)
 
+def iter_chunk_lines(chunks):
+    """Yield the lines of a stream given as a sequence of byte strings."""
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if partial:
+        yield partial
+
 def file_is_valid_utf8(path):
     f = open(path, 'rb')
     buf = f.read(8192)
@@ -153,6 +166,14 @@ def iterd_sorted(dpath, **kwargs):
     for v in sorted(iterd(dpath, **kwargs), locale.strcoll):
         yield v
 
+def mtime_is_racy(mtime, now=None):
+    """Return True if a file with modification time mtime, as seen at time now,
+may change again without its modification time moving."""
+    if now is None:
+        now = time.time()
+    # Timestamps may be as coarse as a second
+    return mtime >= now - 1
+
 def atomic_rename(oldp, newp):
     # FIXME - not really atomic on Windows =/
     if is_windows():
@@ -0,0 +1,199 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import fnmatch, threading, Queue, logging
+
+from hotwire.fs import path_join
+from hotwire.logutil import log_except
+
+_logger = logging.getLogger("hotwire.FsWalk")
+
+class IgnoreRules(object):
+    """A set of .gitignore-style exclusion patterns.  Patterns without a
+slash match the name at any depth below the directory they were given for;
+others match the path relative to it.  A trailing slash restricts a pattern
+to directories, and a leading ! re-includes what an earlier pattern excluded."""
+    __slots__ = ['_rules']
+
+    def __init__(self, rules=()):
+        super(IgnoreRules, self).__init__()
+        self._rules = tuple(rules)
+
+    def extend(self, basedir, patterns):
+        """Return new rules with patterns, relative to basedir, added."""
+        rules = list(self._rules)
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            rules.append((basedir.rstrip('/') + '/', pattern.lstrip('/'), negate, dir_only, anchored))
+        if len(rules) == len(self._rules):
+            return self
+        return IgnoreRules(rules)
+
+    def extend_from_file(self, basedir, fname='.gitignore'):
+        try:
+            f = open(path_join(basedir, fname))
+        except IOError, e:
+            return self
+        try:
+            return self.extend(basedir, [unicode(line, 'utf-8', 'replace') for line in f])
+        finally:
+            f.close()
+
+    def is_ignored(self, path, is_dir):
+        ignored = False
+        for (prefix, pattern, negate, dir_only, anchored) in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if not path.startswith(prefix):
+                continue
+            if anchored:
+                target = path[len(prefix):]
+            else:
+                target = path[path.rfind('/')+1:]
+            if fnmatch.fnmatchcase(target, pattern):
+                ignored = not negate
+        return ignored
+
+class TreeWalker(object):
+    """Traverses a directory tree, listing subdirectories concurrently on a
+few threads; this mostly pays off where stat and readdir have high latency,
+as on network filesystems.  Hidden directories are pruned by name, without a
+stat.  Files are generated in batches, and the order between directories
+is not defined."""
+
+    DEFAULT_THREADS = 4
+    BATCH_SIZE = 256
+
+    def __init__(self, fs, show_all=False, max_depth=None, exclude=(), gitignore=False,
+                 threads=DEFAULT_THREADS):
+        """max_depth limits how far below the starting directory files are
+generated; 1 means just its own entries.  exclude is a list of .gitignore-style
+patterns; if gitignore is set, .gitignore files found in the tree apply too."""
+        super(TreeWalker, self).__init__()
+        self.__fs = fs
+        self.__show_all = show_all
+        self.__max_depth = max_depth
+        self.__exclude = exclude
+        self.__gitignore = gitignore
+        self.__threads = threads
+
+    def walk(self, path):
+        """Generate lists of the File objects for the non-directories under path."""
+        path = path.rstrip('/') or '/'
+        rules = IgnoreRules().extend(path, self.__exclude)
+        work = Queue.Queue()
+        results = Queue.Queue(self.__threads * 4)
+        state = _WalkState()
+        state.pending = 1
+        work.put((path, 1, rules))
+        threads = []
+        for i in xrange(self.__threads):
+            thread = threading.Thread(target=self.__worker, args=(work, results, state),
+                                      name="TreeWalker Thread")
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        try:
+            while True:
+                batch = results.get()
+                if batch is None:
+                    break
+                yield batch
+        finally:
+            state.stopped = True
+            for thread in threads:
+                work.put(None)
+            # Unblock any worker waiting for room in the results queue
+            try:
+                while True:
+                    results.get_nowait()
+            except Queue.Empty, e:
+                pass
+
+    @log_except(_logger)
+    def __worker(self, work, results, state):
+        while True:
+            item = work.get()
+            if item is None or state.stopped:
+                return
+            try:
+                self.__walk_dir(item, work, results, state)
+            except:
+                _logger.exception("Failed to walk %r", item[0])
+            state.lock.acquire()
+            state.pending -= 1
+            done = state.pending == 0
+            state.lock.release()
+            if done:
+                self.__put_result(results, state, None)
+
+    def __put_result(self, results, state, batch):
+        while not state.stopped:
+            try:
+                results.put(batch, timeout=0.1)
+                return
+            except Queue.Full, e:
+                continue
+
+    def __walk_dir(self, item, work, results, state):
+        (dirpath, depth, rules) = item
+        if self.__gitignore:
+            rules = rules.extend_from_file(dirpath)
+        batch = []
+        try:
+            for fobj in self.__fs.ls_dir(dirpath, self.__show_all, sort=False, resolve=False):
+                if state.stopped:
+                    return
+                is_dir = fobj.is_directory
+                if rules.is_ignored(fobj.path, is_dir):
+                    continue
+                if not is_dir:
+                    # Load the stat here, concurrently with the other directories
+                    fobj.stat
+                    batch.append(fobj)
+                    if len(batch) >= self.BATCH_SIZE:
+                        self.__put_result(results, state, batch)
+                        batch = []
+                elif not fobj.is_link and (self.__max_depth is None or depth < self.__max_depth):
+                    state.lock.acquire()
+                    state.pending += 1
+                    state.lock.release()
+                    work.put((fobj.path, depth + 1, rules))
+        except OSError, e:
+            _logger.debug("Failed to list %r: %s", dirpath, e)
+        if batch:
+            self.__put_result(results, state, batch)
+
+class _WalkState(object):
+    def __init__(self):
+        super(_WalkState, self).__init__()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.stopped = False
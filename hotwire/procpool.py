@@ -0,0 +1,326 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os, sys, struct, select, subprocess, threading, logging, errno, cPickle, traceback
+from collections import deque
+
+try:
+    import multiprocessing
+except ImportError, e:
+    multiprocessing = None
+
+from hotwire.externals.singletonmixin import Singleton
+
+_logger = logging.getLogger("hotwire.ProcessPool")
+
+# Messages between the pool and its workers are length-prefixed pickles
+_header = struct.Struct('!Q')
+
+def _read_exact(fd, count):
+    chunks = []
+    while count > 0:
+        try:
+            chunk = os.read(fd, min(count, 1024 * 1024))
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        count -= len(chunk)
+    return ''.join(chunks)
+
+def _write_all(fd, data):
+    while data:
+        try:
+            count = os.write(fd, data)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        data = data[count:]
+
+def _recv(fd):
+    header = _read_exact(fd, _header.size)
+    if header is None:
+        return None
+    data = _read_exact(fd, _header.unpack(header)[0])
+    if data is None:
+        return None
+    return cPickle.loads(data)
+
+def _run_batch(fn, batch):
+    # Runs in a worker process; returns the reply for the batch
+    try:
+        results = [fn(item) for item in batch]
+    except Exception, e:
+        reply = ('exception', e, traceback.format_exc())
+    else:
+        reply = ('ok', results)
+    try:
+        return cPickle.dumps(reply, 2)
+    except Exception, e:
+        if reply[0] == 'ok':
+            text = "Couldn't pickle the results of %r: %s" % (fn, e)
+        else:
+            text = reply[2]
+        return cPickle.dumps(('error', text), 2)
+
+def _worker_main():
+    import gettext, signal
+    gettext.install('hotwire')
+    # Interrupting the shell shouldn't kill its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Keep stdout for replies, and send anything the work prints to stderr
+    outfd = os.dup(1)
+    os.dup2(2, 1)
+    while True:
+        request = _recv(0)
+        if request is None:
+            break
+        (fn, batch) = request
+        data = _run_batch(fn, batch)
+        _write_all(outfd, _header.pack(len(data)) + data)
+
+class ProcessPoolError(Exception):
+    pass
+
+class _Worker(object):
+    """A worker process, running one batch at a time."""
+    def __init__(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path if path])
+        self.__process = subprocess.Popen([sys.executable, '-m', 'hotwire.procpool'],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          close_fds=True, env=env)
+
+    def send(self, data):
+        try:
+            _write_all(self.__process.stdin.fileno(), _header.pack(len(data)) + data)
+        except OSError, e:
+            raise ProcessPoolError(_("Worker process exited: %s") % (e,))
+
+    def recv(self, timeout, cancelled):
+        """Return the reply to the batch sent, or None if cancelled while waiting."""
+        fd = self.__process.stdout.fileno()
+        while True:
+            try:
+                (readable, writable, errors) = select.select([fd], [], [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                break
+            if cancelled is not None and cancelled():
+                return None
+        reply = _recv(fd)
+        if reply is None:
+            raise ProcessPoolError(_("Worker process exited with status %s") % (self.__process.wait(),))
+        return reply
+
+    def kill(self):
+        try:
+            self.__process.kill()
+        except OSError, e:
+            pass
+        self.__process.stdin.close()
+        self.__process.stdout.close()
+        self.__process.wait()
+
+class ProcessPool(Singleton):
+    """A pool of worker processes for CPU-bound builtins.  Work is done by a
+function which takes one object and returns a list of output objects; the
+function and the objects are pickled in batches.  Workers are started as
+needed, as new interpreters rather than forks, so they share no file
+descriptors or locks with the shell; one which dies is replaced.  A batch which
+can't be pickled is run in the calling process, as is everything if the number
+of processes is set to 0; a batch whose results can't be pickled, or whose
+worker dies, raises ProcessPoolError rather than being run again."""
+
+    DEFAULT_BATCH_SIZE = 64
+    # Seconds between checks for cancellation while waiting for a batch
+    POLL_INTERVAL = 0.5
+
+    def __init__(self):
+        _logger.debug("Creating ProcessPool")
+        self.__lock = threading.Lock()
+        self.__idle_changed = threading.Condition(self.__lock)
+        # Started workers not running a batch, and the count of all started
+        self.__idle = []
+        self.__count = 0
+        if multiprocessing is not None:
+            self.__max_processes = multiprocessing.cpu_count()
+        else:
+            self.__max_processes = 1
+
+    def set_max_processes(self, count):
+        """Set the number of worker processes; 0 runs everything locally."""
+        self.__lock.acquire()
+        self.__max_processes = count
+        self.__idle_changed.notifyAll()
+        self.__lock.release()
+        self.close()
+
+    def get_max_processes(self):
+        return self.__max_processes
+
+    def close(self):
+        """Stop the idle worker processes; more are started when needed."""
+        self.__lock.acquire()
+        idle = self.__idle
+        self.__idle = []
+        self.__count -= len(idle)
+        self.__lock.release()
+        for worker in idle:
+            worker.kill()
+
+    def __acquire(self, block):
+        # Return an idle worker, starting one if there are too few; or None
+        # if all are busy and block is False
+        self.__lock.acquire()
+        try:
+            while True:
+                if self.__idle:
+                    return self.__idle.pop()
+                if self.__count < self.__max_processes:
+                    self.__count += 1
+                    break
+                if not block:
+                    return None
+                self.__idle_changed.wait()
+        finally:
+            self.__lock.release()
+        try:
+            _logger.debug("starting a worker process")
+            return _Worker()
+        except:
+            self.__release(None)
+            raise
+
+    def __release(self, worker):
+        # Make worker idle again; None if it was discarded
+        self.__lock.acquire()
+        if worker is not None and self.__count > self.__max_processes:
+            # The limit was lowered while it was busy
+            excess = worker
+            worker = None
+        else:
+            excess = None
+        if worker is None:
+            self.__count -= 1
+        else:
+            self.__idle.append(worker)
+        self.__idle_changed.notify()
+        self.__lock.release()
+        if excess is not None:
+            excess.kill()
+
+    def __discard(self, worker):
+        worker.kill()
+        self.__release(None)
+
+    def imap(self, fn, iterable, batch_size=None, cancelled=None):
+        """Yield the objects returned by fn for each object of iterable, in order.
+If cancelled is given, it is called between batches and no more are submitted
+or waited for once it returns True."""
+        batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        if self.__max_processes < 1:
+            for item in iterable:
+                for result in fn(item):
+                    yield result
+            return
+        # Submitted batches in order, as (worker, batch); batch is set for
+        # those to run locally
+        pending = deque()
+        try:
+            for batch in _batches(iterable, batch_size):
+                if cancelled is not None and cancelled():
+                    return
+                try:
+                    data = cPickle.dumps((fn, batch), 2)
+                except Exception, e:
+                    _logger.debug("couldn't pickle batch, running locally: %s", e)
+                    pending.append((None, batch))
+                    continue
+                # Only wait for a worker when we hold none ourselves
+                worker = self.__acquire(not pending)
+                while worker is None:
+                    results = self.__collect(fn, pending.popleft(), cancelled)
+                    if results is None:
+                        return
+                    for result in results:
+                        yield result
+                    worker = self.__acquire(not pending)
+                try:
+                    worker.send(data)
+                except:
+                    self.__discard(worker)
+                    raise
+                pending.append((worker, None))
+            while pending:
+                results = self.__collect(fn, pending.popleft(), cancelled)
+                if results is None:
+                    return
+                for result in results:
+                    yield result
+        finally:
+            # Stopped early; don't wait for the batches still running
+            for (worker, batch) in pending:
+                if worker is not None:
+                    self.__discard(worker)
+
+    def __collect(self, fn, (worker, batch), cancelled):
+        """Return the output objects for a submitted batch, or None if cancelled."""
+        if worker is None:
+            results = [fn(item) for item in batch]
+        else:
+            try:
+                reply = worker.recv(self.POLL_INTERVAL, cancelled)
+            except:
+                self.__discard(worker)
+                raise
+            if reply is None:
+                self.__discard(worker)
+                return None
+            self.__release(worker)
+            if reply[0] == 'exception':
+                _logger.debug("exception in worker process: %s", reply[2])
+                raise reply[1]
+            elif reply[0] == 'error':
+                raise ProcessPoolError(reply[1])
+            results = reply[1]
+        return [result for itemresults in results for result in itemresults]
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+if __name__ == '__main__':
+    _worker_main()
@@ -0,0 +1,176 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os,sys,logging,time,threading
+
+from hotwire.externals.singletonmixin import Singleton
+
+_logger = logging.getLogger("hotwire.ResultCache")
+
+_getsizeof = getattr(sys, 'getsizeof', lambda obj: 64)
+
+def _estimate_size(obj):
+    size = _getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += _getsizeof(obj.__dict__)
+    return size
+
+def get_validators(paths):
+    """Return a tuple describing the current state of the given paths, used to
+    check whether a cached result is still valid."""
+    validators = []
+    for path in paths:
+        try:
+            stbuf = os.stat(path)
+            validators.append((path, stbuf.st_mtime, stbuf.st_size))
+        except OSError, e:
+            validators.append((path, None, None))
+    return tuple(validators)
+
+class ResultCacheEntry(object):
+    __slots__ = ['validators', 'dependencies', 'objects', 'size', 'ctime']
+    def __init__(self, validators, dependencies, objects, size):
+        self.validators = validators
+        self.dependencies = dependencies
+        self.objects = objects
+        self.size = size
+        self.ctime = time.time()
+
+class ResultCache(Singleton):
+    """Holds the output of recently run cacheable pipelines, keyed on the pipeline
+text and working directory.  An entry is used only while the files and directories
+it depends on are unchanged: those named up front by the caller, and those the
+run itself found, such as the files a glob matched or that were listed; the least recently used entries are evicted to keep
+within a memory budget."""
+
+    DEFAULT_MEMORY_BUDGET = 32 * 1024 * 1024
+    # Results with more objects than this are not cached
+    MAX_OBJECTS = 100000
+    # Seconds after which an entry is discarded
+    MAX_AGE = 30 * 60
+
+    def __init__(self):
+        super(ResultCache, self).__init__()
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        # Keys, least recently used first
+        self.__lru = []
+        self.__size = 0
+        self.__budget = self.DEFAULT_MEMORY_BUDGET
+        self.hits = 0
+        self.misses = 0
+
+    def set_memory_budget(self, budget):
+        self.__lock.acquire()
+        self.__budget = budget
+        self.__evict(0)
+        self.__lock.release()
+
+    def get_memory_budget(self):
+        return self.__budget
+
+    def get_memory_usage(self):
+        """Return the estimated number of bytes used by cached objects."""
+        return self.__size
+
+    def get_entry_count(self):
+        return len(self.__entries)
+
+    def lookup(self, key, validators):
+        """Return the list of objects cached for key if the validators match
+those it was stored with and its dependencies are unchanged, otherwise None."""
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.validators != validators or time.time() - entry.ctime > self.MAX_AGE:
+                _logger.debug("cache entry for %r is stale", key)
+                self.__remove(key)
+                self.misses += 1
+                return None
+        finally:
+            self.__lock.release()
+        # Don't hold the lock while statting
+        if entry.dependencies and get_validators([dep[0] for dep in entry.dependencies]) != entry.dependencies:
+            _logger.debug("dependencies of cache entry for %r changed", key)
+            self.invalidate(key, entry)
+            self.__lock.acquire()
+            self.misses += 1
+            self.__lock.release()
+            return None
+        self.__lock.acquire()
+        try:
+            if self.__entries.get(key) is entry:
+                self.__lru.remove(key)
+                self.__lru.append(key)
+            self.hits += 1
+            return entry.objects
+        finally:
+            self.__lock.release()
+
+    def store(self, key, validators, objects, dependencies=()):
+        """Cache objects for key.  validators are as passed to lookup();
+dependencies, from get_validators(), are checked again on each lookup."""
+        size = 0
+        for obj in objects:
+            size += _estimate_size(obj)
+        self.__lock.acquire()
+        try:
+            if key in self.__entries:
+                self.__remove(key)
+            if size > self.__budget / 2:
+                _logger.debug("not caching %r, estimated size %d", key, size)
+                return
+            self.__evict(size)
+            self.__entries[key] = ResultCacheEntry(validators, dependencies, objects, size)
+            self.__lru.append(key)
+            self.__size += size
+            _logger.debug("cached %d objects for %r, total size %d", len(objects), key, self.__size)
+        finally:
+            self.__lock.release()
+
+    def invalidate(self, key=None, entry=None):
+        """Remove the entry for key, or all entries if key is None.  If entry
+is given, only remove it if it is still the one cached for key."""
+        self.__lock.acquire()
+        if key is None:
+            self.__entries = {}
+            self.__lru = []
+            self.__size = 0
+        elif key in self.__entries and entry in (None, self.__entries[key]):
+            self.__remove(key)
+        self.__lock.release()
+
+    def __remove(self, key):
+        # Called with __lock held
+        entry = self.__entries.pop(key)
+        self.__lru.remove(key)
+        self.__size -= entry.size
+
+    def __evict(self, needed):
+        # Called with __lock held
+        while self.__lru and self.__size + needed > self.__budget:
+            key = self.__lru[0]
+            _logger.debug("evicting cache entry for %r", key)
+            self.__remove(key)
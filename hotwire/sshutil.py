@@ -35,7 +35,7 @@ class OpenSSHKnownHosts(Singleton):
         self.__monitor = None
         self.__hostcache = None
         
-    def __on_hostchange(self):
+    def __on_hostchange(self, *args):
         try:
             _logger.debug("reading %s", self.__path)
             f = open(self.__path)
@@ -60,7 +60,10 @@ class OpenSSHKnownHosts(Singleton):
         
     def get_hosts(self):
         if self.__monitor is None:
-            self.__monitor = Filesystem.getInstance().get_monitor(self.__path, self.__on_hostchange)            
+            try:
+                self.__monitor = Filesystem.getInstance().get_monitor(self.__path, self.__on_hostchange)
+            except NotImplementedError, e:
+                self.__monitor = False
         if self.__hostcache is None:
             self.__on_hostchange()
         return self.__hostcache
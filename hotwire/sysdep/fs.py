@@ -19,13 +19,14 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,shutil,stat,logging,tempfile,urllib
+import os,sys,shutil,stat,logging,tempfile,urllib,threading,struct,locale
+from operator import itemgetter
 from cStringIO import StringIO
 
 import gobject
 
 import hotwire
-from hotwire.fs import unix_basename, FilePath, path_expanduser, path_fromurl, path_tourl, atomic_rename, iterd_sorted
+from hotwire.fs import unix_basename, FilePath, path_expanduser, path_fromurl, path_tourl, atomic_rename, iterd, iterd_sorted
 from hotwire.async import MiniThreadPool
 from hotwire.logutil import log_except
 from hotwire.sysdep import is_windows, is_unix
@@ -42,24 +43,61 @@ class BaseFilesystem(object):
         self._trashdir = os.path.expanduser('~/.Trash')
         self.makedirs_p(self._trashdir)
 
-    def ls_dir(self, dir, show_all):
-        for x in iterd_sorted(dir):
-            fobj = self.get_file_sync(x)
-            if show_all or (not fobj.hidden):  
-                yield fobj
+    def ls_dir(self, dir, show_all, sort=True, resolve=False):
+        """Yield a File for each entry of dir, with its stat deferred.  Where
+the platform gives the type of a directory entry, it answers is_directory and
+is_link until then; the rest is loaded in batches when first read.  If resolve
+is True, stats are loaded in the calling thread before the files are yielded."""
+        batch = StatBatch()
+        entries = self._iterd_typed(dir)
+        if sort:
+            entries = sorted(entries, cmp=locale.strcoll, key=itemgetter(0))
+        # Files are yielded a batch at a time, so that the first one read
+        # loads its neighbours' stats with it
+        pending = []
+        for (x, ftype) in entries:
+            fobj = self.fileklass(x, fs=self)
+            fobj.get_stat_deferred(batch, ftype)
+            if not (show_all or (not fobj.hidden)):
+                continue
+            pending.append(fobj)
+            if len(pending) >= StatBatch.SIZE:
+                if resolve:
+                    batch.resolve_files(pending)
+                for fobj in pending:
+                    yield fobj
+                pending = []
+        if resolve:
+            batch.resolve_files(pending)
+        for fobj in pending:
+            yield fobj
+
+    def _iterd_typed(self, dir):
+        """Generate (path, type) pairs for the files in dir, in the order the
+OS returns them; type is 'd' for a directory, 'l' for a symbolic link, '-' for
+anything else, or None if the directory entry doesn't say."""
+        for x in iterd(dir):
+            yield (x, None)
 
     def get_basename_is_ignored(self, bn):
         return False
     
     def get_monitor(self, path, cb):
+        """Return a monitor for changes to the file or directory path, with a
+cancel() method.  cb(paths) is called from the main loop with the changed paths.
+May be called from any thread.  Raises NotImplementedError if changes can't be
+monitored, including when too many files are already."""
         raise NotImplementedError()
     
     def get_bookmarks(self):
         return BaseBookmarks.getInstance()
 
-    def get_file(self, path):
+    def get_file(self, path, cb=None):
+        """Return a File for path whose stat is loaded asynchronously.  When it
+is, cb(files) is called from the main loop with it and the other files loaded
+at the same time; without cb, a dispatcher signal is sent from the File."""
         f = self.fileklass(path, fs=self)
-        f.get_stat()
+        f.get_stat(cb)
         return f
     
     def get_file_sync(self, path):
@@ -158,6 +196,117 @@ class BaseFilesystem(object):
     def supports_group(self):
         return False
     
+class StatBatch(object):
+    """Files from one directory listing whose stat has been deferred.  When one
+of them is needed, it is resolved together with the files following it, since
+whatever asked for one file's details usually asks for its neighbours' next."""
+    SIZE = 128
+
+    def __init__(self):
+        super(StatBatch, self).__init__()
+        # Reentrant, since a File's own stat code may read its deferred properties
+        self.__lock = threading.RLock()
+        self.__files = []
+        self.__resolving = set()
+
+    def add(self, fobj):
+        self.__files.append(fobj)
+        return len(self.__files) - 1
+
+    def resolve(self, index):
+        end = index + self.SIZE
+        self.__lock.acquire()
+        try:
+            for fobj in self.__files[index:end]:
+                if fobj is not None:
+                    self.__resolve_file(fobj)
+            # Drop the references so resolved files can be collected
+            self.__files[index:end] = [None] * len(self.__files[index:end])
+        finally:
+            self.__lock.release()
+
+    def resolve_files(self, files):
+        """Resolve the given files from this batch, and only those."""
+        self.__lock.acquire()
+        try:
+            for fobj in files:
+                self.__resolve_file(fobj)
+        finally:
+            self.__lock.release()
+
+    def __resolve_file(self, fobj):
+        if fobj in self.__resolving:
+            return
+        self.__resolving.add(fobj)
+        try:
+            fobj._resolve_stat()
+        finally:
+            self.__resolving.discard(fobj)
+
+def _deferred_property(name, doc=None, pack=None, unpack=None):
+    def get(self):
+        deferred = self._deferred
+        if deferred is not None:
+            (batch, index) = deferred
+            batch.resolve(index)
+        value = getattr(self, name)
+        if unpack is not None and value is not None:
+            return unpack(value)
+        return value
+    def set(self, value):
+        if pack is not None and value is not None:
+            value = pack(value)
+        setattr(self, name, value)
+    return property(get, set, doc=doc)
+
+# stat and target_stat are kept packed in a string rather than as a stat_result.
+# The fields File itself reads come first, so its properties decode just those.
+_packed_stat = struct.Struct('=IqdIIQQQddqqQ')
+_S_IFMT = 0170000
+_unpack_mode = struct.Struct('=I').unpack_from
+_unpack_mode_size = struct.Struct('=Iq').unpack_from
+_unpack_mtime = struct.Struct('=12xd').unpack_from
+_unpack_owner = struct.Struct('=20xII').unpack_from
+
+def _stat_field(st, name, index=None, default=0):
+    # Plain tuples, as some platforms build, only have the first ten fields
+    if hasattr(st, name):
+        return getattr(st, name)
+    if index is not None:
+        return st[index]
+    return default
+
+def _pack_stat(st):
+    try:
+        return _packed_stat.pack(st.st_mode, st.st_size, st.st_mtime,
+                                 st.st_uid & 0xFFFFFFFF, st.st_gid & 0xFFFFFFFF,
+                                 st.st_ino & 0xFFFFFFFFFFFFFFFF, st.st_dev & 0xFFFFFFFFFFFFFFFF, st.st_nlink,
+                                 st.st_atime, st.st_ctime, st.st_blksize, st.st_blocks, st.st_rdev)
+    except AttributeError, e:
+        pass
+    return _packed_stat.pack(st[stat.ST_MODE], st[stat.ST_SIZE], _stat_field(st, 'st_mtime', stat.ST_MTIME),
+                             st[stat.ST_UID] & 0xFFFFFFFF, st[stat.ST_GID] & 0xFFFFFFFF,
+                             st[stat.ST_INO] & 0xFFFFFFFFFFFFFFFF, st[stat.ST_DEV] & 0xFFFFFFFFFFFFFFFF,
+                             st[stat.ST_NLINK], _stat_field(st, 'st_atime', stat.ST_ATIME),
+                             _stat_field(st, 'st_ctime', stat.ST_CTIME), _stat_field(st, 'st_blksize'),
+                             _stat_field(st, 'st_blocks'), _stat_field(st, 'st_rdev'))
+
+def _unpack_stat(packed):
+    (mode, size, mtime, uid, gid, ino, dev, nlink, atime, ctime, blksize, blocks, rdev) = _packed_stat.unpack(packed)
+    return os.stat_result((mode, ino, dev, nlink, uid, gid, size, int(atime), int(mtime), int(ctime)),
+                          {'st_atime': atime, 'st_mtime': mtime, 'st_ctime': ctime,
+                           'st_blksize': blksize, 'st_blocks': blocks, 'st_rdev': rdev})
+
+# Files are usually created one directory at a time; let siblings share the string
+_last_dirname = u''
+def _share_dirname(dirname):
+    global _last_dirname
+    last = _last_dirname
+    if dirname == last:
+        return last
+    _last_dirname = dirname
+    return dirname
+
 class FileStatError(Exception):
     def __init__(self, cause):
         Exception.__init__(self, str(cause))
@@ -167,13 +316,13 @@ class File(object):
     """An extended crossplatform stat() container, essentially.  
     Extra data retrieved includes symbolic link target (if applicable) and icon."""
     
-    path = property(lambda self: self._path, doc="""Complete path to file, expressed in Hotwire notation (always forward slashes)""")
-    uri = property(lambda self: self._uri, doc="""URI notation for file""")
-    basename = property(lambda self: self._basename, doc="""Name of file (without directory component)""")
+    path = property(lambda self: self._get_path(), doc="""Complete path to file, expressed in Hotwire notation (always forward slashes)""")
+    uri = property(lambda self: self._get_uri(), doc="""URI notation for file""")
+    basename = property(lambda self: self._get_basename(), doc="""Name of file (without directory component)""")
     size = property(lambda self: self._get_size(), doc="""Size in bytes of file, or None if unknown""")
     hidden = property(lambda self: self._hidden, doc="""Whether or not this file is normally visible in directory listings""")
-    icon = property(lambda self: self._icon, doc="""Icon name (internal Hotwire/GTK+ representation)""")
-    is_directory = property(lambda self: self.test_directory(), doc="""Whether or not this object represents a directory""")
+    icon = property(lambda self: self._get_icon(), doc="""Icon name (internal Hotwire/GTK+ representation)""")
+    is_directory = property(lambda self: self._get_is_directory(), doc="""Whether or not this object represents a directory""")
     is_executable = property(lambda self: self._is_executable(), doc="""Whether or not this object represents an OS-executable file""")
     is_link = property(lambda self: self._is_link(), doc="""Whether or not this object represents a symbolic link""")
     file_type_char = property(lambda self:self._get_file_type_char(), doc="""Unix-style file type character ('d' for directory, etc.)""")
@@ -181,48 +330,115 @@ class File(object):
     permissions_string = property(lambda self: self._get_permissions_string(), doc="""Unix-style compact permissions string""")
     mtime = property(lambda self: self._get_mtime(), doc="""Modification time, in seconds since the epoch""")
     mimetype = property(lambda self: self._get_mime(), doc="""MIME type""")
-
-    __slots__ = ['fs', 'stat', 'xaccess', 'icon_error', '_permstring', 'target_stat', 'stat_error']
+    stat = _deferred_property('_stat', doc="""Result of lstat(), or None if it failed""",
+                              pack=_pack_stat, unpack=_unpack_stat)
+    target_stat = _deferred_property('_target_stat', doc="""Result of stat() for a symbolic link""",
+                                     pack=_pack_stat, unpack=_unpack_stat)
+    stat_error = _deferred_property('_stat_error', doc="""Error message if stat failed""")
+    xaccess = _deferred_property('_xaccess', doc="""Whether the file is accessible for execution""")
+    stat_pending = property(lambda self: self._deferred is not None, doc="""Whether the stat is deferred; reading it loads it in the calling thread""")
+    type_hint = property(lambda self: self._typehint, doc="""Type from the directory entry: 'd', 'l', '-' for anything else, or None if unknown""")
+
+    __slots__ = ['fs', '_dirname', '_basename', '_hidden', '_icon', '_stat', '_xaccess', 'icon_error',
+                 '_permstring', '_target_stat', '_stat_error', '_deferred', '_typehint']
     def __init__(self, path, fs=None):
         super(File, self).__init__()
         if not isinstance(path, unicode):
             path = unicode(path, 'utf-8')
-        self._path = path
-        self._uri = 'file://' + urllib.pathname2url(path.encode(sys.getfilesystemencoding()))
-        self._basename = unix_basename(path)
+        basename = unix_basename(path)
+        split = len(path) - len(basename) - 1
+        if basename and split >= 0 and path[split] == '/':
+            self._dirname = _share_dirname(path[:split])
+            self._basename = basename
+        else:
+            # Not of the form dir/name; keep it whole
+            self._dirname = None
+            self._basename = path
         self.fs = fs
-        self.stat = None
-        self.xaccess = None
+        self._deferred = None
+        self._typehint = None
+        self._stat = None
+        self._xaccess = None
         self._hidden = None
         self._icon = None
         self.icon_error = False
         self._permstring = None
-        self.target_stat = None
-        self.stat_error = None
+        self._target_stat = None
+        self._stat_error = None
+
+    def __getstate__(self):
+        # Resolve a deferred stat rather than pickling the rest of its batch
+        self._resolve_stat()
+        state = {}
+        for klass in type(self).__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name,value in state.iteritems():
+            setattr(self, name, value)
+
+    def _get_path(self):
+        if self._dirname is None:
+            return self._basename
+        return self._dirname + u'/' + self._basename
+
+    def _get_basename(self):
+        if self._dirname is None:
+            return unix_basename(self._basename)
+        return self._basename
+
+    def _get_uri(self):
+        return 'file://' + urllib.pathname2url(self.path.encode(sys.getfilesystemencoding()))
+
+    def _get_packed_stat(self):
+        # What File's own properties read, rather than building a stat_result
+        deferred = self._deferred
+        if deferred is not None:
+            (batch, index) = deferred
+            batch.resolve(index)
+        return self._stat
 
     def test_directory(self, follow_link=True):
-        if not self.stat:
+        packed = self._get_packed_stat()
+        if not packed:
             return False
-        if follow_link and stat.S_ISLNK(self.stat[stat.ST_MODE]):
-            stbuf = self.target_stat
-        else:
-            stbuf = self.stat
-        return stbuf and stat.S_ISDIR(stbuf[stat.ST_MODE])
+        mode = _unpack_mode(packed)[0] & _S_IFMT
+        if follow_link and mode == stat.S_IFLNK:
+            packed = self._target_stat
+            if not packed:
+                return False
+            mode = _unpack_mode(packed)[0] & _S_IFMT
+        return mode == stat.S_IFDIR
     
+    def _get_is_directory(self):
+        # A link's type says nothing of its target
+        if self._deferred is not None and self._typehint in ('d', '-'):
+            return self._typehint == 'd'
+        return self.test_directory()
+
     def _is_link(self):
-        return self.stat and stat.S_ISLNK(self.stat[stat.ST_MODE])
+        if self._deferred is not None and self._typehint is not None:
+            return self._typehint == 'l'
+        packed = self._get_packed_stat()
+        return bool(packed) and (_unpack_mode(packed)[0] & _S_IFMT) == stat.S_IFLNK
     
     def _is_executable(self):
         return self.xaccess
 
     def _get_size(self):
-        if self.stat and stat.S_ISREG(self.stat[stat.ST_MODE]):
-            return self.stat[stat.ST_SIZE]
+        packed = self._get_packed_stat()
+        if packed:
+            (mode, size) = _unpack_mode_size(packed)
+            if (mode & _S_IFMT) == stat.S_IFREG:
+                return size
         return None
 
     def _get_mtime(self):
-        if self.stat:
-            return self.stat[stat.ST_MTIME]
+        packed = self._get_packed_stat()
+        if packed:
+            return int(_unpack_mtime(packed)[0])
         return None
     
     def _get_file_type_char(self):
@@ -231,7 +447,8 @@ class File(object):
         return '-'
     
     def _get_stat_mode(self):
-        return self.stat[stat.ST_MODE]
+        packed = self._get_packed_stat()
+        return packed and _unpack_mode(packed)[0]
 
     def _get_permissions_string(self):
         if self._permstring:
@@ -273,22 +490,49 @@ class File(object):
     def _get_mime(self):
         return None
 
-    def get_stat(self):
-        self._get_stat_async()
+    def get_stat(self, cb=None):
+        self._get_stat_async(cb)
 
-    def _get_stat_async(self):
-        MiniThreadPool.getInstance().run(self.__get_stat_signal)
+    def _get_stat_async(self, cb=None):
+        StatService.getInstance().request([self], cb or _dispatch_files_changed)
         
     def get_stat_sync(self):
-        self._do_get_stat(rethrow=True)
-        self._do_get_xaccess()
+        try:
+            self._do_get_stat(rethrow=True)
+            self._do_get_xaccess()
+        finally:
+            self._deferred = None
         self._do_get_hidden()
         self._do_get_icon()
 
+    def get_stat_deferred(self, batch, ftype=None):
+        """Like get_stat_sync, but only compute what is possible without a stat;
+the rest is filled in through batch when first accessed.  If ftype is known
+from the directory entry, as for type_hint, it answers is_directory and
+is_link in the meantime."""
+        self._deferred = (batch, batch.add(self))
+        self._typehint = ftype
+        self._do_get_hidden()
+
+    def _resolve_stat(self):
+        # Called with the batch lock held; _deferred is cleared only once the
+        # results are in place, so other threads wait on the lock until then
+        if self._deferred is None:
+            return
+        self._do_get_stat()
+        self._do_get_xaccess()
+        self._deferred = None
+
+    def _get_icon(self):
+        if self._icon is None:
+            self._do_get_icon()
+        return self._icon
+
     def _do_get_stat(self, rethrow=False):
         try:
-            self.stat = hasattr(os, 'lstat') and os.lstat(self.path) or os.stat(self.path)
-            if stat.S_ISLNK(self.stat[stat.ST_MODE]):
+            st = hasattr(os, 'lstat') and os.lstat(self.path) or os.stat(self.path)
+            self.stat = st
+            if stat.S_ISLNK(st.st_mode):
                 try:
                     self.target_stat = os.stat(self.path)
                 except OSError, e:
@@ -306,22 +550,124 @@ class File(object):
         pass 
         
     def _do_get_icon(self):
-        if not self.stat:
+        if self._deferred is not None and self._typehint in ('d', '-'):
+            self._icon = (self._typehint == 'd') and 'gtk-directory' or 'gtk-file'
+        elif not self.stat:
             self._icon = 'gtk-dialog-error'
         elif self.is_directory:
             self._icon = 'gtk-directory'
         else:
             self._icon = 'gtk-file'
 
+def _dispatch_files_changed(files):
+    for fobj in files:
+        responses = dispatcher.send(sender=fobj)
+        _logger.debug("changed dispatch from %r, responses=%r", fobj, responses)
+
+class StatService(Singleton):
+    """Loads stat data for File objects in the background.  Requests are
+grouped by directory and handled by a few MiniThreadPool jobs, and the
+results are delivered to the main loop in coalesced batches."""
+
+    # Maximum number of pool jobs working on requests at once
+    MAX_WORKERS = 3
+    # Maximum number of files from one directory a job takes at a time
+    BATCH_SIZE = 256
+    # Milliseconds to coalesce results before delivering them
+    LATENCY = 100
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Directory path -> list of (File, callback) pairs waiting for a stat
+        self.__pending = {}
+        self.__pending_dirs = []
+        self.__workers = 0
+        # Callback -> list of Files, ready for delivery
+        self.__completed = {}
+        self.__deliver_id = 0
+
+    def request(self, files, cb):
+        """Load stat data for each of files; cb(files) is called later from
+the main loop, possibly several times, with the files that are done."""
+        self.__lock.acquire()
+        try:
+            for fobj in files:
+                dpath = os.path.dirname(fobj.path)
+                if dpath not in self.__pending:
+                    self.__pending[dpath] = []
+                    self.__pending_dirs.append(dpath)
+                self.__pending[dpath].append((fobj, cb))
+            while self.__pending_dirs and self.__workers < self.MAX_WORKERS:
+                self.__workers += 1
+                MiniThreadPool.getInstance().run(self.__process, priority=MiniThreadPool.PRIORITY_BULK)
+        finally:
+            self.__lock.release()
+
+    def __pop_batch(self):
+        self.__lock.acquire()
+        try:
+            if not self.__pending_dirs:
+                return None
+            dpath = self.__pending_dirs[0]
+            items = self.__pending[dpath]
+            batch = items[:self.BATCH_SIZE]
+            del items[:self.BATCH_SIZE]
+            if not items:
+                del self.__pending[dpath]
+                self.__pending_dirs.pop(0)
+            return batch
+        finally:
+            self.__lock.release()
+
     @log_except(_logger)
-    def __get_stat_signal(self):
-        self.get_stat_sync()
-        gobject.idle_add(self.__idle_emit_changed, priority=gobject.PRIORITY_LOW)        
-        
+    def __process(self):
+        try:
+            self.__process_batches()
+        finally:
+            self.__lock.acquire()
+            try:
+                self.__workers -= 1
+                # A request may have arrived while we were leaving, or we failed
+                if self.__pending_dirs and self.__workers < self.MAX_WORKERS:
+                    self.__workers += 1
+                    MiniThreadPool.getInstance().run(self.__process, priority=MiniThreadPool.PRIORITY_BULK)
+            finally:
+                self.__lock.release()
+
+    def __process_batches(self):
+        while True:
+            batch = self.__pop_batch()
+            if batch is None:
+                return
+            for (fobj, cb) in batch:
+                try:
+                    fobj.get_stat_sync()
+                except FileStatError, e:
+                    pass
+                except:
+                    # Still deliver it, and the rest of the batch
+                    _logger.exception("Failed to stat %r", fobj.path)
+            self.__lock.acquire()
+            try:
+                for (fobj, cb) in batch:
+                    if cb not in self.__completed:
+                        self.__completed[cb] = []
+                    self.__completed[cb].append(fobj)
+                if self.__deliver_id == 0:
+                    self.__deliver_id = gobject.timeout_add(self.LATENCY, self.__deliver, priority=gobject.PRIORITY_LOW)
+            finally:
+                self.__lock.release()
+
     @log_except(_logger)
-    def __idle_emit_changed(self):
-        responses = dispatcher.send(sender=self)
-        _logger.debug("idle changed dispatch from %r, responses=%r", self, responses)
+    def __deliver(self):
+        self.__lock.acquire()
+        completed = self.__completed
+        self.__completed = {}
+        self.__deliver_id = 0
+        self.__lock.release()
+        for cb,files in completed.iteritems():
+            cb(files)
+        return False
         
 class BaseBookmarks(Singleton):
     def __init__(self):
@@ -29,7 +29,7 @@ try:
 except:
     have_gnomedesktop = False
 
-from hotwire.sysdep.fs import FileStatError
+from hotwire.sysdep.fs import FileStatError, _deferred_property
 from hotwire.sysdep.fs_impl.fs_unix import UnixFilesystem, UnixFile
 from hotwire_ui.pixbufcache import PixbufCache
 
@@ -39,12 +39,15 @@ class GnomeVfsFile(UnixFile):
     """A File implementation based on the GnomeVFS virtual filesystem.
 Important members include the "vfsstat" and "uri"."""
     
-    __slots__ = ['vfsstat', 'target_vfsstat']
+    vfsstat = _deferred_property('_vfsstat')
+    target_vfsstat = _deferred_property('_target_vfsstat')
+
+    __slots__ = ['_vfsstat', '_target_vfsstat', 'target_vfsstat_error']
 
     def __init__(self, path, **kwargs):
         super(GnomeVfsFile, self).__init__(path, **kwargs)
-        self.vfsstat = None
-        self.target_vfsstat = None
+        self._vfsstat = None
+        self._target_vfsstat = None
         self.target_vfsstat_error = None 
 
     def test_directory(self, follow_link=True):
@@ -122,7 +125,7 @@ class GnomeVfsMonitor(object):
   
     def __idle_emit(self):
         self.__idle_id = 0
-        self.__cb()
+        self.__cb([self.__path])
 
     def __on_vfsmon(self, *args):
         if not self.__monid:
@@ -19,16 +19,351 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,stat
+import os,sys,stat,errno,struct,time,logging,threading
 
-from hotwire.fs import unix_basename
-from hotwire.sysdep.fs import BaseFilesystem, File
+import gobject
+
+from hotwire.fs import unix_basename, path_join
+from hotwire.sysdep.fs import BaseFilesystem, File, _unpack_owner
 from hotwire.sysdep.unix import getpwuid_cached, getgrgid_cached
+from hotwire.logutil import log_except
+
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+except (ImportError, OSError, AttributeError), e:
+    _libc = None
+
+# Directory entries with their types, from readdir64(), whose struct dirent64
+# has the same layout on all Linux architectures
+try:
+    import ctypes, ctypes.util
+    class _Dirent64(ctypes.Structure):
+        _fields_ = [('d_ino', ctypes.c_uint64), ('d_off', ctypes.c_int64),
+                    ('d_reclen', ctypes.c_ushort), ('d_type', ctypes.c_ubyte),
+                    ('d_name', ctypes.c_char * 256)]
+    _dirlib = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _dirlib.opendir.argtypes = [ctypes.c_char_p]
+    _dirlib.opendir.restype = ctypes.c_void_p
+    _dirlib.readdir64.argtypes = [ctypes.c_void_p]
+    _dirlib.readdir64.restype = ctypes.POINTER(_Dirent64)
+    _dirlib.closedir.argtypes = [ctypes.c_void_p]
+    if not sys.platform.startswith('linux'):
+        _dirlib = None
+except (ImportError, OSError, AttributeError), e:
+    _dirlib = None
+
+# From <dirent.h>; DT_UNKNOWN (0) means the filesystem doesn't say
+DT_DIR = 4
+DT_LNK = 10
+DT_UNKNOWN = 0
+
+def _readdir_typed(dpath):
+    """Generate (path, type) pairs for the files in directory dpath, as for
+BaseFilesystem._iterd_typed, with the types taken from readdir()."""
+    dpath = unicode(dpath)
+    encoding = sys.getfilesystemencoding()
+    dirp = _dirlib.opendir(dpath.encode(encoding))
+    if not dirp:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), dpath)
+    try:
+        while True:
+            ctypes.set_errno(0)
+            entp = _dirlib.readdir64(dirp)
+            if not entp:
+                err = ctypes.get_errno()
+                if err:
+                    raise OSError(err, os.strerror(err), dpath)
+                return
+            entry = entp.contents
+            name = entry.d_name
+            if name == '.' or name == '..':
+                continue
+            try:
+                # Undecodable names stay bytes, as from os.listdir()
+                name = unicode(name, encoding)
+            except UnicodeDecodeError, e:
+                pass
+            d_type = entry.d_type
+            if d_type == DT_DIR:
+                ftype = 'd'
+            elif d_type == DT_LNK:
+                ftype = 'l'
+            elif d_type == DT_UNKNOWN:
+                ftype = None
+            else:
+                ftype = '-'
+            yield (path_join(dpath, name), ftype)
+    finally:
+        _dirlib.closedir(dirp)
+
+_logger = logging.getLogger("hotwire.sysdep.UnixFilesystem")
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+_IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+                 | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_inotify_event = struct.Struct('iIII')
+
+def _get_max_user_watches():
+    try:
+        f = open('/proc/sys/fs/inotify/max_user_watches')
+        try:
+            return int(f.read())
+        finally:
+            f.close()
+    except (IOError, ValueError), e:
+        return 8192
+
+class InotifyMonitor(object):
+    """A subscription to changes of a file or directory; see InotifyService."""
+    path = property(lambda self: self._path)
+    dirpath = property(lambda self: self._dirpath)
+
+    def __init__(self, service, path, dirpath, cb):
+        super(InotifyMonitor, self).__init__()
+        self._service = service
+        self._path = path
+        self._dirpath = dirpath
+        self._cb = cb
+
+    def cancel(self):
+        if self._service is not None:
+            self._service.remove(self)
+            self._service = None
+
+class InotifyService(object):
+    """Watches for file changes through a single inotify descriptor, read
+from the main loop.  Watches are per directory; monitoring a file watches its
+parent, so that replacing the file by renaming over it is seen.  Events are
+coalesced until things are quiet for QUIET_TIMEOUT milliseconds, or at most
+MAX_DELAY, and each monitor's callback then gets the changed paths at once.
+Monitors may be added and cancelled from any thread; callbacks are called from
+the main loop.  At most max_watches directories are watched, by default half
+the per-user limit, so that other programs can still watch files."""
+
+    QUIET_TIMEOUT = 100
+    MAX_DELAY = 1000
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, max_watches=None):
+        super(InotifyService, self).__init__()
+        if max_watches is None:
+            max_watches = _get_max_user_watches() // 2
+        self.__max_watches = max_watches
+        self.__limit_warned = False
+        self.__fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.__io_id = gobject.io_add_watch(self.__fd, gobject.IO_IN, self.__on_readable)
+        # Guards the watch and monitor tables and the recorded changes
+        self.__lock = threading.Lock()
+        # Watch descriptor -> directory path, and directory path -> descriptor
+        self.__wd_dirs = {}
+        self.__dir_wds = {}
+        # Directory path -> list of InotifyMonitor
+        self.__monitors = {}
+        # Directory path -> set of changed paths within it
+        self.__changed = {}
+        self.__first_event = 0
+        self.__last_event = 0
+        self.__timeout_id = 0
+
+    def add(self, path, cb):
+        """Return a monitor calling cb(paths) with the changed paths under path,
+which may be a file or directory.  Raises NotImplementedError if the watch
+limit is reached."""
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            dirpath = path
+        else:
+            dirpath = os.path.dirname(path)
+        self.__lock.acquire()
+        try:
+            if dirpath not in self.__dir_wds:
+                if len(self.__dir_wds) >= self.__max_watches:
+                    self.__warn_limit("watching %d directories" % (len(self.__dir_wds),))
+                    raise NotImplementedError()
+                if isinstance(dirpath, unicode):
+                    native_dirpath = dirpath.encode(sys.getfilesystemencoding())
+                else:
+                    native_dirpath = dirpath
+                wd = _libc.inotify_add_watch(self.__fd, native_dirpath, _IN_WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.ENOSPC:
+                        self.__warn_limit(os.strerror(err))
+                        raise NotImplementedError()
+                    _logger.debug("Failed to watch %r: %s", dirpath, os.strerror(err))
+                else:
+                    self.__wd_dirs[wd] = dirpath
+                    self.__dir_wds[dirpath] = wd
+            monitor = InotifyMonitor(self, path, dirpath, cb)
+            self.__monitors.setdefault(dirpath, []).append(monitor)
+        finally:
+            self.__lock.release()
+        return monitor
+
+    def __warn_limit(self, reason):
+        # Called with __lock held
+        if not self.__limit_warned:
+            self.__limit_warned = True
+            _logger.warn("Not watching any more directories for changes: %s", reason)
+
+    def remove(self, monitor):
+        dirpath = monitor.dirpath
+        self.__lock.acquire()
+        try:
+            monitors = self.__monitors.get(dirpath, [])
+            if monitor in monitors:
+                monitors.remove(monitor)
+            if monitors:
+                return
+            self.__monitors.pop(dirpath, None)
+            self.__changed.pop(dirpath, None)
+            wd = self.__dir_wds.pop(dirpath, None)
+            if wd is not None:
+                del self.__wd_dirs[wd]
+                _libc.inotify_rm_watch(self.__fd, wd)
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        gobject.source_remove(self.__io_id)
+        if self.__timeout_id:
+            gobject.source_remove(self.__timeout_id)
+            self.__timeout_id = 0
+        os.close(self.__fd)
+
+    def process_events(self):
+        """Read and record the pending events, without blocking."""
+        while True:
+            try:
+                buf = os.read(self.__fd, self.READ_SIZE)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    _logger.debug("Failed to read inotify events", exc_info=True)
+                return
+            if not buf:
+                return
+            self.__lock.acquire()
+            try:
+                self.__parse_events(buf)
+            finally:
+                self.__lock.release()
+
+    def __parse_events(self, buf):
+        # Called with __lock held
+        now = time.time()
+        if not self.__changed:
+            self.__first_event = now
+        self.__last_event = now
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, cookie, namelen) = _inotify_event.unpack_from(buf, offset)
+            offset += _inotify_event.size
+            name = buf[offset:offset+namelen].rstrip('\0')
+            offset += namelen
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; everything counts as changed
+                for dirpath in self.__monitors:
+                    self.__changed.setdefault(dirpath, set()).add(dirpath)
+                continue
+            dirpath = self.__wd_dirs.get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_IGNORED:
+                # The directory went away; so did the watch
+                del self.__wd_dirs[wd]
+                del self.__dir_wds[dirpath]
+            if name:
+                path = os.path.join(dirpath, unicode(name, sys.getfilesystemencoding(), 'replace'))
+            else:
+                path = dirpath
+            self.__changed.setdefault(dirpath, set()).add(path)
+
+    def flush(self):
+        """Notify monitors of the changes recorded so far."""
+        self.__lock.acquire()
+        changed = self.__changed
+        self.__changed = {}
+        # Call back without the lock, so callbacks can add and cancel monitors
+        notify = [(dirpath, paths, list(self.__monitors.get(dirpath, [])))
+                  for (dirpath, paths) in changed.iteritems()]
+        self.__lock.release()
+        for (dirpath, paths, monitors) in notify:
+            for monitor in monitors:
+                if monitor.path == dirpath:
+                    matches = paths
+                elif monitor.path in paths or dirpath in paths:
+                    matches = [monitor.path]
+                else:
+                    continue
+                try:
+                    monitor._cb(sorted(matches))
+                except:
+                    _logger.exception("Failed to notify monitor for %r", monitor.path)
+
+    @log_except(_logger)
+    def __on_readable(self, fd, condition):
+        self.process_events()
+        if self.__changed and self.__timeout_id == 0:
+            self.__timeout_id = gobject.timeout_add(self.QUIET_TIMEOUT, self.__on_timeout)
+        return True
+
+    @log_except(_logger)
+    def __on_timeout(self):
+        now = time.time()
+        if (now - self.__last_event) * 1000 < self.QUIET_TIMEOUT \
+               and (now - self.__first_event) * 1000 < self.MAX_DELAY:
+            return True
+        self.__timeout_id = 0
+        self.flush()
+        return False
 
 class UnixFilesystem(BaseFilesystem):
     def __init__(self):
         super(UnixFilesystem, self).__init__()
         self.fileklass = UnixFile         
+        self.__inotify = None
+        self.__inotify_lock = threading.Lock()
+
+    def get_monitor(self, path, cb):
+        if _libc is None:
+            raise NotImplementedError()
+        self.__inotify_lock.acquire()
+        try:
+            if self.__inotify is None:
+                try:
+                    self.__inotify = InotifyService()
+                except OSError, e:
+                    _logger.debug("Failed to initialize inotify", exc_info=True)
+                    raise NotImplementedError()
+        finally:
+            self.__inotify_lock.release()
+        return self.__inotify.add(path, cb)
+
+    def _iterd_typed(self, dir):
+        if _dirlib is None:
+            return super(UnixFilesystem, self)._iterd_typed(dir)
+        return _readdir_typed(dir)
         
     def _get_conf_dir_path(self):
         return os.path.expanduser(u'~/.hotwire')
@@ -61,15 +396,19 @@ class UnixFile(File):
     group = property(lambda self: self._get_gid(), doc="""Group GID""")
     owner_name = property(lambda self: self._get_owner(), doc="""Owner name""")
     group_name = property(lambda self: self._get_group(), doc="""Group name""")    
+
+    __slots__ = []
     
     def __init__(self, *args, **kwargs):
         super(UnixFile, self).__init__(*args, **kwargs)
   
     def _get_uid(self):
-        return self.stat and self.stat.st_uid
+        packed = self._get_packed_stat()
+        return packed and _unpack_owner(packed)[0]
     
     def _get_gid(self):
-        return self.stat and self.stat.st_gid
+        packed = self._get_packed_stat()
+        return packed and _unpack_owner(packed)[1]
     
     def _get_file_type_char(self):
         stmode = self.stat_mode
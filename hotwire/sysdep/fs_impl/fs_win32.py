@@ -22,7 +22,7 @@
 import os,sys,subprocess,logging, stat
 
 from hotwire.fs import path_normalize, unix_basename
-from hotwire.sysdep.fs import File, BaseFilesystem,iterd_sorted, FileStatError
+from hotwire.sysdep.fs import File, BaseFilesystem, iterd, iterd_sorted, FileStatError
 from hotwire.sysdep.win32 import win_exec_re, msvcrt
 import win32api, win32con
 import os.path
@@ -65,8 +65,9 @@ class Win32Filesystem(BaseFilesystem):
         super(Win32Filesystem, self).__init__()
         self.fileklass = Win32File
 
-    def ls_dir(self, dir, show_all):
-        for x in iterd_sorted(dir):
+    def ls_dir(self, dir, show_all, sort=True, resolve=False):
+        # Hidden files are found by attribute, so everything is stat'ed here
+        for x in (sort and iterd_sorted(dir) or iterd(dir)):
             try:
                 if show_all:
                     yield self.get_file_sync(x)
@@ -111,6 +112,8 @@ class Win32Filesystem(BaseFilesystem):
             raise NotImplementedError()
     
 class Win32File(File):
+    __slots__ = []
+
     def __init__(self, *args, **kwargs):
         super(Win32File, self).__init__(*args, **kwargs)
         
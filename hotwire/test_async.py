@@ -0,0 +1,159 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import unittest, threading, time
+
+from hotwire.async import MiniThreadPool, GroupThreadPool, DeadlineTimer
+
+class MiniThreadPoolTests(unittest.TestCase):
+    def setUp(self):
+        self._pool = MiniThreadPool.getInstance()
+        self._max_threads = self._pool.get_max_threads()
+        self._gate = threading.Event()
+        self._order = []
+        self._lock = threading.Lock()
+
+    def tearDown(self):
+        self._gate.set()
+        self._pool.set_max_threads(self._max_threads)
+        self._pool = None
+
+    def __block(self):
+        self._gate.wait()
+
+    def __record(self, name):
+        self._lock.acquire()
+        self._order.append(name)
+        self._lock.release()
+
+    def __fill_pool(self, priority):
+        for i in xrange(self._pool.get_max_threads()):
+            self._pool.run(self.__block, priority=priority)
+        time.sleep(0.1)
+
+    def __wait_recorded(self, count):
+        for i in xrange(50):
+            if len(self._order) >= count:
+                return
+            time.sleep(0.05)
+
+    def testCancel(self):
+        self.__fill_pool(MiniThreadPool.PRIORITY_DEFAULT)
+        serial = self._pool.run(self.__record, args=('cancelled',))
+        self.assertEquals(self._pool.get_queue_depths()['default'], 1)
+        self.assertTrue(self._pool.cancel(serial))
+        self.assertFalse(self._pool.cancel(serial))
+        self._gate.set()
+        time.sleep(0.1)
+        self.assertEquals(self._order, [])
+
+    def testPriority(self):
+        self.__fill_pool(MiniThreadPool.PRIORITY_DEFAULT)
+        self._pool.run(self.__record, args=('bulk',), priority=MiniThreadPool.PRIORITY_BULK)
+        self._pool.run(self.__record, args=('default',))
+        self._pool.run(self.__record, args=('interactive',), priority=MiniThreadPool.PRIORITY_INTERACTIVE)
+        depths = self._pool.get_queue_depths()
+        self.assertEquals(depths, {'interactive': 1, 'default': 1, 'bulk': 1})
+        self._pool.set_max_threads(self._pool.get_max_threads() + 1)
+        self._pool.run(self.__record, args=('last-bulk',), priority=MiniThreadPool.PRIORITY_BULK)
+        self.__wait_recorded(1)
+        self.assertEquals(self._order[0], 'interactive')
+        self._gate.set()
+        self.__wait_recorded(4)
+        self.assertEquals(len(self._order), 4)
+
+    def testBulkReserve(self):
+        self.__fill_pool(MiniThreadPool.PRIORITY_BULK)
+        self._pool.run(self.__record, args=('interactive',), priority=MiniThreadPool.PRIORITY_INTERACTIVE)
+        self.__wait_recorded(1)
+        self.assertEquals(self._order, ['interactive'])
+
+class GroupThreadPoolTests(unittest.TestCase):
+    def setUp(self):
+        self._pool = GroupThreadPool.getInstance()
+        self._max_threads = self._pool.get_max_threads()
+        self._gate = threading.Event()
+        self._done = []
+
+    def tearDown(self):
+        self._gate.set()
+        self._pool.set_max_threads(self._max_threads)
+        self._pool = None
+
+    def __block(self):
+        self._gate.wait()
+
+    def __wait_done(self, count):
+        for i in xrange(50):
+            if len(self._done) >= count:
+                return
+            time.sleep(0.05)
+
+    def testGroup(self):
+        # Members of a group must run concurrently; this would deadlock otherwise
+        evt = threading.Event()
+        def waiter():
+            evt.wait()
+            self._done.append('waiter')
+        def setter():
+            evt.set()
+            self._done.append('setter')
+        self._pool.set_max_threads(2)
+        self._pool.run_group([waiter, setter])
+        self.__wait_done(2)
+        self.assertEquals(sorted(self._done), ['setter', 'waiter'])
+
+    def testAdmission(self):
+        self._pool.set_max_threads(2)
+        self._pool.run_group([self.__block, self.__block])
+        self._pool.run_group([lambda: self._done.append('queued')])
+        time.sleep(0.1)
+        self.assertEquals(self._pool.get_queue_depth(), 1)
+        self.assertEquals(self._done, [])
+        self._pool.run_group([lambda: self._done.append('nowait')], wait=False)
+        self.__wait_done(1)
+        self.assertEquals(self._done, ['nowait'])
+        self._gate.set()
+        self.__wait_done(2)
+        self.assertEquals(self._done, ['nowait', 'queued'])
+        self.assertEquals(self._pool.get_queue_depth(), 0)
+
+    def testAdmitTimeout(self):
+        # The running group never finishes, so the queued one must not wait on it
+        self._pool.set_max_threads(2)
+        self._pool.run_group([self.__block, self.__block])
+        self._pool.run_group([lambda: self._done.append('queued')])
+        time.sleep(0.1)
+        self.assertEquals(self._done, [])
+        self.__wait_done(1)
+        self.assertEquals(self._done, ['queued'])
+        self.assertEquals(self._pool.get_queue_depth(), 0)
+
+class DeadlineTimerTests(unittest.TestCase):
+    def testOrder(self):
+        fired = []
+        done = threading.Event()
+        timer = DeadlineTimer.getInstance()
+        now = time.time()
+        timer.call_at(now + 0.2, lambda: (fired.append('late'), done.set()))
+        timer.call_at(now + 0.05, lambda: fired.append('early'))
+        timer.call_at(now - 1, lambda: fired.append('past'))
+        done.wait(2)
+        self.assertEquals(fired, ['past', 'early', 'late'])
@@ -20,14 +20,18 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, sys, unittest, tempfile, shutil
+import os, sys, re, stat, unittest, tempfile, shutil, Queue, threading, time
 
 import hotwire
 from hotwire.command import *
 from hotwire.sysdep import is_windows, is_unix
-from hotwire.sysdep.fs import File
+from hotwire.sysdep.fs import File, Filesystem, StatService
+from hotwire.resultcache import ResultCache, get_validators
+from hotwire.procpool import ProcessPool, ProcessPoolError
+from hotwire.textindex import TrigramIndex, TrigramIndexService
+from hotwire.externals.glob2 import expand_braces
 import hotwire.script
-from hotwire.fs import unix_basename, path_join, path_abs, path_dirname, path_fastnormalize
+from hotwire.fs import unix_basename, path_join, path_abs, path_dirname, path_fastnormalize, path_unabs
 
 class PipelineParserTests(unittest.TestCase):
     def setUp(self):
@@ -136,6 +140,44 @@ class PipelineParserTests(unittest.TestCase):
         self.assertEquals(len(pt), 2)
         self.assertEquals(pt[1].text, 'foo@bar')
 
+    def __assertTokensEqual(self, tokens, text):
+        expected = list(Pipeline.tokenize(text, self._context))
+        self.assertEquals(len(tokens), len(expected))
+        for (a, b) in zip(tokens, expected):
+            if isinstance(b, ParsedToken):
+                self.assertEquals((a.text, a.start, a.end, a.quoted), (b.text, b.start, b.end, b.quoted))
+            else:
+                self.assertEquals(a, b)
+
+    def testIncremental1(self):
+        tokenizer = IncrementalTokenizer()
+        text = u''
+        for c in "sys echo 'foo  bar' baz|filter b > out":
+            text += c
+            if text.count("'") == 1:
+                self.assertRaises(PipelineParseException, lambda: tokenizer.tokenize(text))
+            else:
+                self.__assertTokensEqual(tokenizer.tokenize(text), text)
+        self.assert_(tokenizer.lexed < 5)
+
+    def testIncremental2(self):
+        tokenizer = IncrementalTokenizer()
+        tokenizer.tokenize('ls foo.py bar.py | filter x')
+        pt = tokenizer.tokenize('ls foo.py baz.py | filter x')
+        self.__assertTokensEqual(pt, 'ls foo.py baz.py | filter x')
+        self.assertEquals(tokenizer.lexed, len('baz.py | filter x'))
+        pt = tokenizer.tokenize('ls foo.py')
+        self.__assertTokensEqual(pt, 'ls foo.py')
+        self.assertRaises(PipelineParseException, lambda: tokenizer.tokenize('ls "foo'))
+        self.__assertTokensEqual(tokenizer.tokenize('ls foo'), 'ls foo')
+
+class GlobTests(unittest.TestCase):
+    def testBraces(self):
+        self.assertEquals(expand_braces('a{b,c{d,e}}f'), ['abf', 'acdf', 'acef'])
+        self.assertEquals(expand_braces('{x}{a,b}'), ['{x}a', '{x}b'])
+        self.assertEquals(expand_braces('*.{c,h}'), ['*.c', '*.h'])
+        self.assertEquals(expand_braces('a{b'), ['a{b'])
+
 class PipelineInstantiateTests(unittest.TestCase):
     def setUp(self):
         self._context = HotwireContext()
@@ -357,13 +399,236 @@ class PipelineRunTests(PipelineRunTestFramework):
         p = Pipeline.parse("ls *test*", self._context)
         p.execute_sync()
         results = list(p.get_output())
-        results.sort()
+        results.sort(key=lambda f: f.path)
         self.assertEquals(len(results), 2)
         self.assertEquals(os.path.dirname(results[0].path), self._tmpd)
         self.assertEquals(unix_basename(results[0].path), 'testdir')
         self.assertEquals(os.path.dirname(results[1].path), self._tmpd)
         self.assertEquals(unix_basename(results[1].path), 'testf')
 
+    def testLsRecursiveGlob(self):
+        self._setupTree2()
+        os.mkdir(path_join(self._tmpd, 'testdir2', 'sub'))
+        open(path_join(self._tmpd, 'testdir2', 'sub', 'blah2'), 'w').close()
+        p = Pipeline.parse("ls **/blah*", self._context)
+        p.execute_sync()
+        results = [f.path for f in p.get_output()]
+        results.sort()
+        self.assertEquals(results, [path_join(self._tmpd, 'testdir2', 'blah'),
+                                    path_join(self._tmpd, 'testdir2', 'sub', 'blah2')])
+
+    def testLsBraceGlob(self):
+        self._setupTree2()
+        p = Pipeline.parse("ls {testf,f3*,nosuchfile}", self._context)
+        p.execute_sync()
+        results = [unix_basename(f.path) for f in p.get_output()]
+        self.assertEquals(results, ['f3test', 'testf'])
+
+    def testLsDeferredStat(self):
+        self._setupTree1()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('hello')
+        f.close()
+        p = Pipeline.parse("ls", self._context)
+        p.execute_sync()
+        results = dict([(unix_basename(f.path), f) for f in p.get_output()])
+        # Removed after listing; the stat error shows up when first needed
+        os.rmdir(path_join(self._tmpd, 'dir with spaces'))
+        for fobj in results.itervalues():
+            self.assert_(fobj.stat_pending)
+        self.assertEquals(results['testf'].size, 5)
+        self.assert_(not results['testf'].is_directory)
+        self.assert_(results['testdir'].is_directory)
+        self.assertEquals(results['testdir'].icon, 'gtk-directory')
+        self.assertEquals(results['dir with spaces'].stat, None)
+        self.assert_(results['dir with spaces'].stat_error)
+
+    def testLsTypes(self):
+        self._setupTree1()
+        os.symlink('testdir', path_join(self._tmpd, 'link'))
+        fs = Filesystem.getInstance()
+        results = dict([(unix_basename(f.path), f) for f in fs.ls_dir(self._tmpd, False)])
+        types = dict([(name, (fobj.type_hint, fobj.is_link)) for (name, fobj) in results.iteritems()])
+        if types['testf'][0] is None:
+            # No directory entry types here
+            return
+        self.assertEquals(types, {'testf': ('-', False), 'testdir': ('d', False),
+                                  'dir with spaces': ('d', False), 'link': ('l', True)})
+        self.assert_(results['testdir'].is_directory)
+        self.assertEquals(results['testf'].icon, 'gtk-file')
+        for fobj in results.itervalues():
+            self.assert_(fobj.stat_pending)
+        self.assert_(results['link'].is_directory)
+        self.assert_(not results['link'].stat_pending)
+
+    def testLsUnordered(self):
+        self._setupTree1()
+        p = Pipeline.parse("ls", self._context)
+        p.execute_sync(ordered=False)
+        results = [unix_basename(f.path) for f in p.get_output()]
+        results.sort()
+        self.assertEquals(results, ['dir with spaces', 'testdir', 'testf'])
+        self.assert_(p.get_profile()[0].first_output_time is not None)
+
+    def __walk(self, text):
+        p = Pipeline.parse(text, self._context)
+        p.execute_sync()
+        results = [path_unabs(f.path, self._tmpd) for f in p.get_output()]
+        results.sort()
+        return results
+
+    def testWalk(self):
+        self._setupTree2()
+        os.mkdir(path_join(self._tmpd, 'testdir2', '.hidden'))
+        open(path_join(self._tmpd, 'testdir2', '.hidden', 'h'), 'w').close()
+        open(path_join(self._tmpd, 'testdir2', '.h2'), 'w').close()
+        self.assertEquals(self.__walk("walk"),
+                          ['f3test', 'otherfile', 'testdir2/blah', 'testf', 'testf2'])
+        self.assertEquals(self.__walk("walk -a testdir2"),
+                          ['testdir2/.h2', 'testdir2/.hidden/h', 'testdir2/blah'])
+
+    def testWalkDepth(self):
+        self._setupTree2()
+        self.assertEquals(self.__walk("walk . 1"), ['f3test', 'otherfile', 'testf', 'testf2'])
+
+    def testWalkGitignore(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, '.gitignore'), 'w')
+        f.write('f3*\ntestdir2/\n')
+        f.close()
+        f = open(path_join(self._tmpd, 'testdir', '.gitignore'), 'w')
+        f.write('*.o\n!keep.o\n')
+        f.close()
+        open(path_join(self._tmpd, 'testdir', 'a.o'), 'w').close()
+        open(path_join(self._tmpd, 'testdir', 'keep.o'), 'w').close()
+        self.assertEquals(self.__walk("walk -g"),
+                          ['otherfile', 'testdir/keep.o', 'testf', 'testf2'])
+
+    def testFind(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testdir2', 'big'), 'w')
+        f.write('x' * 2000)
+        f.close()
+        self.assertEquals(self.__walk("find test"), ['f3test', 'testdir', 'testdir2', 'testf', 'testf2'])
+        self.assertEquals(self.__walk("find 'test*' type=f"), ['testf', 'testf2'])
+        self.assertEquals(self.__walk("find -r '^[bf]'"), ['f3test', 'testdir2/big', 'testdir2/blah'])
+        self.assertEquals(self.__walk("find -i BI size+1k"), ['testdir2/big'])
+        os.mkdir(path_join(self._tmpd, 'testdir', 'sub'))
+        open(path_join(self._tmpd, 'testdir', 'sub', 'testnew'), 'w').close()
+        shutil.rmtree(path_join(self._tmpd, 'testdir2'))
+        self.assertEquals(self.__walk("find -u new"), ['testdir/sub/testnew'])
+        self.assertEquals(self.__walk("find bl"), [])
+
+    def testFindModified(self):
+        self._setupTree2()
+        big = path_join(self._tmpd, 'testdir2', 'big')
+        f = open(big, 'w')
+        f.write('x' * 2000)
+        f.close()
+        past = time.time() - 60
+        os.utime(path_join(self._tmpd, 'testdir2'), (past, past))
+        os.utime(big, (past, past))
+        self.assertEquals(self.__walk("find -u size+1k type=f"), ['testdir2/big'])
+        self.assertEquals(self.__walk("find big mtime-10s"), [])
+        # Edited in place; the directory doesn't change
+        open(big, 'w').close()
+        self.assertEquals(self.__walk("find size+1k type=f"), [])
+        self.assertEquals(self.__walk("find big mtime-10s"), ['testdir2/big'])
+        f = open(big, 'w')
+        f.write('x' * 2000)
+        f.close()
+        self.assertEquals(self.__walk("find size+1k type=f"), ['testdir2/big'])
+
+    def testFindHidden(self):
+        self._setupTree2()
+        os.mkdir(path_join(self._tmpd, '.hdir'))
+        open(path_join(self._tmpd, '.hdir', 'testh'), 'w').close()
+        open(path_join(self._tmpd, 'testdir', '.testh2'), 'w').close()
+        self.assertEquals(self.__walk("find testh"), [])
+        self.assertEquals(self.__walk("find -a testh"), ['.hdir/testh', 'testdir/.testh2'])
+        self.assertEquals(self.__walk("find -a 'test*' type=f"), ['.hdir/testh', 'testf', 'testf2'])
+
+    def testFsearch(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('hello\nfoo world\n\nfoo again')
+        f.close()
+        f = open(path_join(self._tmpd, 'testdir2', 'blah'), 'w')
+        f.write('\0binary foo')
+        f.close()
+        f = open(path_join(self._tmpd, 'testdir', 'x'), 'w')
+        f.write('\xc3\xa9 FOO')
+        f.close()
+        p = Pipeline.parse("fsearch -i foo", self._context)
+        p.execute_sync()
+        results = [(unix_basename(m.path), m.line_num, m.line, m.match_start, m.match_end) for m in p.get_output()]
+        results.sort()
+        self.assertEquals(results, [('testf', 1, 'foo world', 0, 3),
+                                    ('testf', 3, 'foo again', 0, 3),
+                                    ('x', 0, u'\xe9 FOO', 2, 5)])
+        p = Pipeline.parse("fsearch -l foo", self._context)
+        p.execute_sync()
+        results = [(unix_basename(m.path), m.line_num) for m in p.get_output()]
+        self.assertEquals(results, [('testf', 1)])
+
+    def testFsearchLines(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('x foo\n  bar\nfoo  bar z')
+        f.close()
+        p = Pipeline.parse("fsearch 'foo\s+bar'", self._context)
+        p.execute_sync()
+        results = [(m.line_num, m.line, m.match_start, m.match_end) for m in p.get_output()]
+        self.assertEquals(results, [(2, 'foo  bar z', 0, 8)])
+        p = Pipeline.parse("fsearch '[^z]*z'", self._context)
+        p.execute_sync()
+        results = [(m.line_num, m.line, m.match_start, m.match_end) for m in p.get_output()]
+        self.assertEquals(results, [(2, 'foo  bar z', 0, 10)])
+
+    def __fsearch(self, text):
+        p = Pipeline.parse(text, self._context)
+        p.execute_sync()
+        results = [(unix_basename(m.path), m.line_num) for m in p.get_output()]
+        results.sort()
+        return results
+
+    def testFsearchIndex(self):
+        self._setupTree2()
+        fs = Filesystem.getInstance()
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('hello\nfoo world\n')
+        f.close()
+        f = open(path_join(self._tmpd, 'testdir', 'x'), 'w')
+        f.write('another world')
+        f.close()
+        p = Pipeline.parse("index-build", self._context)
+        p.execute_sync()
+        service = TrigramIndexService.getInstance()
+        candidates = service.candidates(fs, re.compile('foo w'), self._tmpd)
+        self.assertEquals(map(unix_basename, candidates), ['testf'])
+        candidates = service.candidates(fs, re.compile('world'), path_join(self._tmpd, 'testdir'))
+        self.assertEquals(map(unix_basename, candidates), ['x'])
+        self.assertEquals(self.__fsearch("fsearch -i FOO"), [('testf', 1)])
+        f = open(path_join(self._tmpd, 'testdir', 'x'), 'w')
+        f.write('foo at last\n')
+        f.close()
+        os.unlink(path_join(self._tmpd, 'testf'))
+        self.assertEquals(self.__fsearch("fsearch foo"), [('x', 0)])
+
+    def testTrigramIndexUpdate(self):
+        fs = Filesystem.getInstance()
+        path = path_join(self._tmpd, 'testf')
+        f = open(path, 'w')
+        f.write('hello world\n')
+        f.close()
+        mtime = time.time() - 10.5
+        os.utime(path, (mtime, mtime))
+        index = TrigramIndex(self._tmpd)
+        self.assertEquals(index.sync(fs), 1)
+        # A change notification for an unchanged file must not unsettle the walk
+        index.update_paths(fs, [path])
+        self.assertEquals(index.sync(fs), 0)
+
     def testLs2(self):
         p = Pipeline.parse("ls ~", self._context)
         p.execute_sync()
@@ -491,6 +756,66 @@ class PipelineRunTests(PipelineRunTestFramework):
         self.assertEquals(results[0], '22596363b3de40b06f981fb85d82312e8c0ed511')
         self.assertEquals(results[1], '84b5d4093c8ffaf2eca0feaf014a53b9f41d28ed')
         
+    def testSechashParallel(self):
+        self._setupTree2()
+        f = open(path_join(self._tmpd, 'sectest.txt'), 'wb')
+        f.write('hello world\n')
+        f.close()
+        p = Pipeline.parse("sechash -j sectest.txt testf sectest.txt", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511',
+                                                 'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+                                                 '22596363b3de40b06f981fb85d82312e8c0ed511'])
+        p = Pipeline.parse("sechash -j < sectest.txt", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511'])
+
+    def testSechashCache(self):
+        self._setupTree1()
+        path = path_join(self._tmpd, 'sectest.txt')
+        f = open(path, 'wb')
+        f.write('hello world\n')
+        f.close()
+        os.utime(path, (1000000000, 1000000000))
+        p = Pipeline.parse("ls sectest.txt | sechash", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511'])
+        p = Pipeline.parse("sechash -2 sectest.txt", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['a948904f2f0f479b8f8197694b30184b0d2ed1c1cd2a1ec0fb85d299a192a447'])
+        # With the size and modification time unchanged, the cached digest is used
+        f = open(path, 'wb')
+        f.write('HELLO WORLD\n')
+        f.close()
+        os.utime(path, (1000000000, 1000000000))
+        p = Pipeline.parse("sechash sectest.txt", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511'])
+
+    def testSechashListing(self):
+        self._setupTree1()
+        f = open(path_join(self._tmpd, 'sectest.txt'), 'wb')
+        f.write('hello world\n')
+        f.close()
+        os.symlink(path_join(self._tmpd, 'nosuchfile'), path_join(self._tmpd, 'brokenlink'))
+        statuses = []
+        def on_metadata(cmd, metatype, flags, value):
+            if metatype == 'hotwire.status':
+                statuses.append(value[0])
+        # The directories and the broken link are skipped, and reported
+        p = Pipeline.parse("ls | sechash", self._context)
+        p[1].connect("metadata", on_metadata)
+        p.execute_sync()
+        self.assertEquals(sorted(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511',
+                                                   'da39a3ee5e6b4b0d3255bfef95601890afd80709'])
+        self.assertEquals(statuses, ['Skipped 3: brokenlink, dir with spaces, testdir'])
+        del statuses[:]
+        p = Pipeline.parse("sechash testdir sectest.txt brokenlink", self._context)
+        p[0].connect("metadata", on_metadata)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511'])
+        self.assertEquals(statuses, ['Skipped 2: testdir, brokenlink'])
+
     def testCat1(self):
         self._setupTree2()
         outpath = path_join(self._tmpd, 'cattest.txt')
@@ -503,6 +828,54 @@ class PipelineRunTests(PipelineRunTestFramework):
         self.assertEquals(len(results), 1)
         self.assertEquals(results[0], 'hello world\n')    
         
+    def testCat2(self):
+        self._setupTree1()
+        for name in ('cat1.txt', 'cat2.txt'):
+            f = open(path_join(self._tmpd, name), 'w')
+            f.write(name + '\n')
+            f.close()
+        p = Pipeline.parse("cat cat*.txt", self._context)
+        p.execute_sync()
+        results = list(p.get_output())
+        results.sort()
+        self.assertEquals(results, ['cat1.txt\n', 'cat2.txt\n'])
+
+    def testCatWrite(self):
+        self._setupTree1()
+        data = 'hello\n\xff\xfe' * 50000
+        f = open(path_join(self._tmpd, 'cattest.bin'), 'wb')
+        f.write(data)
+        f.close()
+        p = Pipeline.parse("cat cattest.bin | write copy.bin", self._context)
+        p.execute()
+        list(p.get_output())
+        self.assertEquals(p[1].input.opt_type, 'bytearray/chunked')
+        self.assertEquals(open(path_join(self._tmpd, 'copy.bin'), 'rb').read(), data)
+
+    def testCatDisplay(self):
+        self._setupTree1()
+        f = open(path_join(self._tmpd, 'cattest.txt'), 'wb')
+        f.write('hello\nworld\n')
+        f.close()
+        # Shown as lines even though the display takes byte chunks too
+        p = Pipeline.parse("cat cattest.txt", self._context)
+        p.execute(opt_formats=['bytearray/chunked'])
+        self.assertEquals(list(p.get_output()), ['hello\n', 'world\n'])
+        self.assertEquals(p[0].output.opt_type, None)
+
+    def testCatSechash(self):
+        self._setupTree1()
+        f = open(path_join(self._tmpd, 'sectest.txt'), 'wb')
+        f.write('hello world\nsha test\n')
+        f.close()
+        p = Pipeline.parse("cat sectest.txt | sechash", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), ['22596363b3de40b06f981fb85d82312e8c0ed511',
+                                                 '84b5d4093c8ffaf2eca0feaf014a53b9f41d28ed'])
+        p = Pipeline.parse("cat sectest.txt | filter sha", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), ['sha test\n'])
+
     def testWrite1(self):
         self._setupTree1()
         p = Pipeline.parse("ls | py-map 'it.path+\"\\n\"' | write outtest.txt", self._context)
@@ -618,7 +991,473 @@ class PipelineRunTests(PipelineRunTestFramework):
         p.execute_sync()
         results = list(p.get_output())
         self.assertEquals([0,2,5,7,8,10], results)
-        
+
+    def testParallel1(self):
+        p = Pipeline.parse("py-eval 'range(1000)' | iter | py-map -j 'it * 2' | py-filter -j 'it % 3 == 0'", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), [x * 2 for x in range(1000) if (x * 2) % 3 == 0])
+
+    def testParallelUnpicklable(self):
+        p = Pipeline.parse("py-eval '[lambda: 1, lambda: 2]' | iter | py-map -j 'it()'", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), [1, 2])
+
+    def testBatch1(self):
+        self._setupTree2()
+        p = Pipeline.parse("ls | filter test basename | prop basename", self._context)
+        p.execute_sync(batch_size=2)
+        results = list(p.get_output())
+        self.assertEquals(len(results), 5)
+        self.assertEquals(results[0], 'f3test')
+
+    def testBatch2(self):
+        p = Pipeline.parse("py-eval 'range(1000)' | iter | filter -s 7", self._context)
+        p.execute_sync(batch_size=0)
+        unbatched = list(p.get_output())
+        p = Pipeline.parse("py-eval 'range(1000)' | iter | filter -s 7", self._context)
+        p.execute_sync(batch_size=64)
+        batched = list(p.get_output())
+        self.assertEquals(unbatched, batched)
+
+    def testBatchDeadline(self):
+        # The producer stalls after its first object; that object must not wait for it
+        p = Pipeline.parse("py-eval 'import time; (time.sleep(x) or x for x in [0, 1])' | iter", self._context)
+        start = time.time()
+        p.execute(batch_size=64)
+        output = iter(p.get_output())
+        self.assertEquals(output.next(), 0)
+        self.assert_(time.time() - start < 0.5)
+        self.assertEquals(list(output), [1])
+
+    def testHighWater1(self):
+        p = Pipeline.parse("py-eval 'range(1000)' | iter | filter -s 1", self._context)
+        p.execute(high_water=10)
+        results = list(p.get_output())
+        self.assertEquals(results, [x for x in range(1000) if '1' in str(x)])
+
+    def testExecutor1(self):
+        p = Pipeline.parse("py-eval 'range(100)' | iter | filter -s 1", self._context)
+        p.execute(executor='thread', fuse=False)
+        results = list(p.get_output())
+        self.assertEquals(results, [x for x in range(100) if '1' in str(x)])
+        self.assertEquals(p.get_stage_executors(), ['thread', 'sync', 'thread'])
+
+    def testExecutor2(self):
+        for i in xrange(3):
+            p = Pipeline.parse("py-eval 'range(100)' | iter | filter -s 1", self._context)
+            p.execute(fuse=False)
+            results = list(p.get_output())
+            self.assertEquals(results, [x for x in range(100) if '1' in str(x)])
+            self.assertEquals(p.get_stage_executors(), ['pool', 'sync', 'pool'])
+
+    def testFuse1(self):
+        p = Pipeline.parse("py-eval 'range(100)' | iter | filter -s 1 | head -5", self._context)
+        p.execute()
+        results = list(p.get_output())
+        self.assertEquals(results, [1, 10, 11, 12, 13])
+        self.assertEquals(p.get_stage_executors(), ['fused', 'fused', 'fused', 'pool'])
+        self.assertTrue(p.get_profile()[0].complete)
+
+    def testFuse2(self):
+        p = Pipeline.parse("py-eval 'range(100)' | iter | filter -s 1", self._context)
+        p.execute(executor='thread')
+        results = list(p.get_output())
+        self.assertEquals(results, [x for x in range(100) if '1' in str(x)])
+        self.assertEquals(p.get_stage_executors(), ['fused', 'fused', 'thread'])
+
+    def testFuseException(self):
+        p = Pipeline.parse("py-eval '[1, None]' | iter | prop real", self._context)
+        p.execute()
+        results = list(p.get_output())
+        self.assertEquals(results, [1])
+        self.assertEquals(p.get_state(), 'exception')
+        self.assertEquals(p.get_exception_info()[2].builtin.name, 'prop')
+
+    def testFuseRedirect(self):
+        p = Pipeline.parse("py-eval 'range(10)' | iter | stringify > foo.txt", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), [])
+        self.assertEquals(p.get_stage_executors(), ['fused', 'fused', 'pool'])
+        self.assertEquals(open(os.path.join(self._tmpd, 'foo.txt')).read(), '0123456789')
+
+    def testProfile1(self):
+        p = Pipeline.parse("py-eval 'range(100)' | iter | filter -s 1", self._context)
+        p.execute(profile=True)
+        results = list(p.get_output())
+        self.assertEquals(len(results), 19)
+        self.assertTrue(p.get_profiling())
+        profile = p.get_profile()
+        self.assertEquals([x.name for x in profile], ['py-eval', 'iter', 'filter'])
+        self.assertEquals([x.stage for x in profile], [0, 1, 2])
+        self.assertEquals(profile[0].objects_in, 0)
+        self.assertEquals(profile[0].objects_out, 1)
+        self.assertEquals(profile[1].objects_in, 1)
+        self.assertEquals(profile[1].objects_out, 100)
+        self.assertEquals(profile[2].objects_in, 100)
+        self.assertEquals(profile[2].objects_out, 19)
+        self.assertTrue(profile[2].complete)
+        for stats in profile:
+            self.assertTrue(stats.wall_time >= stats.busy_time >= 0)
+            self.assertTrue(stats.peak_queue_depth <= stats.objects_out)
+
+    def testPipelineStats(self):
+        profiled = Pipeline.parse("py-eval 'range(100)' | iter | filter -s 1", self._context)
+        profiled.execute(profile=True)
+        self.assertEquals(len(list(profiled.get_output())), 19)
+        class OutputContext(HotwireContext):
+            def get_current_output_metadata(self):
+                return None
+            def get_current_output_ref(self):
+                return 'ref'
+            def get_output_pipeline(self, ref):
+                return profiled
+        p = Pipeline.parse("pipeline-stats", OutputContext(initcwd=self._tmpd))
+        p.execute_sync()
+        profile = list(p.get_output())
+        self.assertEquals([x.name for x in profile], ['py-eval', 'iter', 'filter'])
+        self.assertEquals([x.objects_in for x in profile], [0, 1, 100])
+        self.assertEquals([x.objects_out for x in profile], [1, 100, 19])
+        self.assertTrue(profile[2].complete)
+        # Nothing without a current output
+        p = Pipeline.parse("pipeline-stats", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), [])
+
+    def __wait_complete(self, p, stage):
+        for i in xrange(100):
+            if p.get_profile()[stage].complete:
+                return
+            time.sleep(0.05)
+
+    def testStop1(self):
+        f = open(os.path.join(self._tmpd, 'lines.txt'), 'w')
+        for i in xrange(100000):
+            f.write('%d\n' % (i,))
+        f.close()
+        p = Pipeline.parse("cat lines.txt | head -2", self._context)
+        p.execute(fuse=False)
+        self.assertEquals(list(p.get_output()), ['0\n', '1\n'])
+        self.__wait_complete(p, 0)
+        profile = p.get_profile()
+        self.assertTrue(profile[0].complete)
+        self.assertTrue(profile[0].objects_out < 100000)
+
+    def testStopSys(self):
+        p = Pipeline.parse("sys yes | head -3", self._context)
+        p.execute(fuse=False)
+        self.assertEquals(list(p.get_output()), ['y\n', 'y\n', 'y\n'])
+        self.__wait_complete(p, 0)
+        self.assertTrue(p.get_profile()[0].complete)
+
+    def testSysPipeExit(self):
+        # cat finishes first, having read the whole pipe; sh must still exit normally
+        p = Pipeline.parse("sys sh -c 'exec >&- 2>&-; sleep 0.3' | sys cat", self._context)
+        statuses = []
+        def on_metadata(cmd, metatype, flags, value):
+            if metatype == 'hotwire.status':
+                statuses.append(value[0])
+        p[0].connect("metadata", on_metadata)
+        p.execute()
+        self.assertEquals(list(p.get_output()), [])
+        self.__wait_complete(p, 0)
+        self.assertEquals(p[1].input.opt_type, 'x-unix-pipe-file-object/special')
+        self.assertEquals(statuses[-1], 'Exit 0')
+
+    def testStopFused(self):
+        p = Pipeline.parse("sys yes | head -3", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), ['y\n', 'y\n', 'y\n'])
+        self.assertEquals(p.get_stage_executors(), ['fused', 'pool'])
+        self.assertTrue(p.get_profile()[0].complete)
+
+    def __wait_cached(self, count=1):
+        cache = ResultCache.getInstance()
+        for i in xrange(50):
+            if cache.get_entry_count() >= count:
+                return
+            time.sleep(0.1)
+        self.fail("pipeline output was not cached")
+
+    def testCache1(self):
+        self._setupTree1()
+        ResultCache.getInstance().invalidate()
+        p = Pipeline.parse("ls | prop path", self._context)
+        self.assertTrue(p.get_cacheable())
+        p.execute()
+        results = list(p.get_output())
+        self.assertEquals(p.get_cache_status(), 'miss')
+        self.__wait_cached()
+        p = Pipeline.parse("ls | prop path", self._context)
+        p.execute()
+        self.assertEquals(p.get_cache_status(), 'hit')
+        self.assertEquals(list(p.get_output()), results)
+
+    def testCache2(self):
+        self._setupTree1()
+        ResultCache.getInstance().invalidate()
+        p = Pipeline.parse("ls | prop path", self._context)
+        p.execute()
+        results = list(p.get_output())
+        self.__wait_cached()
+        open(path_join(self._tmpd, 'newf'), 'w').close()
+        # Don't depend on the filesystem's timestamp granularity
+        os.utime(self._tmpd, (time.time() + 10, time.time() + 10))
+        p = Pipeline.parse("ls | prop path", self._context)
+        p.execute()
+        self.assertEquals(p.get_cache_status(), 'miss')
+        self.assertEquals(len(list(p.get_output())), len(results) + 1)
+
+    def testCacheGlob(self):
+        self._setupTree2()
+        ResultCache.getInstance().invalidate()
+        os.utime(self._tmpd, (1000000000, 1000000000))
+        p = Pipeline.parse("ls test* | prop path", self._context)
+        self.assertTrue(p.get_cacheable())
+        p.execute()
+        self.assertEquals(len(list(p.get_output())), 4)
+        self.assertEquals(p.get_cache_status(), 'miss')
+        self.__wait_cached()
+        p = Pipeline.parse("ls test* | prop path", self._context)
+        p.execute()
+        self.assertEquals(len(list(p.get_output())), 4)
+        self.assertEquals(p.get_cache_status(), 'hit')
+        # A file the glob matched changed, while its directory didn't
+        f = open(path_join(self._tmpd, 'testf2'), 'w')
+        f.write('changed')
+        f.close()
+        os.utime(self._tmpd, (1000000000, 1000000000))
+        p = Pipeline.parse("ls test* | prop path", self._context)
+        p.execute()
+        list(p.get_output())
+        self.assertEquals(p.get_cache_status(), 'miss')
+
+    def testCacheListed(self):
+        self._setupTree1()
+        ResultCache.getInstance().invalidate()
+        os.utime(self._tmpd, (1000000000, 1000000000))
+        p = Pipeline.parse("ls | filter stf path | prop size", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), [0])
+        self.__wait_cached()
+        # Modified in place, so only the listed file's stat shows the change
+        f = open(path_join(self._tmpd, 'testf'), 'w')
+        f.write('changed')
+        f.close()
+        os.utime(self._tmpd, (1000000000, 1000000000))
+        p = Pipeline.parse("ls | filter stf path | prop size", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), [7])
+        self.assertEquals(p.get_cache_status(), 'miss')
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._cache = ResultCache.getInstance()
+        self._cache.invalidate()
+
+    def tearDown(self):
+        self._cache.set_memory_budget(ResultCache.DEFAULT_MEMORY_BUDGET)
+        self._cache.invalidate()
+
+    def testLookup(self):
+        hits, misses = self._cache.hits, self._cache.misses
+        self._cache.store('a', (('/', 1, 1),), ['x', 'y'])
+        self.assertEquals(self._cache.lookup('a', (('/', 1, 1),)), ['x', 'y'])
+        self.assertEquals(self._cache.lookup('a', (('/', 2, 1),)), None)
+        self.assertEquals(self._cache.lookup('a', (('/', 1, 1),)), None)
+        self.assertEquals(self._cache.hits - hits, 1)
+        self.assertEquals(self._cache.misses - misses, 2)
+
+    def testDependencies(self):
+        tmpd = tempfile.mkdtemp(prefix='hotwiretest')
+        try:
+            path = path_join(tmpd, 'f')
+            open(path, 'w').close()
+            self._cache.store('a', (), ['x'], get_validators([path]))
+            self.assertEquals(self._cache.lookup('a', ()), ['x'])
+            f = open(path, 'w')
+            f.write('changed')
+            f.close()
+            self.assertEquals(self._cache.lookup('a', ()), None)
+            self.assertEquals(self._cache.get_entry_count(), 0)
+        finally:
+            shutil.rmtree(tmpd)
+
+    def testEvict(self):
+        self._cache.store('a', (), ['x' * 1000])
+        self._cache.store('b', (), ['y' * 1000])
+        self._cache.lookup('a', ())
+        self._cache.set_memory_budget(self._cache.get_memory_usage() - 1)
+        self.assertEquals(self._cache.get_entry_count(), 1)
+        self.assertEquals(self._cache.lookup('a', ()), ['x' * 1000])
+        self._cache.store('c', (), ['z' * 10000])
+        self.assertEquals(self._cache.lookup('c', ()), None)
+
+class StatServiceTests(unittest.TestCase):
+    def setUp(self):
+        self._tmpd = tempfile.mkdtemp(prefix='hotwiretest')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpd)
+
+    def testGetFiles(self):
+        fs = Filesystem.getInstance()
+        os.mkdir(path_join(self._tmpd, 'sub'))
+        paths = [path_join(self._tmpd, 'f%d' % (i,)) for i in xrange(300)]
+        paths.append(path_join(self._tmpd, 'sub', 'g'))
+        for path in paths:
+            open(path, 'w').close()
+        files = [fs.get_file(path, cb=lambda files: None) for path in paths]
+        files.append(fs.get_file(path_join(self._tmpd, 'nosuchfile'), cb=lambda files: None))
+        for i in xrange(100):
+            if not [f for f in files if f.stat is None and f.stat_error is None]:
+                break
+            time.sleep(0.05)
+        for f in files[:-1]:
+            self.assertEquals(f.size, 0)
+        self.assert_(files[-1].stat_error)
+
+    def testStatWorkerFailure(self):
+        class BrokenFile(object):
+            path = path_join(self._tmpd, 'broken')
+            def get_stat_sync(self):
+                raise RuntimeError('broken')
+        fs = Filesystem.getInstance()
+        StatService.getInstance().request([BrokenFile()], lambda files: None)
+        path = path_join(self._tmpd, 'f')
+        open(path, 'w').close()
+        fobj = fs.get_file(path, cb=lambda files: None)
+        service = StatService.getInstance()
+        for i in xrange(100):
+            if fobj.stat is not None and service._StatService__workers == 0:
+                break
+            time.sleep(0.05)
+        self.assertEquals(fobj.size, 0)
+        self.assertEquals(service._StatService__workers, 0)
+
+    def testStatBatchFailure(self):
+        class BrokenFile(object):
+            path = path_join(self._tmpd, 'broken')
+            def get_stat_sync(self):
+                raise RuntimeError('broken')
+        for i in xrange(10):
+            open(path_join(self._tmpd, 'f%d' % (i,)), 'w').close()
+        files = list(Filesystem.getInstance().ls_dir(self._tmpd, True, resolve=False))
+        service = StatService.getInstance()
+        delivered = []
+        def on_files(files):
+            delivered.extend(files)
+        service.request([BrokenFile()] + files, on_files)
+        for i in xrange(100):
+            if service._StatService__workers == 0:
+                break
+            time.sleep(0.05)
+        service._StatService__deliver()
+        # The files after the broken one in its batch are delivered too
+        self.assertEquals(len(delivered), 11)
+        self.assertEquals([f.size for f in files], [0] * 10)
+
+    def testDeferredStatThreads(self):
+        for i in xrange(300):
+            open(path_join(self._tmpd, 'f%d' % (i,)), 'w').close()
+        files = list(Filesystem.getInstance().ls_dir(self._tmpd, True, resolve=False))
+        sizes = []
+        def read_sizes():
+            sizes.extend([f.size for f in files])
+        threads = [threading.Thread(target=read_sizes) for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(sizes, [0] * 1200)
+
+    def testStatFields(self):
+        path = path_join(self._tmpd, 'f')
+        f = open(path, 'w')
+        f.write('hello')
+        f.close()
+        fobj = Filesystem.getInstance().get_file_sync(path)
+        st = os.lstat(path)
+        self.assertEquals(fobj.stat[stat.ST_SIZE], 5)
+        self.assertEquals(fobj.stat[stat.ST_MTIME], st[stat.ST_MTIME])
+        self.assertEquals(fobj.stat.st_ino, st.st_ino)
+        self.assertEquals(fobj.stat.st_nlink, st.st_nlink)
+        self.assertEquals(fobj.stat.st_mtime, st.st_mtime)
+        self.assertEquals(fobj.mtime, st[stat.ST_MTIME])
+
+class CommandQueueTests(unittest.TestCase):
+    def testBatchGet(self):
+        q = CommandQueue()
+        q.put_batch([1, 2, 3])
+        q.put(4)
+        self.assertEquals(q.get(False), 1)
+        self.assertEquals(q.get_batch(False), [2, 3])
+        self.assertEquals(q.get_batch(False), [4])
+        self.assertRaises(Queue.Empty, lambda: q.get_batch(False))
+
+    def testBatchIter(self):
+        q = CommandQueue()
+        q.put_batch(['a', 'b'])
+        q.put_batch([])
+        q.put('c')
+        q.put(None)
+        self.assertEquals(list(q), ['a', 'b', 'c'])
+
+    def testHighWater(self):
+        q = CommandQueue()
+        q.high_water = 2
+        q.put_batch([1, 2])
+        def consume():
+            time.sleep(0.2)
+            q.get_batch()
+        t = threading.Thread(target=consume)
+        t.start()
+        q.put(3)
+        t.join()
+        self.assertTrue(q.put_wait_time > 0)
+        self.assertEquals(q.get_count(), 1)
+
+    def testHighWaterCancel(self):
+        q = CommandQueue()
+        q.high_water = 1
+        q.put(1)
+        t = threading.Thread(target=lambda: q.put(2))
+        t.setDaemon(True)
+        t.start()
+        time.sleep(0.1)
+        q.cancel()
+        t.join(2)
+        self.assertFalse(t.isAlive())
+        self.assertEquals(list(q), [1])
+
+def _double(item):
+    return [item * 2]
+
+def _exit_on_3(item):
+    if item == 3:
+        os._exit(1)
+    return [item]
+
+def _unpicklable(item):
+    return [lambda: item]
+
+class ProcessPoolTests(unittest.TestCase):
+    def setUp(self):
+        self._pool = ProcessPool.getInstance()
+
+    def tearDown(self):
+        self._pool.close()
+
+    def testImap(self):
+        self.assertEquals(list(self._pool.imap(_double, xrange(1000), batch_size=16)), range(0, 2000, 2))
+
+    def testWorkerExit(self):
+        self.assertRaises(ProcessPoolError, list, self._pool.imap(_exit_on_3, range(10), batch_size=2))
+        # The dead worker is replaced
+        self.assertEquals(list(self._pool.imap(_double, range(10), batch_size=2)), range(0, 20, 2))
+
+    def testUnpicklableResults(self):
+        self.assertRaises(ProcessPoolError, list, self._pool.imap(_unpicklable, range(3)))
+
 def suite():
     loader = unittest.TestLoader()
     loader.loadTestsFromTestCase(PipelineParserTests)
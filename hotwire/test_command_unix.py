@@ -19,11 +19,12 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os,sys,time
+import os,sys,time,unittest,tempfile,shutil
 
 import hotwire
 from hotwire.command import *
 from hotwire.test_command import PipelineRunTestFramework
+from hotwire.sysdep.fs_impl.fs_unix import InotifyService
 from hotwire.fs import unix_basename, path_join
 
 class PipelineRunTestsUnix(PipelineRunTestFramework):
@@ -96,6 +97,39 @@ class PipelineRunTestsUnix(PipelineRunTestFramework):
         same_testdata = open(newoutpath).read()
         self.assertEquals(same_testdata, testdata)
         
+    def testRedir2(self):
+        self._setupTree1()
+        f = open(path_join(self._tmpd, 'redirtest.txt'), 'w')
+        f.write('hello world\n')
+        f.close()
+        p = Pipeline.parse("sys cat < redirtest.txt | sys cat | sys tr a-z A-Z > upper.txt", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), [])
+        self.assertEquals(p[1].input.opt_type, 'x-unix-pipe-file-object/special')
+        self.assertEquals(open(path_join(self._tmpd, 'upper.txt')).read(), 'HELLO WORLD\n')
+
+    def testSysWrite(self):
+        self._setupTree1()
+        p = Pipeline.parse("sys printf 'a\\xe9\\nb' | write out.txt", self._context)
+        p.execute()
+        list(p.get_output())
+        self.assertEquals(open(path_join(self._tmpd, 'out.txt')).read(), 'a\xe9\nb')
+
+    def testSysLines(self):
+        p = Pipeline.parse("sys printf 'a\\nbc\\n\\nd'", self._context)
+        p.execute()
+        self.assertEquals(list(p.get_output()), ['a\n', 'bc\n', '\n', 'd'])
+        p = Pipeline.parse("sys seq 200000", self._context)
+        p.execute()
+        results = list(p.get_output())
+        self.assertEquals(len(results), 200000)
+        self.assertEquals(results[-1], '200000\n')
+
+    def testSysPartialLine(self):
+        p = Pipeline.parse("sys sh -c 'printf foo; sleep 0.2; echo bar' | filter foobar", self._context)
+        p.execute_sync()
+        self.assertEquals(list(p.get_output()), ['foobar\n'])
+
     def testCatBinCat(self):
         self._setupTree1()
         p = Pipeline.parse("/bin/cat testf | sys wc -l", self._context)
@@ -144,3 +178,56 @@ class PipelineRunTestsUnix(PipelineRunTestFramework):
         self.assertEquals(len(results), 1)
         self.assertEquals(results[0].path, bglobpath)
         
+
+class InotifyServiceTests(unittest.TestCase):
+    def setUp(self):
+        self._tmpd = tempfile.mkdtemp(prefix='hotwiretest')
+        self._service = InotifyService()
+        self._changes = []
+
+    def tearDown(self):
+        self._service.close()
+        shutil.rmtree(self._tmpd)
+
+    def __record(self, paths):
+        self._changes.append(paths)
+
+    def testDirectory(self):
+        self._service.add(self._tmpd, self.__record)
+        open(path_join(self._tmpd, 'a'), 'w').close()
+        open(path_join(self._tmpd, 'b'), 'w').close()
+        self._service.process_events()
+        self._service.flush()
+        self.assertEquals(self._changes, [[path_join(self._tmpd, 'a'), path_join(self._tmpd, 'b')]])
+
+    def testWatchLimit(self):
+        service = InotifyService(max_watches=1)
+        try:
+            os.mkdir(path_join(self._tmpd, 'sub'))
+            monitors = [service.add(self._tmpd, self.__record),
+                        service.add(path_join(self._tmpd, 'a'), self.__record)]
+            self.assertRaises(NotImplementedError, service.add, path_join(self._tmpd, 'sub'), self.__record)
+            for monitor in monitors:
+                monitor.cancel()
+            service.add(path_join(self._tmpd, 'sub'), self.__record)
+        finally:
+            service.close()
+
+    def testFileReplaced(self):
+        fpath = path_join(self._tmpd, 'a')
+        open(fpath, 'w').close()
+        monitor = self._service.add(fpath, self.__record)
+        open(path_join(self._tmpd, 'other'), 'w').close()
+        self._service.process_events()
+        self._service.flush()
+        self.assertEquals(self._changes, [])
+        open(fpath + '.tmp', 'w').close()
+        os.rename(fpath + '.tmp', fpath)
+        self._service.process_events()
+        self._service.flush()
+        self.assertEquals(self._changes, [[fpath]])
+        monitor.cancel()
+        open(fpath, 'w').close()
+        self._service.process_events()
+        self._service.flush()
+        self.assertEquals(len(self._changes), 1)
@@ -24,6 +24,7 @@ import os, sys, unittest, tempfile, shutil, platform
 import hotwire
 from hotwire.fs import path_join
 from hotwire.completion import *
+from hotwire.fileindex import FileIndex
 from hotwire.sysdep import is_windows, is_unix
 
 class CompletionTests(unittest.TestCase):
@@ -165,6 +166,14 @@ class CompletionTests(unittest.TestCase):
         self.assertEquals(result.results[foo_index].target.path, path_join(self._tmpd, '.foo'))
         self.assertEquals(result.results[foo_index].suffix, '.foo')
         
+    def testDeep(self):
+        self._setupTree2()
+        FileIndex.getInstance().update(Filesystem.getInstance(), self._tmpd)
+        result = self.cc.sync_complete(self.pc, '**/mo', self._tmpd)
+        self.assertEquals([(compl.matchbase, compl.suffix) for compl in result.results],
+                          [('testdir2/moo', 'o'), ('testdir2/moodir', 'odir/')])
+        self.assertEquals(result.results[0].target.path, path_join(self._tmpd, 'testdir2', 'moo'))
+
     def testSafechar1(self):
         self._setupTree1()
         bpath = path_join(self._tmpd, 'bar_foo')
@@ -0,0 +1,495 @@
+# This file is part of the Hotwire Shell project API.
+
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do so, 
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE X CONSORTIUM BE 
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR 
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os, sys, stat, string, threading, logging, hashlib, cPickle, time
+import sre_parse, sre_constants
+from array import array
+from collections import defaultdict
+
+from hotwire.fs import path_normalize, mtime_is_racy
+from hotwire.fswalk import TreeWalker
+from hotwire.sysdep.fs import FileStatError
+from hotwire.procpool import ProcessPool
+from hotwire.logutil import log_except
+from hotwire.externals.singletonmixin import Singleton
+
+_logger = logging.getLogger("hotwire.TextIndex")
+
+# Bytes looked at to decide whether a file is binary
+SNIFF_SIZE = 8192
+
+# Content is indexed folded to ASCII lower case, so one index serves
+# case-sensitive and case-insensitive searches
+_LOWER = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def _file_trigrams(path):
+    # Runs in a ProcessPool worker; returns the list of trigrams, or None if
+    # the file could not be read.  Binary files have none.
+    try:
+        f = open(path, 'rb')
+        try:
+            buf = f.read()
+        finally:
+            f.close()
+    except EnvironmentError, e:
+        return [(path, None)]
+    if buf[:SNIFF_SIZE].find('\0') >= 0:
+        return [(path, [])]
+    buf = buf.translate(_LOWER)
+    return [(path, list(set(buf[i:i+3] for i in xrange(len(buf)-2))))]
+
+def _content_stat(fobj):
+    """Return the stat of what fobj's content is read from, following a
+symbolic link, or None.  Both sync() and update_paths() go through here, so
+index entries always compare like with like."""
+    st = fobj.stat
+    if st is not None and stat.S_ISLNK(st.st_mode):
+        st = fobj.target_stat
+    return st
+
+def _new_posting():
+    return array('I')
+
+def _literal_runs(parsed):
+    runs = []
+    current = []
+    for (op, av) in parsed:
+        if op == sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        runs.append(''.join(current))
+        current = []
+        if op == sre_constants.SUBPATTERN:
+            runs.extend(_literal_runs(av[1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            runs.extend(_literal_runs(av[2]))
+    runs.append(''.join(current))
+    return runs
+
+def required_trigrams(pattern, flags=0):
+    """Return the set of (lower case) trigrams the text matched by the bytes
+regular expression pattern must contain; it is empty if there are none."""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (sre_constants.error, OverflowError, ValueError), e:
+        return set()
+    trigrams = set()
+    for run in _literal_runs(parsed):
+        run = run.translate(_LOWER)
+        trigrams.update(run[i:i+3] for i in xrange(len(run)-2))
+    return trigrams
+
+class TrigramIndex(object):
+    """The trigrams in the text files under a directory tree, for finding the
+files a regular expression could match without reading all of them.  Files
+are checked against their size and modification time when the index is
+synced; changed files get new ids, and the postings of the old ones are
+dropped when the index is compacted on saving."""
+
+    VERSION = 2
+    # Larger files are not indexed, and are always candidates
+    SIZE_LIMIT = 8 * 1024 * 1024
+
+    root = property(lambda self: self._root)
+
+    def __init__(self, root):
+        super(TrigramIndex, self).__init__()
+        self._root = root
+        self.lock = threading.RLock()
+        # path -> (id, mtime, size); id is None if the content isn't indexed
+        self.__files = {}
+        # id -> path, or None once the file has changed or gone away
+        self.__paths = []
+        # trigram -> array of ids
+        self.__postings = defaultdict(_new_posting)
+        self.__unindexed = set()
+        self.__stale = 0
+        self.__modified = False
+
+    @staticmethod
+    def get_index_path(root):
+        from hotwire.sysdep.fs import Filesystem
+        dirname = Filesystem.getInstance().make_conf_subdir('index')
+        if isinstance(root, unicode):
+            root = root.encode('utf-8')
+        return os.path.join(dirname, hashlib.sha1(root).hexdigest() + '.trigrams')
+
+    @staticmethod
+    def load(root):
+        """Return the saved index for root, or None if there is none."""
+        try:
+            f = open(TrigramIndex.get_index_path(root), 'rb')
+        except IOError, e:
+            return None
+        try:
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+            if data['version'] != TrigramIndex.VERSION or data['root'] != root:
+                return None
+        except Exception, e:
+            _logger.debug("Failed to load index for %r", root, exc_info=True)
+            return None
+        index = TrigramIndex(root)
+        index.__files = data['files']
+        index.__paths = data['paths']
+        for (trigram, ids) in data['postings'].iteritems():
+            posting = index.__postings[trigram]
+            posting.fromstring(ids)
+        index.__unindexed = set(path for (path, entry) in index.__files.iteritems() if entry[0] is None)
+        index.__stale = data['stale']
+        return index
+
+    def save(self):
+        self.lock.acquire()
+        try:
+            if not self.__modified:
+                return
+            if self.__stale > len(self.__files):
+                self.__compact()
+            data = {'version': self.VERSION, 'root': self._root, 'files': self.__files,
+                    'paths': self.__paths, 'stale': self.__stale,
+                    'postings': dict((trigram, posting.tostring()) for (trigram, posting) in self.__postings.iteritems())}
+            path = self.get_index_path(self._root)
+            tmppath = path + '.tmp'
+            f = open(tmppath, 'wb')
+            try:
+                cPickle.dump(data, f, 2)
+            finally:
+                f.close()
+            os.rename(tmppath, path)
+            self.__modified = False
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.__files = {}
+        self.__paths = []
+        self.__postings = defaultdict(_new_posting)
+        self.__unindexed = set()
+        self.__stale = 0
+        self.__modified = True
+        self.lock.release()
+
+    def remove(self):
+        """Delete the saved index."""
+        try:
+            os.unlink(self.get_index_path(self._root))
+        except OSError, e:
+            pass
+
+    def __compact(self):
+        ids = {}
+        paths = []
+        for (oldid, path) in enumerate(self.__paths):
+            if path is not None:
+                ids[oldid] = len(paths)
+                paths.append(path)
+        postings = defaultdict(_new_posting)
+        for (trigram, posting) in self.__postings.iteritems():
+            newposting = array('I', (ids[oldid] for oldid in posting if oldid in ids))
+            if newposting:
+                postings[trigram] = newposting
+        for (path, (oldid, mtime, size)) in self.__files.iteritems():
+            if oldid is not None:
+                self.__files[path] = (ids[oldid], mtime, size)
+        self.__paths = paths
+        self.__postings = postings
+        self.__stale = 0
+
+    def __forget(self, path):
+        entry = self.__files.pop(path, None)
+        if entry is None:
+            return
+        self.__modified = True
+        if entry[0] is None:
+            self.__unindexed.discard(path)
+        else:
+            self.__paths[entry[0]] = None
+            self.__stale += 1
+
+    def __add(self, path, mtime, size, trigrams):
+        self.__forget(path)
+        self.__modified = True
+        if trigrams is None:
+            self.__files[path] = (None, mtime, size)
+            self.__unindexed.add(path)
+            return
+        fileid = len(self.__paths)
+        self.__paths.append(path)
+        self.__files[path] = (fileid, mtime, size)
+        postings = self.__postings
+        for trigram in trigrams:
+            postings[trigram].append(fileid)
+
+    def __update(self, changed, cancelled):
+        now = time.time()
+        # Leave files which may change again without their mtime moving to
+        # be checked once more next time
+        def entry_mtime(mtime):
+            if mtime_is_racy(mtime, now):
+                return None
+            return mtime
+        readable = []
+        stats = {}
+        for (path, mtime, size) in changed:
+            if size > self.SIZE_LIMIT:
+                self.__add(path, entry_mtime(mtime), size, None)
+            else:
+                stats[path] = (mtime, size)
+                readable.append(path)
+        for (path, trigrams) in ProcessPool.getInstance().imap(_file_trigrams, readable, cancelled=cancelled):
+            (mtime, size) = stats[path]
+            self.__add(path, entry_mtime(mtime), size, trigrams)
+
+    def __is_current(self, path, st):
+        entry = self.__files.get(path)
+        return entry is not None and entry[1] == st.st_mtime and entry[2] == st.st_size
+
+    def sync(self, fs, path=None, cancelled=None):
+        """Bring the index for the files under path (by default, the root) up
+to date, reading those which are new or have changed.  Returns the number
+of files added, changed or removed."""
+        path = (path or self._root).rstrip('/') or '/'
+        prefix = path.rstrip('/') + '/'
+        seen = set()
+        changed = []
+        batches = TreeWalker(fs).walk(path)
+        try:
+            for batch in batches:
+                if cancelled is not None and cancelled():
+                    return 0
+                for fobj in batch:
+                    st = _content_stat(fobj)
+                    if st is None:
+                        continue
+                    seen.add(fobj.path)
+                    self.lock.acquire()
+                    current = self.__is_current(fobj.path, st)
+                    self.lock.release()
+                    if not current:
+                        changed.append((fobj.path, st.st_mtime, st.st_size))
+        finally:
+            batches.close()
+        self.lock.acquire()
+        try:
+            removed = [fpath for fpath in self.__files if fpath.startswith(prefix) and fpath not in seen]
+            for fpath in removed:
+                self.__forget(fpath)
+            self.__update(changed, cancelled)
+        finally:
+            self.lock.release()
+        return len(changed) + len(removed)
+
+    def update_paths(self, fs, paths):
+        """Bring the index up to date for paths, which may be files or directories."""
+        rootprefix = self._root.rstrip('/') + '/'
+        for path in paths:
+            # Skip what the tree walk would, hidden files and directories
+            if not path.startswith(rootprefix) or '/.' in path[len(rootprefix)-1:]:
+                continue
+            try:
+                st = _content_stat(fs.get_file_sync(path))
+            except FileStatError, e:
+                st = None
+            if st is None:
+                self.lock.acquire()
+                try:
+                    prefix = path + '/'
+                    for fpath in [fpath for fpath in self.__files if fpath == path or fpath.startswith(prefix)]:
+                        self.__forget(fpath)
+                finally:
+                    self.lock.release()
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                self.sync(fs, path)
+                continue
+            self.lock.acquire()
+            try:
+                if not self.__is_current(path, st):
+                    self.__update([(path, st.st_mtime, st.st_size)], None)
+            finally:
+                self.lock.release()
+
+    def get_dirs(self):
+        """Return the directories holding the indexed files."""
+        self.lock.acquire()
+        try:
+            return set(os.path.dirname(path) for path in self.__files)
+        finally:
+            self.lock.release()
+
+    def candidates(self, regexp, path=None):
+        """Return the sorted paths of the files under path which the compiled
+bytes regular expression regexp could match."""
+        prefix = (path or self._root).rstrip('/') + '/'
+        trigrams = required_trigrams(regexp.pattern, regexp.flags)
+        self.lock.acquire()
+        try:
+            if not trigrams:
+                return sorted(fpath for fpath in self.__files if fpath.startswith(prefix))
+            postings = []
+            for trigram in trigrams:
+                posting = self.__postings.get(trigram)
+                if not posting:
+                    postings = []
+                    ids = set()
+                    break
+                postings.append(posting)
+            if postings:
+                postings.sort(key=len)
+                ids = set(postings[0])
+                for posting in postings[1:]:
+                    ids.intersection_update(posting)
+                    if not ids:
+                        break
+            paths = self.__paths
+            result = [paths[fileid] for fileid in ids]
+            result.extend(self.__unindexed)
+            return sorted(fpath for fpath in result if fpath is not None and fpath.startswith(prefix))
+        finally:
+            self.lock.release()
+
+class TrigramIndexService(Singleton):
+    """Keeps the trigram indexes in use loaded, and where the filesystem can
+monitor changes, reindexes changed files in the background so searches
+find the index current."""
+
+    def __init__(self):
+        super(TrigramIndexService, self).__init__()
+        self.__lock = threading.Lock()
+        # root -> TrigramIndex
+        self.__indexes = {}
+        # root -> directory -> monitor
+        self.__monitors = {}
+        # root -> set of changed paths not yet reindexed
+        self.__pending = {}
+
+    def build(self, fs, path, rebuild=False, cancelled=None):
+        """Create or update the index for the tree at path, and return it."""
+        path = path_normalize(path).rstrip('/') or '/'
+        self.__lock.acquire()
+        index = self.__indexes.get(path)
+        self.__lock.release()
+        if rebuild:
+            if index is not None:
+                index.clear()
+            else:
+                index = TrigramIndex(path)
+                index.remove()
+        elif index is None:
+            index = TrigramIndex.load(path) or TrigramIndex(path)
+        index.sync(fs, cancelled=cancelled)
+        if cancelled is not None and cancelled():
+            return index
+        index.save()
+        self.__add(fs, index)
+        return index
+
+    def lookup(self, fs, path):
+        """Return the index covering path, or None."""
+        path = path_normalize(path).rstrip('/') or '/'
+        root = path
+        while True:
+            self.__lock.acquire()
+            index = self.__indexes.get(root)
+            self.__lock.release()
+            if index is not None:
+                return index
+            if os.path.exists(TrigramIndex.get_index_path(root)):
+                index = TrigramIndex.load(root)
+                if index is not None:
+                    self.__add(fs, index)
+                    return index
+            parent = os.path.dirname(root)
+            if parent == root:
+                return None
+            root = parent
+
+    def candidates(self, fs, regexp, path, cancelled=None):
+        """Return the paths under path which the compiled bytes regular
+expression regexp could match, or None if no index covers path."""
+        index = self.lookup(fs, path)
+        if index is None:
+            return None
+        if index.sync(fs, path, cancelled=cancelled):
+            index.save()
+        return index.candidates(regexp, path)
+
+    def __add(self, fs, index):
+        self.__lock.acquire()
+        known = index.root in self.__indexes
+        self.__indexes[index.root] = index
+        self.__lock.release()
+        if not known:
+            self.__watch(fs, index, index.get_dirs())
+
+    def __watch(self, fs, index, dirs):
+        root = index.root
+        for dirpath in dirs:
+            self.__lock.acquire()
+            monitors = self.__monitors.setdefault(root, {})
+            watched = dirpath in monitors
+            self.__lock.release()
+            if watched:
+                continue
+            try:
+                monitor = fs.get_monitor(dirpath, lambda paths: self.__on_changed(fs, index, paths))
+            except NotImplementedError, e:
+                # Unsupported, or too many watches; searches still sync first
+                return
+            self.__lock.acquire()
+            monitors[dirpath] = monitor
+            self.__lock.release()
+
+    def __on_changed(self, fs, index, paths):
+        self.__lock.acquire()
+        pending = self.__pending.get(index.root)
+        if pending is None:
+            pending = self.__pending[index.root] = set()
+            start = True
+        else:
+            start = False
+        pending.update(paths)
+        self.__lock.release()
+        if start:
+            thread = threading.Thread(target=self.__update, args=(fs, index), name="TrigramIndex Update")
+            thread.setDaemon(True)
+            thread.start()
+
+    @log_except(_logger)
+    def __update(self, fs, index):
+        while True:
+            self.__lock.acquire()
+            paths = self.__pending.get(index.root)
+            if not paths:
+                del self.__pending[index.root]
+                self.__lock.release()
+                break
+            self.__pending[index.root] = set()
+            self.__lock.release()
+            _logger.debug("updating index for %r: %d changed paths", index.root, len(paths))
+            index.update_paths(fs, sorted(paths))
+            self.__watch(fs, index, [path for path in paths if os.path.isdir(path)])
+        index.save()
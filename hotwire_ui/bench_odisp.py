@@ -0,0 +1,81 @@
+# This file is part of the Hotwire Shell user interface.
+#   
+# Copyright (C) 2007 Colin Walters <walters@verbum.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import sys, time, logging
+
+import gobject
+
+from hotwire.command import HotwireContext, Pipeline
+from hotwire.builtin import Builtin
+from hotwire_ui.odisp import ObjectsDisplay, MultiObjectsDisplay
+
+_logger = logging.getLogger("hotwire.ui.BenchODisp")
+
+class TimestampBuiltin(Builtin):
+    """Yield the current time, in bursts separated by a pause."""
+    def __init__(self, bursts, burst_size, pause):
+        super(TimestampBuiltin, self).__init__('bench-timestamp',
+                                               output=float,
+                                               argspec=None)
+        self.__bursts = bursts
+        self.__burst_size = burst_size
+        self.__pause = pause
+
+    def execute(self, context, args, options=[]):
+        for i in xrange(self.__bursts):
+            for j in xrange(self.__burst_size):
+                yield time.time()
+            if self.__pause:
+                time.sleep(self.__pause)
+
+def _measure_append_latency(bursts, burst_size, pause):
+    latencies = []
+    orig_append = ObjectsDisplay.append_object
+    def timed_append(odisp, obj, **kwargs):
+        latencies.append(time.time() - obj)
+        return orig_append(odisp, obj, **kwargs)
+    ObjectsDisplay.append_object = timed_append
+    try:
+        loop = gobject.MainLoop()
+        context = HotwireContext()
+        pipeline = Pipeline.create(context, None, TimestampBuiltin(bursts, burst_size, pause))
+        odisp = MultiObjectsDisplay(None, pipeline)
+        odisp.connect('primary-complete', lambda o: loop.quit())
+        start = time.time()
+        pipeline.execute(opt_formats=odisp.get_opt_formats())
+        loop.run()
+        total = time.time() - start
+    finally:
+        ObjectsDisplay.append_object = orig_append
+    latencies.sort()
+    def ms(secs):
+        return secs * 1000.0
+    sys.stdout.write("  %d objects in %.3fs; yield to append latency ms: median %.1f, 95%% %.1f, max %.1f\n" \
+                     % (len(latencies), total, 
+                        ms(latencies[len(latencies)//2]),
+                        ms(latencies[int(len(latencies)*0.95)]),
+                        ms(latencies[-1])))
+
+def bench_append_latency_bursts():
+    """Short bursts of output with pauses between them, like interactive commands."""
+    _measure_append_latency(20, 5, 0.3)
+
+def bench_append_latency_streaming():
+    """Sustained streaming output."""
+    _measure_append_latency(1, 20000, 0)
@@ -131,6 +131,12 @@ class CommandExecutionHeader(gtk.VBox):
             self.__cmd_statuses = None
             self.__cmd_status_show_cmd = False
 
+        self.__profiles = {}
+        self.__profile_label = gtk.Label()
+        self.__profile_label.set_alignment(0, 0.5)
+        self.__profile_label.set_no_show_all(True)
+        self.__cmdstatus_vbox.pack_start(hotwidgets.Align(self.__profile_label, padding_left=4), expand=False)
+
         self.__objects = odisp
         self.__objects.connect("primary-complete", self.__on_primary_complete)        
         self.__objects.connect("changed", lambda o: self.__update_titlebox())
@@ -247,6 +253,8 @@ class CommandExecutionHeader(gtk.VBox):
             status_str = self.__objects.get_status_str()
             if status_str is None:
                 status_str = _('%d objects') % (ocount,)
+            if self.__pipeline.get_cache_status() == 'hit':
+                status_str += _(' (cached)')
         else:
             status_str = None
             
@@ -313,6 +321,12 @@ class CommandExecutionHeader(gtk.VBox):
         if key == 'hotwire.status':
             self.__handle_status(cmdidx, meta)
             return
+        if key == 'hotwire.profile':
+            self.__handle_profile(cmdidx, meta)
+            return
+        if key == 'hotwire.first_output':
+            _logger.debug("first output after %.3fs", meta)
+            return
         
     def __handle_basedir(self, cmdidx, meta):
         _logger.debug("got basedir %s", meta)
@@ -323,6 +337,14 @@ class CommandExecutionHeader(gtk.VBox):
         statusdisp.set_status(*meta)
         self.__update_titlebox()
 
+    def __handle_profile(self, cmdidx, meta):
+        self.__profiles[cmdidx] = meta
+        stages = self.__profiles.keys()
+        stages.sort()
+        self.__profile_label.set_markup('<small><tt>%s</tt></small>' \
+            % ('\n'.join([gobject.markup_escape_text(str(self.__profiles[i])) for i in stages]),))
+        self.__profile_label.show()
+
     def __isexecuting(self):
         state = self.__pipeline.get_state()           
         return (state == 'executing' or (state == 'complete' and not self.__primary_complete))
@@ -359,6 +359,7 @@ class CompletionStatusDisplay(hotwidgets.TransientPopup):
         self.__token = None
         self.__completer = None
         self.__complsys = CompletionSystem()
+        self.__completion_serial = None
         self.__current_completion = None
         self.__current_history = None
         self.__pending_completion_load = False
@@ -391,6 +392,10 @@ class CompletionStatusDisplay(hotwidgets.TransientPopup):
         self.emit('completion-selected', compl)
 
     def invalidate(self):
+        if self.__completion_serial is not None:
+            # Don't let a stale request hold up the thread pool
+            self.__complsys.cancel(self.__completion_serial)
+            self.__completion_serial = None
         self.__token = None
         self.__completer = None
         self.__current_completion = None
@@ -419,7 +424,8 @@ class CompletionStatusDisplay(hotwidgets.TransientPopup):
         self.__token = text
         self.__completer = completer
         if completer:
-            self.__complsys.async_complete(completer, text, context.get_cwd(), self.__completions_result)
+            self.__completion_serial = self.__complsys.async_complete(completer, text, context.get_cwd(), 
+                                                                      self.__completions_result)
         
     def completion_request(self):      
         if self.__current_completion is not None:
@@ -450,6 +456,7 @@ class CompletionStatusDisplay(hotwidgets.TransientPopup):
         if not (text == self.__token and completer == self.__completer):
             _logger.debug("stale completion result")
             return
+        self.__completion_serial = None
         self.__current_completion = results
         self.__completion_display.set_content(self.__current_completion.results)        
         if self.__pending_completion_load:
@@ -96,6 +96,9 @@ class ObjectsDisplay(gtk.VBox):
             
     def supports_input(self):
         return self.__display and self.__display.supports_input()
+
+    def sorts_objects(self):
+        return self.__display and self.__display.sorts_objects()
             
     def start_input(self, old_focus):
         if self.__inputarea is None:
@@ -268,6 +271,9 @@ class MultiObjectsDisplay(gtk.Notebook):
     def supports_input(self):
         return self.__default_odisp and self.__default_odisp.supports_input()
 
+    def sorts_objects(self):
+        return self.__default_odisp and self.__default_odisp.sorts_objects()
+
     def start_input(self, old_focus):
         self.__default_odisp.start_input(old_focus)
 
@@ -360,32 +366,34 @@ class MultiObjectsDisplay(gtk.Notebook):
         if queue.opt_type:
             append_kwargs['fmt'] = queue.opt_type
         try:
-            while i < maxitems:
-                i += 1
-                item = queue.get(False)
+            while (not empty) and i < maxitems:
+                # Producers may transfer objects in batches; take a whole batch at once.
+                items = queue.get_batch(False)
                 changed = True
-                if item is None:
-                    if name is None:
-                        self.emit("primary-complete")
-                    empty = True
-                    queue.disconnect()
-                    break
-                _logger.debug("appending item: %s", item)
-                if odisp:
-                    if not odisp_displayed:
-                        self.append_page(odisp)
-                        odisp.show_all()
-                        self.set_tab_label_text(odisp, name or 'Default')
-                        self.set_show_tabs(True)
-                        odisp_displayed = True
-                    odisp.append_object(item, **append_kwargs)
-                    self.__ocount += 1
-                    if self.__do_autoswitch:
-                        self.set_current_page(self.page_num(odisp))
-                        self.__do_autoswitch = False
-                    active_odisp = True
-                else:
-                    _logger.warn("Unexpected item %s from queue %s", item, name)
+                for item in items:
+                    i += 1
+                    if item is None:
+                        if name is None:
+                            self.emit("primary-complete")
+                        empty = True
+                        queue.disconnect()
+                        break
+                    _logger.debug("appending item: %s", item)
+                    if odisp:
+                        if not odisp_displayed:
+                            self.append_page(odisp)
+                            odisp.show_all()
+                            self.set_tab_label_text(odisp, name or 'Default')
+                            self.set_show_tabs(True)
+                            odisp_displayed = True
+                        odisp.append_object(item, **append_kwargs)
+                        self.__ocount += 1
+                        if self.__do_autoswitch:
+                            self.set_current_page(self.page_num(odisp))
+                            self.__do_autoswitch = False
+                        active_odisp = True
+                    else:
+                        _logger.warn("Unexpected item %s from queue %s", item, name)
         except Queue.Empty:
             pass
         if empty:
@@ -394,7 +402,7 @@ class MultiObjectsDisplay(gtk.Notebook):
             odisp.do_autoscroll()
         if changed:
             self.emit("changed")
-        readd_idle = (not empty) and (i == maxitems)
+        readd_idle = (not empty) and (i >= maxitems)
         _logger.debug("doing idle readd: %s", readd_idle)
         return readd_idle
 
@@ -21,6 +21,7 @@ import os, sys, re, logging, string,locale
 import gtk, gobject, pango
 
 from hotwire.state import Preferences
+from hotwire.resultcache import ResultCache
 from hotwire.logutil import log_except
 import hotwire_ui.widgets as hotwidgets
 from hotwire_ui.pixbufcache import PixbufCache
@@ -149,6 +150,14 @@ class PrefsWindow(gtk.Dialog):
         readline.connect('toggled', self.__on_readline_toggled)        
         vbox.pack_start(hotwidgets.Align(readline, padding_left=12), expand=False)
         self.__sync_emacs_sensitive()
+        profile = gtk.CheckButton(_('Show pipeline profiling statistics'))
+        profile.set_property('active', prefs.get_pref('ui.pipeline.profile', default=False))
+        profile.connect('toggled', self.__on_profile_toggled)
+        vbox.pack_start(hotwidgets.Align(profile, padding_left=12), expand=False)
+        cache = gtk.CheckButton(_('Reuse recent output of commands that only read files'))
+        cache.set_property('active', prefs.get_pref('ui.pipeline.cache', default=True))
+        cache.connect('toggled', self.__on_cache_toggled)
+        vbox.pack_start(hotwidgets.Align(cache, padding_left=12), expand=False)
         
         label = gtk.Label()
         label.set_markup('<b>%s</b>' % (_('System'),))
@@ -247,6 +256,18 @@ class PrefsWindow(gtk.Dialog):
         prefs.set_pref('ui.menuaccels', not active)
         self.__sync_emacs_sensitive()
 
+    def __on_profile_toggled(self, cb):
+        active = cb.get_property('active')
+        prefs = Preferences.getInstance()
+        prefs.set_pref('ui.pipeline.profile', active)
+
+    def __on_cache_toggled(self, cb):
+        active = cb.get_property('active')
+        prefs = Preferences.getInstance()
+        prefs.set_pref('ui.pipeline.cache', active)
+        if not active:
+            ResultCache.getInstance().invalidate()
+
     def __on_folders_before_files_toggled(self, cb):
         active = cb.get_property('active')
         prefs = Preferences.getInstance()
@@ -90,6 +90,11 @@ class ObjectsRenderer(gobject.GObject):
     
     def supports_input(self):
         return False
+
+    def sorts_objects(self):
+        """Whether objects are shown in an order of our own, whatever
+the order they are appended in."""
+        return False
     
     def get_input(self):
         raise NotImplementedError()
@@ -138,6 +143,10 @@ class TreeObjectsRenderer(ObjectsRenderer):
     def get_widget(self):
         return self._table
 
+    def sorts_objects(self):
+        (column, order) = self._model.get_sort_column_id()
+        return column is not None and column >= 0
+
     def get_objects(self):
         iter = self._model.get_iter_first()
         while iter:
@@ -33,7 +33,6 @@ from hotwire.logutil import log_except
 from hotwire_ui.pixbufcache import PixbufCache
 from hotwire_ui.adaptors.editors import EditorRegistry
 from hotwire.util import format_file_size, quote_arg
-from hotwire.externals.dispatch import dispatcher
 from hotwire.state import Preferences
 
 _logger = logging.getLogger("hotwire.ui.render.File")
@@ -45,6 +44,8 @@ class FilePathRenderer(TreeObjectsRenderer):
         self.__fs = Filesystem.getInstance()
         self.__basedir = None
         self.__windows_basedir = None
+        # Files waiting for an async stat -> their iter in the liststore
+        self.__pending_stat = {}
         super(FilePathRenderer, self).__init__(*args,
                                                **kwargs)
         self._table.enable_model_drag_source(gtk.gdk.BUTTON1_MASK,
@@ -74,9 +75,11 @@ class FilePathRenderer(TreeObjectsRenderer):
             return 0
         
         if (self.__folders_before_files):
-            if (ob1.is_directory and (not ob2.is_directory)):
+            ob1_dir = self.__is_directory(ob1)
+            ob2_dir = self.__is_directory(ob2)
+            if (ob1_dir and (not ob2_dir)):
                 return -1
-            if (ob2.is_directory and (not ob1.is_directory)):
+            if (ob2_dir and (not ob1_dir)):
                 return 1
         
         return cmp(ob1.path.lower(), ob2.path.lower())          
@@ -90,7 +93,7 @@ class FilePathRenderer(TreeObjectsRenderer):
         self._table.set_search_column(0)
         self._table.set_search_equal_func(self.__path_search_equal)
 
-        self._insert_column('icon', title='', renderfunc=self._render_icon, renderer=gtk.CellRendererPixbuf(), valuefunc=lambda x: x.mimetype)
+        self._insert_column('icon', title='', renderfunc=self._render_file_icon, renderer=gtk.CellRendererPixbuf(), valuefunc=lambda x: x.mimetype)
         self._insert_column('path', title=_('Path'), renderfunc=self._render_path,
                                     sortfunc=self.__compare_paths, 
                                     family='Monospace')
@@ -116,6 +119,31 @@ class FilePathRenderer(TreeObjectsRenderer):
     def _file_for_iter(self, model, iter):
         return model.get_value(iter, 0)
 
+    def __is_directory(self, fobj):
+        # Sorting doesn't load stats on the main thread; links and files of
+        # unknown type are placed once theirs arrive
+        if fobj.stat_pending:
+            return fobj.type_hint == 'd'
+        return fobj.is_directory
+
+    def __stat_ready(self, fobj, model, iter):
+        """Return whether fobj's stat is loaded; if not, it is loaded in the
+background and the row redrawn then."""
+        if not fobj.stat_pending:
+            return True
+        if fobj not in self.__pending_stat:
+            path = model.convert_path_to_child_path(model.get_path(iter))
+            self.__pending_stat[fobj] = self._liststore.get_iter(path)
+            fobj.get_stat(self.__handle_files_stat)
+        return False
+
+    def _render_file_icon(self, col, cell, model, iter, data):
+        obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('icon-name', (obj.type_hint == 'd') and 'gtk-directory' or 'gtk-file')
+            return
+        self._render_icon(col, cell, model, iter, data)
+
     def _render_path(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
         path = obj.path
@@ -137,6 +165,9 @@ class FilePathRenderer(TreeObjectsRenderer):
 
     def _render_size(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('text', '')
+            return
         size = obj.size
         if size is not None: 
             cell.set_property('text', format_file_size(size))
@@ -145,6 +176,9 @@ class FilePathRenderer(TreeObjectsRenderer):
 
     def _render_last_modified(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('text', '')
+            return
         mtime = obj.mtime
         if mtime is not None:
             dt = datetime.datetime.fromtimestamp(mtime) 
@@ -154,40 +188,54 @@ class FilePathRenderer(TreeObjectsRenderer):
 
     def _render_owner(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('text', '')
+            return
         cell.set_property('text', obj.owner_name or '')
 
     def _render_group(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('text', '')
+            return
         cell.set_property('text', obj.group_name or '')
             
     def _render_permissions(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('text', '')
+            return
         perms = obj.permissions_string
         cell.set_property('text', perms or '')
         
     def _render_mime(self, col, cell, model, iter, data):
         obj = self._file_for_iter(model, iter)
+        if not self.__stat_ready(obj, model, iter):
+            cell.set_property('text', '')
+            return
         mime = obj.mimetype
         cell.set_property('text', mime or '')
         
     @log_except(_logger)
-    def __handle_file_change(self, signal=None, sender=None):
-        fobj = sender
-        _logger.debug("got file change for %r", fobj)
-        self._signal_obj_changed(fobj, colidx=0)
+    def __handle_files_stat(self, files):
+        _logger.debug("got stat for %d files", len(files))
+        for fobj in files:
+            iter = self.__pending_stat.pop(fobj, None)
+            if iter is not None:
+                self._liststore.row_changed(self._liststore.get_path(iter), iter)
 
     def _get_row(self, obj):
         if isinstance(obj, File):
             fobj = obj
         else:
-            fobj = self.__fs.get_file(obj)
-        dispatcher.connect(self.__handle_file_change, sender=fobj)
+            fobj = self.__fs.get_file(obj, cb=self.__handle_files_stat)
         return (fobj,)
     
     def append_obj(self, obj, **kwargs):
-        row = self._get_row(obj)
+        newrow = self._get_row(obj)
+        fobj = newrow[0]
         if self.__basedir is not False:
-            bn,fn = os.path.split(row[0].path)
+            bn,fn = os.path.split(fobj.path)
             if self.__basedir is None:
                 _logger.debug("using basedir %s", bn)
                 self.__basedir = bn
@@ -203,7 +251,9 @@ class FilePathRenderer(TreeObjectsRenderer):
                 self.__basedir = False
                 for row in self._liststore:
                     self._liststore.row_changed(row.path, row.iter)                
-        self._liststore.append(row)
+        iter = self._liststore.append(newrow)
+        if fobj is not obj:
+            self.__pending_stat[fobj] = iter
 
     def _onclick_iter(self, iter):
         self.__do_open(self._file_for_iter(self._model, iter))
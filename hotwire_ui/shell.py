@@ -86,6 +86,9 @@ class HotwireClientContext(hotwire.command.HotwireContext):
     
     def get_current_output_ref(self):
         return self.__hotwire.get_current_output_ref()
+
+    def get_output_pipeline(self, ref):
+        return self.__hotwire.get_output_pipeline(ref)
     
     def snapshot_output(self, ref):
         return self.__hotwire.snapshot_output(ref)
@@ -710,6 +713,12 @@ class Hotwire(gtk.VBox):
             return weakref.ref(odisp)
         return None
     
+    def get_output_pipeline(self, ref):
+        odisp = ref()
+        if not odisp:
+            return None
+        return odisp.get_pipeline()
+
     def snapshot_output(self, ref):
         return self.__do_snapshot(ref)
     
@@ -787,7 +796,13 @@ class Hotwire(gtk.VBox):
         self.__unset_welcome()
 
         self.__outputs.add_pipeline(pipeline)
-        pipeline.execute(opt_formats=self.__outputs.get_current().get_opt_formats())
+        prefs = Preferences.getInstance()
+        odisp = self.__outputs.get_current()
+        # A display which sorts for itself lets the last command skip sorting
+        pipeline.execute(opt_formats=odisp.get_opt_formats(),
+                         profile=prefs.get_pref('ui.pipeline.profile', default=False),
+                         cache=prefs.get_pref('ui.pipeline.cache', default=True),
+                         ordered=not odisp.sorts_objects())
         
     def __unset_welcome(self):
         if not self.__welcome:
@@ -1018,7 +1033,7 @@ class Hotwire(gtk.VBox):
 
     def __requeue_parse(self):
         self.__unqueue_parse()
-        self.__idle_parse_id = gobject.timeout_add(450, self.__idle_do_parse_and_complete)        
+        self.__idle_parse_id = gobject.timeout_add(200, self.__idle_do_parse_and_complete)        
 
     def __queue_parse(self):
         self.__parse_stale = True